@@ -1,25 +1,87 @@
+import asyncio
 import os
-from typing import Any, Callable, Literal
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Literal, cast, get_args
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
-from openai import OpenAI, Stream
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from openai import AsyncStream, Stream
 from openai.types.chat import ChatCompletionChunk, ChatCompletionToolParam
 from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
 from pydantic import BaseModel
-from duckduckgo_search.exceptions import DuckDuckGoSearchException
+from starlette.background import BackgroundTask
 
+from .utils.admission import (
+    AdmissionController,
+    Overloaded,
+    Pipeline,
+    arelease_after,
+    release_after,
+)
+from .utils.clients import (
+    async_openai_client,
+    get_ddgs,
+    get_exa_client,
+    openai_client,
+    pool_stats,
+)
+from .utils.context import get_encoding
+from .utils.lazy import startup_report
+from .utils.log import get_logger, log_payload
+from .utils.metrics import Trace, current_trace, registry, stage
+from .utils.passages import get_passage_splitter
+from .utils.pdf import (
+    get_embedding_batcher,
+    get_document_frequencies,
+    get_embeddings,
+    get_snapshot,
+    get_vector_backend,
+)
+from .utils.vector_index import NumpyVectorIndex
+from .utils.response_cache import (
+    SemanticResponseCache,
+    areplay,
+    cache_scope,
+    replay,
+)
 from .utils.prompt import ClientMessage, convert_to_openai_messages
 from .utils.rag import (
+    ado_pipelined_rag_search,
+    ado_rag_similarity_search,
+    agenerate_rag_parameters,
+    asimilarity_search_pdf,
+    do_pipelined_rag_search,
     do_rag_similarity_search,
     generate_rag_parameters,
+    RAG_SEARCH_MODE,
+    refinement_cache,
+    search_flight,
     similarity_search_pdf,
+    warm_up_retrieval,
 )
-from .utils.search import do_duckduckgo_search, do_exa_search
-from .utils.stream import stream_text
-from .utils.tools import duckduckgo_search, exa_search, get_current_weather
-from .utils.agent import do_research_agent
+from .utils.search import ado_web_search, do_web_search, web_search
+from .utils.rerank import rerank_stats
+from .utils.router import (
+    Route,
+    aroute_query,
+    corpus_centroid,
+    route_query,
+    router_stats,
+)
+from .utils.stream import astream_text, atrace_frames, stream_text, trace_frames
+from .utils.tools import (
+    aduckduckgo_search,
+    aexa_search,
+    aget_current_weather,
+    duckduckgo_search,
+    exa_search,
+    get_current_weather,
+    tool_cache_stats,
+)
+from .utils.agent import agent_flight, ado_research_agent, do_research_agent
 
 ###############################################################################
 # USE THIS TO CONTROL WHICH VERSION OF THE CHATBOT YOU WANT TO USE
@@ -52,20 +114,93 @@ from .utils.agent import do_research_agent
 #     Try a query like "What does the book say about catholicism, anglicanism,
 #     and protestantism in England? And what other scholarship can be good
 #     further reading on this topic?"
+#
+# 7 = Adaptive routing (opt-in)
+#     Each question is routed to a direct answer, PDF retrieval, web search or
+#     tools, based on cheap cues and on its similarity to the book's content.
+#     Should do well with all the prompts above, and skips retrieval for
+#     questions like "What is the capital of France?"
 ###############################################################################
 
-STEP: Literal[0, 1, 2, 3, 4, 5, 6] = 6
+Step = Literal[0, 1, 2, 3, 4, 5, 6, 7]
+
+
+def parse_step(value: str) -> Step:
+    """Validates the STEP setting, so a typo fails at startup."""
+    try:
+        step = int(value)
+    except ValueError:
+        step = None
+    if step not in get_args(Step):
+        raise ValueError(f"STEP must be an integer from 0 to 7, got {value!r}")
+    return cast(Step, step)
+
+
+# The STEP and ASYNC_MODE environment variables override these (the load
+# tests in `bench/` use them to run each step without editing this file)
+STEP: Step = parse_step(os.getenv("STEP", "6"))
+
+# When True, the whole chat path (OpenAI calls, tools, retrieval, streaming)
+# runs on the event loop, so a single worker can serve many chats at once.
+# Set it to False to use the original blocking implementation.
+ASYNC_MODE: bool = os.getenv("ASYNC_MODE", "1") == "1"
+
+# When True, each tool call starts as soon as its arguments are complete,
+# while the model is still streaming the next tool calls (STEP 4 and 5).
+SPECULATIVE_TOOL_CALLS: bool = False
+
+# When True, STEP 3 searches the raw query while it is being refined, instead
+# of waiting for the refinement, and merges both results.
+PIPELINED_REFINEMENT: bool = True
+
+# When True, answers are cached and replayed for paraphrases of a previous
+# question (same STEP and conversation), skipping retrieval and generation.
+SEMANTIC_CACHE: bool = False
+
+# Clients, embeddings and indexes are built on first use, so that startup
+# only imports what every STEP needs. When WARMUP is set, those of the active
+# STEP are built (and the indexes loaded) before the app accepts requests.
+WARMUP: bool = os.getenv("WARMUP", "0") == "1"
 
 ###############################################################################
 
 _ = load_dotenv(".env.local")
 _ = load_dotenv("../.env")
 
-app = FastAPI()
 
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),
-)
+def warm_up() -> None:
+    """Builds the clients and indexes that the active STEP uses."""
+    started_at = time.monotonic()
+    if STEP in (1, 2, 3, 5, 6, 7):
+        _ = get_encoding()
+    if STEP in (2, 3, 5, 6, 7):
+        warm_up_retrieval(lexical=RAG_SEARCH_MODE != "dense")
+    if STEP == 3 and PIPELINED_REFINEMENT and RAG_SEARCH_MODE == "dense":
+        _ = get_document_frequencies()
+    if STEP in (1, 5, 6, 7):
+        _ = get_exa_client()
+        _ = get_passage_splitter()
+    if STEP in (1, 6, 7):
+        _ = get_ddgs()
+    if STEP == 7:
+        _ = corpus_centroid()
+    logger.info("Warmed up STEP %d in %.2fs", STEP, time.monotonic() - started_at)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    if WARMUP:
+        await asyncio.to_thread(warm_up)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Shared with the embeddings, so they all reuse the same connection pools
+client = openai_client
+async_client = async_openai_client
+
+logger = get_logger(__name__)
 
 
 class Request(BaseModel):
@@ -161,6 +296,39 @@ available_tools: ToolsDict = {
     "exa_search": (exa_search_fn_def, exa_search),
 }
 
+STEP_TOOLS: dict[int, list[str]] = {
+    4: ["get_current_weather"],
+    5: ["get_current_weather", "exa_search", "similarity_search_pdf"],
+}
+
+# Admission control: each chat takes a slot in the pipeline of its STEP (or,
+# in STEP 7, of its route) for as long as it runs
+STEP_PIPELINES: dict[int, Pipeline] = {
+    0: "direct",
+    1: "retrieval",
+    2: "retrieval",
+    3: "retrieval",
+    4: "tools",
+    5: "tools",
+    6: "agent",
+}
+ROUTE_PIPELINES: dict[Route, Pipeline] = {
+    "direct": "direct",
+    "pdf_rag": "retrieval",
+    "web_search": "retrieval",
+    "tools": "tools",
+}
+
+admission = AdmissionController()
+response_cache = SemanticResponseCache()
+
+async_available_tools: ToolsDict = {
+    "get_current_weather": (get_current_weather_fn_def, aget_current_weather),
+    "duckduckgo_search": (duckduckgo_search_fn_def, aduckduckgo_search),
+    "similarity_search_pdf": (similarity_search_fn_def, asimilarity_search_pdf),
+    "exa_search": (exa_search_fn_def, aexa_search),
+}
+
 
 def get_last_msg_content(messages: list[ChatCompletionMessageParam]) -> str:
     last_msg = messages[-1]
@@ -173,6 +341,14 @@ def get_last_msg_content(messages: list[ChatCompletionMessageParam]) -> str:
         return content
 
 
+def select_tools(available: ToolsDict, tools_to_use: list[str]) -> ToolsDict:
+    return {
+        tool_name: available[tool_name]
+        for tool_name in tools_to_use
+        if tool_name in available
+    }
+
+
 def do_stream(
     messages: list[ChatCompletionMessageParam],
     tools: ToolsDict,
@@ -187,10 +363,24 @@ def do_stream(
     return stream
 
 
-@app.post("/api/chat")
-async def handle_chat_data(request: Request):
-    messages = request.messages
-    messages = convert_to_openai_messages(messages)
+async def ado_stream(
+    messages: list[ChatCompletionMessageParam],
+    tools: ToolsDict,
+) -> AsyncStream[ChatCompletionChunk]:
+    stream = await async_client.chat.completions.create(
+        messages=messages,
+        model="gpt-4o",
+        stream=True,
+        tools=[tools[name][0] for name in tools],
+    )
+
+    return stream
+
+
+def prepare_chat(
+    messages: list[ChatCompletionMessageParam],
+    route: Route | None = None,
+) -> tuple[list[ChatCompletionMessageParam], list[str]]:
     tools_to_use: list[str] = []
 
     match STEP:
@@ -198,36 +388,27 @@ async def handle_chat_data(request: Request):
             pass
         case 1:
             query = get_last_msg_content(messages)
-            try:
-                messages = do_duckduckgo_search(
-                    query=query,
-                    messages=messages,
-                )
-                print("DUCKDUCKGO SEARCH RESULTS:", messages[-1].get("content", ""))
-            except DuckDuckGoSearchException as e:
-                print("DUCKDUCKGO SEARCH ERROR:", e)
-                messages = do_exa_search(
-                    query=query,
-                    messages=messages,
-                )
-                print("EXA SEARCH RESULTS:", messages[-1].get("content", ""))
+            messages = do_web_search(query=query, messages=messages)
+            log_payload(logger, "Web search results", messages[-1].get("content", ""))
         case 2:
             query = get_last_msg_content(messages)
             messages = do_rag_similarity_search(messages=messages, query=query, k=10)
-            print("RAG SEARCH RESULTS:", messages[-1].get("content", ""))
+            log_payload(logger, "RAG search results", messages[-1].get("content", ""))
+        case 3 if PIPELINED_REFINEMENT:
+            query = get_last_msg_content(messages)
+            messages = do_pipelined_rag_search(
+                messages=messages, raw_query=query, client=client
+            )
+            log_payload(logger, "RAG search results", messages[-1].get("content", ""))
         case 3:
             query = get_last_msg_content(messages)
             query, k = generate_rag_parameters(raw_query=query, client=client)
             messages = do_rag_similarity_search(messages=messages, query=query, k=k)
-            print("RAG SEARCH RESULTS:", messages[-1].get("content", ""))
+            log_payload(logger, "RAG search results", messages[-1].get("content", ""))
         case 4:
-            tools_to_use = ["get_current_weather"]
+            tools_to_use = STEP_TOOLS[4]
         case 5:
-            tools_to_use = [
-                "get_current_weather",
-                "exa_search",
-                "similarity_search_pdf",
-            ]
+            tools_to_use = STEP_TOOLS[5]
         case 6:
             query = get_last_msg_content(messages)
             messages = do_research_agent(
@@ -236,13 +417,210 @@ async def handle_chat_data(request: Request):
                 client=client,
                 available_tools=available_tools,
             )
+        case 7:
+            query = get_last_msg_content(messages)
+            route = route or route_query(query)
+            started_at = time.monotonic()
+            match route:
+                case "direct":
+                    pass
+                case "pdf_rag":
+                    messages = do_rag_similarity_search(
+                        messages=messages, query=query, k=10
+                    )
+                case "web_search":
+                    messages = do_web_search(query=query, messages=messages)
+                case "tools":
+                    tools_to_use = STEP_TOOLS[5]
+            router_stats.record(route, time.monotonic() - started_at)
 
-    tools = {
-        tool_name: available_tools[tool_name]
-        for tool_name in tools_to_use
-        if tool_name in available_tools
-    }
-    stream = do_stream(messages=messages, tools=tools)
-    response = StreamingResponse(stream_text(stream, tools))
+    return messages, tools_to_use
+
+
+async def aprepare_chat(
+    messages: list[ChatCompletionMessageParam],
+    route: Route | None = None,
+) -> tuple[list[ChatCompletionMessageParam], list[str]]:
+    tools_to_use: list[str] = []
+
+    match STEP:
+        case 0:
+            pass
+        case 1:
+            query = get_last_msg_content(messages)
+            messages = await ado_web_search(query=query, messages=messages)
+            log_payload(logger, "Web search results", messages[-1].get("content", ""))
+        case 2:
+            query = get_last_msg_content(messages)
+            messages = await ado_rag_similarity_search(
+                messages=messages, query=query, k=10
+            )
+            log_payload(logger, "RAG search results", messages[-1].get("content", ""))
+        case 3 if PIPELINED_REFINEMENT:
+            query = get_last_msg_content(messages)
+            messages = await ado_pipelined_rag_search(
+                messages=messages, raw_query=query, client=async_client
+            )
+            log_payload(logger, "RAG search results", messages[-1].get("content", ""))
+        case 3:
+            query = get_last_msg_content(messages)
+            query, k = await agenerate_rag_parameters(
+                raw_query=query, client=async_client
+            )
+            messages = await ado_rag_similarity_search(
+                messages=messages, query=query, k=k
+            )
+            log_payload(logger, "RAG search results", messages[-1].get("content", ""))
+        case 4:
+            tools_to_use = STEP_TOOLS[4]
+        case 5:
+            tools_to_use = STEP_TOOLS[5]
+        case 6:
+            query = get_last_msg_content(messages)
+            messages = await ado_research_agent(
+                query=query,
+                messages=messages,
+                client=async_client,
+                available_tools=async_available_tools,
+            )
+        case 7:
+            query = get_last_msg_content(messages)
+            route = route or await aroute_query(query)
+            started_at = time.monotonic()
+            match route:
+                case "direct":
+                    pass
+                case "pdf_rag":
+                    messages = await ado_rag_similarity_search(
+                        messages=messages, query=query, k=10
+                    )
+                case "web_search":
+                    messages = await ado_web_search(query=query, messages=messages)
+                case "tools":
+                    tools_to_use = STEP_TOOLS[5]
+            router_stats.record(route, time.monotonic() - started_at)
+
+    return messages, tools_to_use
+
+
+@app.post("/api/chat")
+async def handle_chat_data(request: Request):
+    trace = Trace()
+    _ = current_trace.set(trace)
+    messages = request.messages
+    with stage("message_conversion"):
+        messages = convert_to_openai_messages(messages)
+
+    # In STEP 7 the route is chosen first, since it decides the pipeline (and
+    # the cached answers that may be reused)
+    route: Route | None = None
+    if STEP == 7:
+        query = get_last_msg_content(messages)
+        route = await aroute_query(query) if ASYNC_MODE else route_query(query)
+
+    scope: str | None = None
+    vector: list[float] | None = None
+    if SEMANTIC_CACHE:
+        scope = cache_scope(STEP, STEP_TOOLS.get(STEP, []), messages, route)
+        query = get_last_msg_content(messages)
+        if ASYNC_MODE:
+            embeddings = await get_embeddings.aget()
+            vector = await embeddings.aembed_query(query)
+        else:
+            vector = get_embeddings().embed_query(query)
+        frames = response_cache.lookup(scope, vector)
+        if frames is not None:
+            logger.info("%s response_cache=hit", trace.summary())
+            response = StreamingResponse(
+                areplay(frames) if ASYNC_MODE else replay(frames)
+            )
+            response.headers["x-vercel-ai-data-stream"] = "v1"
+            return response
+
+    pipeline = ROUTE_PIPELINES[route] if route else STEP_PIPELINES[STEP]
+    try:
+        slot = await admission.acquire(pipeline)
+    except Overloaded as e:
+        logger.warning("%s rejected: %s", trace.summary(), e)
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    try:
+        if ASYNC_MODE:
+            with stage("prepare"):
+                messages, tools_to_use = await aprepare_chat(messages, route)
+            tools = select_tools(async_available_tools, tools_to_use)
+            llm_started_at = time.monotonic()
+            stream = await ado_stream(messages=messages, tools=tools)
+            frames = atrace_frames(
+                astream_text(stream, tools, speculative=SPECULATIVE_TOOL_CALLS),
+                trace,
+                llm_started_at,
+            )
+            if scope is not None and vector is not None:
+                frames = response_cache.arecord(frames, scope, vector)
+            frames = arelease_after(frames, slot)
+        else:
+            with stage("prepare"):
+                messages, tools_to_use = prepare_chat(messages, route)
+            tools = select_tools(available_tools, tools_to_use)
+            llm_started_at = time.monotonic()
+            stream = do_stream(messages=messages, tools=tools)
+            frames = trace_frames(
+                stream_text(stream, tools, speculative=SPECULATIVE_TOOL_CALLS),
+                trace,
+                llm_started_at,
+            )
+            if scope is not None and vector is not None:
+                frames = response_cache.record(frames, scope, vector)
+            frames = release_after(frames, slot)
+    except BaseException:
+        slot.release()
+        raise
+
+    # Also released after the response, in case the stream never started
+    response = StreamingResponse(frames, background=BackgroundTask(slot.release))
     response.headers["x-vercel-ai-data-stream"] = "v1"
     return response
+
+
+@app.get("/api/metrics")
+async def handle_metrics():
+    """Latency histograms, in the Prometheus text format."""
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/api/stats")
+async def handle_stats():
+    # Only what was built: the stats shouldn't load the indexes
+    embeddings = get_embeddings.peek()
+    embedding_batcher = get_embedding_batcher.peek()
+    vector_backend = get_vector_backend.peek()
+    stats: dict[str, Any] = {  # pyright: ignore[reportExplicitAny]
+        "startup": startup_report(),
+        "embedding_cache": embeddings.stats() if embeddings else None,
+        "embedding_batcher": embedding_batcher.stats() if embedding_batcher else None,
+        "response_cache": response_cache.stats(),
+        "tool_caches": tool_cache_stats(),
+        "http_pools": pool_stats(),
+        "web_search": web_search.report(),
+        "rag_refinement_cache": refinement_cache.stats(),
+        "rerank": rerank_stats.report(),
+        "router": router_stats.report(),
+        "admission": admission.stats(),
+        "coalescing": {
+            "pdf_search": search_flight.stats(),
+            "research_agent": agent_flight.stats(),
+        },
+    }
+    if isinstance(vector_backend, NumpyVectorIndex):
+        stats["vector_index"] = vector_backend.memory_report()
+    snapshot = get_snapshot.peek()
+    if snapshot is not None:
+        stats["snapshot"] = snapshot.snapshot.manifest
+    return stats
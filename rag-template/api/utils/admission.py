@@ -0,0 +1,221 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Iterator
+from typing import Literal
+
+from .metrics import SECONDS_BUCKETS, registry
+
+Pipeline = Literal["direct", "retrieval", "tools", "agent"]
+PIPELINES: list[Pipeline] = ["direct", "retrieval", "tools", "agent"]
+
+# Chats of each pipeline running at once (from the request to the end of its
+# stream), and chats that may queue for a slot beyond that. Chats arriving
+# when the queue is full, or waiting longer than ADMISSION_QUEUE_TIMEOUT, are
+# turned away with a 429. Each pipeline has its own slots, so that research
+# agents can't starve the cheap chats.
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+PIPELINE_LIMITS: dict[Pipeline, tuple[int, int]] = {
+    "direct": (
+        int(os.getenv("DIRECT_CONCURRENCY", "64")),
+        int(os.getenv("DIRECT_QUEUE_DEPTH", "128")),
+    ),
+    "retrieval": (
+        int(os.getenv("RETRIEVAL_CONCURRENCY", "32")),
+        int(os.getenv("RETRIEVAL_QUEUE_DEPTH", "64")),
+    ),
+    "tools": (
+        int(os.getenv("TOOLS_CONCURRENCY", "16")),
+        int(os.getenv("TOOLS_QUEUE_DEPTH", "32")),
+    ),
+    "agent": (
+        int(os.getenv("AGENT_CONCURRENCY", "4")),
+        int(os.getenv("AGENT_QUEUE_DEPTH", "8")),
+    ),
+}
+
+
+class Overloaded(Exception):
+    def __init__(self, pipeline: Pipeline, reason: str, retry_after: int):
+        super().__init__(f"The {pipeline} pipeline is overloaded ({reason})")
+        self.pipeline = pipeline
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Slot:
+    """A chat's place in its pipeline, given back once with `release`.
+
+    Releasing is idempotent and thread-safe, since a response may end both
+    in the thread streaming it and in its background task.
+    """
+
+    def __init__(self, limiter: "PipelineLimiter | None"):
+        self.limiter = limiter
+        self.acquired_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._released = False
+
+    def release(self) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        if self.limiter is not None:
+            self.limiter.release(time.monotonic() - self.acquired_at)
+
+
+class PipelineLimiter:
+    """Bounded concurrency with a bounded FIFO queue, for one pipeline.
+
+    Slots are acquired on the event loop, but may be released from any thread
+    (sync responses are streamed from a worker thread): a released slot is
+    handed directly to the first waiter, whose future is resolved on its loop.
+    """
+
+    def __init__(
+        self,
+        pipeline: Pipeline,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.pipeline = pipeline
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiters: deque[
+            tuple[asyncio.AbstractEventLoop, asyncio.Future[None]]
+        ] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_queued = 0
+        self.wait_seconds = registry.histogram(
+            "admission_wait_seconds", "Time chats queue for a slot", pipeline=pipeline
+        )
+        self.hold_seconds = registry.histogram(
+            "admission_hold_seconds",
+            "Time chats hold their slot",
+            SECONDS_BUCKETS + (30, 60, 120),
+            pipeline=pipeline,
+        )
+
+    def retry_after(self) -> int:
+        """Seconds until the queue has likely drained, for `Retry-After`."""
+        count, total = self.hold_seconds.count, self.hold_seconds.sum
+        mean = total / count if count else 1.0
+        return max(1, math.ceil(mean * (len(self._waiters) + 1) / self.max_concurrency))
+
+    async def acquire(self) -> Slot:
+        started_at = time.monotonic()
+        with self._lock:
+            if self._running < self.max_concurrency and not self._waiters:
+                self._running += 1
+                self.admitted += 1
+                self.wait_seconds.observe(0.0)
+                return Slot(self)
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded(self.pipeline, "queue full", self.retry_after())
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+            self.peak_queued = max(self.peak_queued, len(self._waiters))
+
+        try:
+            await asyncio.wait_for(waiter[1], self.queue_timeout)
+        except BaseException as e:
+            with self._lock:
+                granted = waiter not in self._waiters
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                # The slot was handed over just as we gave up: pass it on
+                self.hand_over()
+            if isinstance(e, TimeoutError):
+                self.timed_out += 1
+                raise Overloaded(
+                    self.pipeline, "queue timeout", self.retry_after()
+                ) from None
+            raise
+        self.admitted += 1
+        self.wait_seconds.observe(time.monotonic() - started_at)
+        return Slot(self)
+
+    def release(self, held_seconds: float) -> None:
+        self.hold_seconds.observe(held_seconds)
+        self.hand_over()
+
+    def hand_over(self) -> None:
+        """Gives a freed slot to the first waiter, or returns it to the pool."""
+        with self._lock:
+            if not self._waiters:
+                self._running -= 1
+                return
+            loop, future = self._waiters.popleft()
+        _ = loop.call_soon_threadsafe(grant, future)
+
+    def stats(self) -> dict[str, object]:
+        with self._lock:
+            running, queued = self._running, len(self._waiters)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "running": running,
+            "queued": queued,
+            "peak_queued": self.peak_queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds": self.wait_seconds.as_dict(),
+        }
+
+
+def grant(future: asyncio.Future[None]) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """One `PipelineLimiter` per pipeline; admits everything when disabled."""
+
+    def __init__(self, enabled: bool = ADMISSION_CONTROL):
+        self.enabled = enabled
+        self.limiters = {
+            pipeline: PipelineLimiter(pipeline, *PIPELINE_LIMITS[pipeline])
+            for pipeline in PIPELINES
+        }
+
+    async def acquire(self, pipeline: Pipeline) -> Slot:
+        if not self.enabled:
+            return Slot(None)
+        return await self.limiters[pipeline].acquire()
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            **{pipeline: limiter.stats() for pipeline, limiter in self.limiters.items()},
+        }
+
+
+def release_after(frames: Iterator[str], slot: Slot) -> Iterator[str]:
+    """Releases the slot once the response is streamed (or fails)."""
+    try:
+        yield from frames
+    finally:
+        slot.release()
+
+
+async def arelease_after(frames: AsyncIterator[str], slot: Slot) -> AsyncIterator[str]:
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        slot.release()
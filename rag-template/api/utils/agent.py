@@ -1,6 +1,12 @@
-from typing import Any, Callable
+import asyncio
+import concurrent.futures
+import inspect
+import os
+import time
+from contextvars import copy_context
+from typing import Any, Callable, Literal
 import json
-from openai import OpenAI
+from openai import APITimeoutError, AsyncOpenAI, OpenAI
 from openai.types.chat import (
     ChatCompletionToolParam,
     ChatCompletionUserMessageParam,
@@ -9,140 +15,512 @@ from openai.types.chat import (
 from openai.types.responses import (
     EasyInputMessageParam,
     FunctionToolParam,
+    Response,
+    ResponseFunctionToolCall,
     ResponseInputItemParam,
+    ToolParam,
 )
 from openai.types.responses.response_input_param import FunctionCallOutput
 from openai.types.shared_params.reasoning import Reasoning
+from pydantic import BaseModel
+
+from .coalesce import SingleFlight
+from .embedding_cache import normalize_query
+from .executor import tool_executor, tool_timeout
+from .log import get_logger, log_payload
+from .metrics import SIZE_BUCKETS, observe_stage, registry, stage
+from .passages import pack_tool_result
 
 ToolsDict = dict[str, tuple[ChatCompletionToolParam, Callable[..., Any]]]  # pyright: ignore[reportExplicitAny]
 
+INSTRUCTIONS = (
+    "You are a subagent within a more complex agent framework. "
+    "Your job is to compile research information and give it to the main "
+    "agent. Use the search and PDF retrieval tool repeatedly, up to 10 "
+    "requests. After this is done, generate a long message with all the"
+    "relevant information. Don't hesitate to pass "
+    "a long-ish answer; the main agent will create a synthesis."
+    "If DuckDuckGo is not working, use Exa instead."
+)
 
-def research_agent(query: str, client: OpenAI, available_tools: ToolsDict) -> str:
-    instructions = (
-        "You are a subagent within a more complex agent framework. "
-        "Your job is to compile research information and give it to the main "
-        "agent. Use the search and PDF retrieval tool repeatedly, up to 10 "
-        "requests. After this is done, generate a long message with all the"
-        "relevant information. Don't hesitate to pass "
-        "a long-ish answer; the main agent will create a synthesis."
-        "If DuckDuckGo is not working, use Exa instead."
-    )
-    stop = False
-    messages: list[ResponseInputItemParam] = [
-        EasyInputMessageParam(content=f"The research query is: {query}", role="user")
-    ]
-    previous_response_id: None | str = None
-    text = ""
-    while not stop:
-        print(messages)
-        response = client.responses.create(
-            input=messages,
-            previous_response_id=previous_response_id,
-            model="o4-mini",
-            instructions=instructions,
-            store=True,
-            reasoning=Reasoning(summary="detailed"),
-            tools=[
-                {"type": "web_search_preview"},
-                # FunctionToolParam(
-                #     type="function",
-                #     name="duckduckgo_search",
-                #     description="Searches DuckDuckGo for the given query and returns a list of results",
-                #     parameters={
-                #         "type": "object",
-                #         "required": ["query"],
-                #         "properties": {
-                #             "query": {
-                #                 "type": "string",
-                #                 "description": "The search query to look for on DuckDuckGo",
-                #             }
-                #         },
-                #         "additionalProperties": False,
-                #     },
-                #     strict=True,
-                # ),
-                # FunctionToolParam(
-                #     name="exa_search",
-                #     description="Performs a search on Exa",
-                #     strict=True,
-                #     type="function",
-                #     parameters={
-                #         "type": "object",
-                #         "required": ["query"],
-                #         "properties": {
-                #             "query": {
-                #                 "type": "string",
-                #                 "description": "The search query to look for on Exa",
-                #             }
-                #         },
-                #         "additionalProperties": False,
-                #     },
-                # ),
-                FunctionToolParam(
-                    name="similarity_search_pdf",
-                    description="Performs similarity search in PDF documents based on a query.",
-                    strict=True,
-                    type="function",
-                    parameters={
-                        "type": "object",
-                        "required": ["query", "k"],
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "The query string for searching similar PDFs",
-                            },
-                            "k": {
-                                "type": "number",
-                                "description": "The number of top similar PDFs to return",
-                            },
-                        },
-                        "additionalProperties": False,
-                    },
-                ),
+SYNTHESIS_INSTRUCTIONS = (
+    "The research budget is exhausted: do not call any more tools. Write "
+    "your final message now, with all the relevant information gathered so "
+    "far, and mention which parts of the research query remain open."
+)
+
+# Seconds allowed for the final synthesis request once a budget runs out,
+# capped by what is left of the wall-time budget (but never below the floor)
+SYNTHESIS_TIMEOUT = 30.0
+SYNTHESIS_MIN_TIMEOUT = 5.0
+
+StopReason = Literal["done", "max_rounds", "max_wall_time", "max_total_tokens"]
+
+logger = get_logger(__name__)
+
+
+class AgentBudget(BaseModel):
+    max_rounds: int = int(os.getenv("AGENT_MAX_ROUNDS", "8"))
+    max_wall_time: float = float(os.getenv("AGENT_MAX_WALL_TIME", "120"))
+    max_total_tokens: int = int(os.getenv("AGENT_MAX_TOTAL_TOKENS", "200000"))
+
+
+class AgentRound(BaseModel):
+    round: int
+    llm_seconds: float
+    tool_seconds: float
+    input_tokens: int
+    output_tokens: int
+    tool_calls: int
+
+
+class AgentRun(BaseModel):
+    text: str
+    stop_reason: StopReason
+    rounds: list[AgentRound]
+    total_seconds: float
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(r.input_tokens + r.output_tokens for r in self.rounds)
+
+    def report(self) -> str:
+        lines = [
+            f"Research agent: {len(self.rounds)} rounds, {self.total_seconds:.1f}s, "
+            + f"{self.total_tokens} tokens, stopped on '{self.stop_reason}'"
+        ]
+        for r in self.rounds:
+            lines.append(
+                f"  round {r.round}: llm {r.llm_seconds:.2f}s, "
+                + f"tools {r.tool_seconds:.2f}s ({r.tool_calls} calls), "
+                + f"{r.input_tokens} in / {r.output_tokens} out tokens"
+            )
+        return "\n".join(lines)
+
+
+# Concurrent requests with the same research query share one agent run
+agent_flight = SingleFlight[AgentRun]("research_agent")
+
+
+def record_agent_run(agent_run: AgentRun) -> None:
+    """Records the rounds of a research agent run as pipeline stages."""
+    for r in agent_run.rounds:
+        observe_stage("agent_llm", r.llm_seconds)
+        observe_stage("agent_round", r.llm_seconds + r.tool_seconds)
+    registry.histogram(
+        "agent_rounds", "Rounds of each research agent run", SIZE_BUCKETS
+    ).observe(len(agent_run.rounds))
+
+
+def response_tokens(response: Response) -> tuple[int, int]:
+    usage = response.usage
+    return (usage.input_tokens, usage.output_tokens) if usage else (0, 0)
+
+
+def fallback_text(last_text: str, tool_outputs: list[FunctionCallOutput]) -> str:
+    """What we return when even the synthesis request fails: the raw findings."""
+    findings = [str(item["output"]) for item in tool_outputs]
+    return "\n\n".join([last_text, *findings]).strip()
+
+
+class AgentRunState:
+    """The bookkeeping shared by the sync and async research loops.
+
+    It tracks the budget, the rounds and the conversation with the Responses
+    API, builds the arguments of each request, and turns the outcome into an
+    `AgentRun`, so that both loops only differ in how they await.
+    """
+
+    def __init__(self, query: str, budget: AgentBudget | None = None):
+        self.budget = budget or AgentBudget()
+        self.started_at = time.monotonic()
+        self.rounds: list[AgentRound] = []
+        self.messages: list[ResponseInputItemParam] = [
+            EasyInputMessageParam(content=f"The research query is: {query}", role="user")
+        ]
+        self.previous_response_id: str | None = None
+        self.tool_outputs: list[FunctionCallOutput] = []
+        self.last_text = ""
+
+    def remaining(self) -> float:
+        """Seconds left of the wall-time budget."""
+        return self.budget.max_wall_time - (time.monotonic() - self.started_at)
+
+    def check_budget(self) -> StopReason | None:
+        if len(self.rounds) >= self.budget.max_rounds:
+            return "max_rounds"
+        if self.remaining() <= 0:
+            return "max_wall_time"
+        total_tokens = sum(r.input_tokens + r.output_tokens for r in self.rounds)
+        if total_tokens >= self.budget.max_total_tokens:
+            return "max_total_tokens"
+        return None
+
+    def round_request(self) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+        log_payload(logger, "Agent input", self.messages)
+        return {
+            "input": self.messages,
+            "previous_response_id": self.previous_response_id,
+            "model": "o4-mini",
+            "instructions": INSTRUCTIONS,
+            "store": True,
+            "reasoning": Reasoning(summary="detailed"),
+            "tools": RESEARCH_TOOLS,
+            "timeout": self.remaining(),
+        }
+
+    def synthesis_request(self) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+        return {
+            "input": [
+                *self.messages,
+                EasyInputMessageParam(content=SYNTHESIS_INSTRUCTIONS, role="user"),
             ],
-        )
-        print(response.output)
+            "previous_response_id": self.previous_response_id,
+            "model": "o4-mini",
+            "instructions": INSTRUCTIONS,
+            "store": True,
+            "tools": RESEARCH_TOOLS,
+            "tool_choice": "none",
+            "timeout": max(
+                SYNTHESIS_MIN_TIMEOUT, min(SYNTHESIS_TIMEOUT, self.remaining())
+            ),
+        }
+
+    def start_round(self, response: Response) -> list[ResponseFunctionToolCall]:
+        """Records a model response, and returns the tool calls to run."""
+        log_payload(logger, "Agent output", response.output)
+        self.previous_response_id = response.id
+        self.last_text = response.output_text or self.last_text
         tool_calls = [item for item in response.output if item.type == "function_call"]
-        previous_response_id = response.id
-        messages = []
-        if len(tool_calls) == 0:
-            stop = True
-            text = response.output_text
-        else:
-            print(f"🛞 Tool calls:\n{tool_calls}\n")
-            for tool_call in tool_calls:
-                tool_call_call_id = tool_call.call_id
-                try:
-                    output = available_tools[tool_call.name][1](  # pyright: ignore[reportAny]
-                        **json.loads(tool_call.arguments)
-                    )
-                except Exception as e:
-                    output = f"Error calling tool {tool_call.name}: {e}"
-                    print(output)
-
-                messages.append(
-                    FunctionCallOutput(
-                        call_id=tool_call_call_id,
-                        type="function_call_output",
-                        output=str(output),
-                    )
+        if tool_calls:
+            logger.info("Agent tool calls: %s", [call.name for call in tool_calls])
+        return tool_calls
+
+    def end_round(
+        self,
+        response: Response,
+        llm_seconds: float,
+        tool_started_at: float,
+        tool_calls: list[ResponseFunctionToolCall],
+        outputs: list[FunctionCallOutput],
+    ) -> None:
+        if outputs:
+            self.tool_outputs.extend(outputs)
+            self.messages = list[ResponseInputItemParam](outputs)
+        input_tokens, output_tokens = response_tokens(response)
+        self.rounds.append(
+            AgentRound(
+                round=len(self.rounds) + 1,
+                llm_seconds=llm_seconds,
+                tool_seconds=time.monotonic() - tool_started_at,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                tool_calls=len(tool_calls),
+            )
+        )
+
+    def synthesis_failed(self, error: Exception) -> str:
+        logger.warning("Research agent synthesis failed: %s", error)
+        return fallback_text(self.last_text, self.tool_outputs)
+
+    def finish(self, text: str, stop_reason: StopReason) -> AgentRun:
+        return AgentRun(
+            text=text,
+            stop_reason=stop_reason,
+            rounds=self.rounds,
+            total_seconds=time.monotonic() - self.started_at,
+        )
+
+
+RESEARCH_TOOLS: list[ToolParam] = [
+    {"type": "web_search_preview"},
+    # FunctionToolParam(
+    #     type="function",
+    #     name="duckduckgo_search",
+    #     description="Searches DuckDuckGo for the given query and returns a list of results",
+    #     parameters={
+    #         "type": "object",
+    #         "required": ["query"],
+    #         "properties": {
+    #             "query": {
+    #                 "type": "string",
+    #                 "description": "The search query to look for on DuckDuckGo",
+    #             }
+    #         },
+    #         "additionalProperties": False,
+    #     },
+    #     strict=True,
+    # ),
+    # FunctionToolParam(
+    #     name="exa_search",
+    #     description="Performs a search on Exa",
+    #     strict=True,
+    #     type="function",
+    #     parameters={
+    #         "type": "object",
+    #         "required": ["query"],
+    #         "properties": {
+    #             "query": {
+    #                 "type": "string",
+    #                 "description": "The search query to look for on Exa",
+    #             }
+    #         },
+    #         "additionalProperties": False,
+    #     },
+    # ),
+    FunctionToolParam(
+        name="similarity_search_pdf",
+        description="Performs similarity search in PDF documents based on a query.",
+        strict=True,
+        type="function",
+        parameters={
+            "type": "object",
+            "required": ["query", "k"],
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "The query string for searching similar PDFs",
+                },
+                "k": {
+                    "type": "number",
+                    "description": "The number of top similar PDFs to return",
+                },
+            },
+            "additionalProperties": False,
+        },
+    ),
+]
+
+
+def run_function_call(
+    tool_call: ResponseFunctionToolCall, available_tools: ToolsDict
+) -> FunctionCallOutput:
+    arguments: dict[str, Any] = {}  # pyright: ignore[reportExplicitAny]
+    try:
+        arguments = json.loads(tool_call.arguments)
+        with stage(f"tool:{tool_call.name}"):
+            output = available_tools[tool_call.name][1](**arguments)  # pyright: ignore[reportAny]
+    except Exception as e:
+        output = f"Error calling tool {tool_call.name}: {e}"
+        logger.warning(output)
+
+    return FunctionCallOutput(
+        call_id=tool_call.call_id,
+        type="function_call_output",
+        output=str(pack_tool_result(output, arguments)),  # pyright: ignore[reportAny]
+    )
+
+
+def run_function_calls(
+    tool_calls: list[ResponseFunctionToolCall],
+    available_tools: ToolsDict,
+    max_seconds: float | None = None,
+) -> list[FunctionCallOutput]:
+    """Runs all the function calls of a turn concurrently on the tool executor.
+
+    Each call is given its own timeout (or `max_seconds`, what is left of the
+    agent's budget, if it is shorter), counted from when they were submitted.
+    """
+    started_at = time.monotonic()
+    futures = [
+        tool_executor.submit(
+            copy_context().run, run_function_call, tool_call, available_tools
+        )
+        for tool_call in tool_calls
+    ]
+
+    outputs: list[FunctionCallOutput] = []
+    for tool_call, future in zip(tool_calls, futures):
+        timeout = tool_timeout(tool_call.name)
+        if max_seconds is not None:
+            timeout = max(0.0, min(timeout, max_seconds))
+        try:
+            outputs.append(
+                future.result(timeout=max(0.0, started_at + timeout - time.monotonic()))
+            )
+        except concurrent.futures.TimeoutError:
+            _ = future.cancel()
+            logger.warning("Tool %s timed out", tool_call.name)
+            outputs.append(
+                FunctionCallOutput(
+                    call_id=tool_call.call_id,
+                    type="function_call_output",
+                    output=f"Tool {tool_call.name} timed out",
                 )
+            )
+    return outputs
 
-    return text
 
+async def arun_function_call(
+    tool_call: ResponseFunctionToolCall,
+    available_tools: ToolsDict,
+    max_seconds: float | None = None,
+) -> FunctionCallOutput:
+    arguments: dict[str, Any] = {}  # pyright: ignore[reportExplicitAny]
+    try:
+        fn = available_tools[tool_call.name][1]
+        arguments = json.loads(tool_call.arguments)
+        if inspect.iscoroutinefunction(fn):
+            call = fn(**arguments)  # pyright: ignore[reportAny]
+        else:
+            call = asyncio.to_thread(fn, **arguments)
+        with stage(f"tool:{tool_call.name}"):
+            timeout = tool_timeout(tool_call.name)
+            if max_seconds is not None:
+                timeout = max(0.0, min(timeout, max_seconds))
+            output = await asyncio.wait_for(call, timeout)  # pyright: ignore[reportAny]
+    except TimeoutError:
+        output = f"Tool {tool_call.name} timed out"
+        logger.warning(output)
+    except Exception as e:
+        output = f"Error calling tool {tool_call.name}: {e}"
+        logger.warning(output)
 
-def do_research_agent(
+    return FunctionCallOutput(
+        call_id=tool_call.call_id,
+        type="function_call_output",
+        output=str(pack_tool_result(output, arguments)),  # pyright: ignore[reportAny]
+    )
+
+
+async def arun_function_calls(
+    tool_calls: list[ResponseFunctionToolCall],
+    available_tools: ToolsDict,
+    max_seconds: float | None = None,
+) -> list[FunctionCallOutput]:
+    return list(
+        await asyncio.gather(
+            *(
+                arun_function_call(tool_call, available_tools, max_seconds)
+                for tool_call in tool_calls
+            )
+        )
+    )
+
+
+def research_agent(
     query: str,
-    messages: list[ChatCompletionMessageParam],
     client: OpenAI,
     available_tools: ToolsDict,
+    budget: AgentBudget | None = None,
+) -> AgentRun:
+    state = AgentRunState(query, budget)
+    stop_reason: StopReason | None = None
+
+    while (stop_reason := state.check_budget()) is None:
+        llm_started_at = time.monotonic()
+        try:
+            response = client.responses.create(**state.round_request())  # pyright: ignore[reportAny]
+        except APITimeoutError:
+            stop_reason = "max_wall_time"
+            break
+        llm_seconds = time.monotonic() - llm_started_at
+        tool_calls = state.start_round(response)
+
+        tool_started_at = time.monotonic()
+        outputs = (
+            run_function_calls(tool_calls, available_tools, state.remaining())
+            if tool_calls
+            else []
+        )
+        state.end_round(response, llm_seconds, tool_started_at, tool_calls, outputs)
+        if not tool_calls:
+            stop_reason = "done"
+            break
+
+    text = state.last_text
+    if stop_reason != "done":
+        try:
+            text = client.responses.create(**state.synthesis_request()).output_text  # pyright: ignore[reportAny]
+        except Exception as e:
+            text = state.synthesis_failed(e)
+    return state.finish(text, stop_reason)
+
+
+async def aresearch_agent(
+    query: str,
+    client: AsyncOpenAI,
+    available_tools: ToolsDict,
+    budget: AgentBudget | None = None,
+) -> AgentRun:
+    state = AgentRunState(query, budget)
+    stop_reason: StopReason | None = None
+
+    while (stop_reason := state.check_budget()) is None:
+        llm_started_at = time.monotonic()
+        try:
+            response = await client.responses.create(**state.round_request())  # pyright: ignore[reportAny]
+        except APITimeoutError:
+            stop_reason = "max_wall_time"
+            break
+        llm_seconds = time.monotonic() - llm_started_at
+        tool_calls = state.start_round(response)
+
+        tool_started_at = time.monotonic()
+        outputs = (
+            await arun_function_calls(tool_calls, available_tools, state.remaining())
+            if tool_calls
+            else []
+        )
+        state.end_round(response, llm_seconds, tool_started_at, tool_calls, outputs)
+        if not tool_calls:
+            stop_reason = "done"
+            break
+
+    text = state.last_text
+    if stop_reason != "done":
+        try:
+            response = await client.responses.create(**state.synthesis_request())  # pyright: ignore[reportAny]
+            text = response.output_text
+        except Exception as e:
+            text = state.synthesis_failed(e)
+    return state.finish(text, stop_reason)
+
+
+def finish_agent_run(agent_run: AgentRun) -> AgentRun:
+    """Logs and records a run, once for all the requests sharing it."""
+    logger.info("%s", agent_run.report())
+    record_agent_run(agent_run)
+    return agent_run
+
+
+def append_agent_message(
+    agent_run: AgentRun, messages: list[ChatCompletionMessageParam]
 ) -> list[ChatCompletionMessageParam]:
-    print(f"QUERY: {query}")
-    agent_msg = research_agent(query, client, available_tools)
-    print(f"AGENT RESPONSE: {agent_msg}")
+    agent_msg = agent_run.text
+    log_payload(logger, "Agent response", agent_msg)
     messages.append(
         ChatCompletionUserMessageParam(
             content=("Result from research agent => \n" + str(agent_msg)), role="user"
         )
     )
     return messages
+
+
+def do_research_agent(
+    query: str,
+    messages: list[ChatCompletionMessageParam],
+    client: OpenAI,
+    available_tools: ToolsDict,
+) -> list[ChatCompletionMessageParam]:
+    log_payload(logger, "Query", query)
+    agent_run = agent_flight.call(
+        normalize_query(query),
+        lambda: finish_agent_run(research_agent(query, client, available_tools)),
+    )
+    return append_agent_message(agent_run, messages)
+
+
+async def ado_research_agent(
+    query: str,
+    messages: list[ChatCompletionMessageParam],
+    client: AsyncOpenAI,
+    available_tools: ToolsDict,
+) -> list[ChatCompletionMessageParam]:
+    log_payload(logger, "Query", query)
+
+    async def run() -> AgentRun:
+        return finish_agent_run(await aresearch_agent(query, client, available_tools))
+
+    agent_run = await agent_flight.acall(normalize_query(query), run)
+    return append_agent_message(agent_run, messages)
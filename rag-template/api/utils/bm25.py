@@ -0,0 +1,429 @@
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+from langchain_core.documents.base import Document
+
+from .metrics import timed
+from .vector_index import (
+    Hits,
+    MappedMetadata,
+    NumpyVectorIndex,
+    copy_prefix,
+    map_file,
+    write_mapped_metadata,
+)
+
+# Standard BM25 parameters: term-frequency saturation and length normalization
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    # No stop words: "I" in "Charles I" or "of" in "Act of Union" matter here,
+    # and the IDF weight already makes common terms cheap
+    return _TOKEN.findall(unicodedata.normalize("NFKC", text).casefold())
+
+
+def bm25_scores(
+    query: str, texts: list[str], k1: float = BM25_K1, b: float = BM25_B
+) -> list[float]:
+    """BM25 scores of a few texts for a query, without a persistent index."""
+    documents = [Counter(tokenize(text)) for text in texts]
+    lengths = [sum(terms.values()) for terms in documents]
+    average_length = max(sum(lengths) / max(len(documents), 1), 1e-9)
+    scores = [0.0] * len(documents)
+    for term in set(tokenize(query)):
+        frequency = sum(1 for terms in documents if term in terms)
+        if frequency == 0:
+            continue
+        idf = math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+        for i, terms in enumerate(documents):
+            tf = terms.get(term, 0)
+            if tf:
+                norm = k1 * (1 - b + b * lengths[i] / average_length)
+                scores[i] += idf * tf * (k1 + 1) / (tf + norm)
+    return scores
+
+
+class DocumentFrequencies:
+    """The number of chunks containing each term, saved with a BM25 index.
+
+    `doc_freqs.json` is rewritten with each commit of the index, and is much
+    cheaper to load than the postings, for callers that only need to know
+    how rare the terms of a query are. Indexes written before it existed
+    have none, and load as empty until `python -m api.utils.bm25` is run.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._count = 0
+        self._frequencies: dict[str, int] = {}
+        try:
+            with open(os.path.join(path, "doc_freqs.json")) as f:
+                data: dict[str, Any] = json.load(f)  # pyright: ignore[reportExplicitAny]
+        except FileNotFoundError:
+            return
+        self._count = data["count"]
+        self._frequencies = data["frequencies"]
+
+    @staticmethod
+    def write(path: str, count: int, frequencies: dict[str, int]) -> None:
+        tmp_path = os.path.join(path, "doc_freqs.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"count": count, "frequencies": frequencies}, f)
+        os.replace(tmp_path, os.path.join(path, "doc_freqs.json"))
+
+    def count(self) -> int:
+        return self._count
+
+    def document_frequency(self, term: str) -> int:
+        return self._frequencies.get(term, 0)
+
+
+class MappedPostings:
+    """The postings and document lengths of a frozen index, memory-mapped.
+
+    `terms.sorted` holds the vocabulary in sorted order, so that terms are
+    found with a binary search, and `postings.offsets` where the postings of
+    each term start in `postings.rows` and `postings.tfs` (a CSR matrix of
+    term frequencies). `lengths.bin` holds the length of each chunk.
+    """
+
+    def __init__(
+        self, path: str, count: int, terms: int, term_width: int, postings: int
+    ):
+        self.lengths = map_file(path, "lengths.bin", np.float32, count)
+        self.terms = map_file(path, "terms.sorted", f"S{term_width}", terms)
+        self.offsets = (
+            map_file(path, "postings.offsets", np.int64, terms + 1)
+            if terms
+            else np.zeros(1, dtype=np.int64)
+        )
+        self.rows = map_file(path, "postings.rows", np.int32, postings)
+        self.tfs = map_file(path, "postings.tfs", np.float32, postings)
+
+    @staticmethod
+    def write(
+        path: str, lengths: list[int], postings: dict[str, tuple[list[int], list[int]]]
+    ) -> dict[str, int]:
+        """Writes the files of an index's postings, and returns their sizes."""
+        terms = sorted(postings)
+        term_width = max((len(term.encode()) for term in terms), default=1)
+        np.asarray([term.encode() for term in terms], dtype=f"S{term_width}").tofile(
+            os.path.join(path, "terms.sorted")
+        )
+        sizes = [len(postings[term][0]) for term in terms]
+        np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64).tofile(
+            os.path.join(path, "postings.offsets")
+        )
+        rows = [row for term in terms for row in postings[term][0]]
+        tfs = [tf for term in terms for tf in postings[term][1]]
+        np.asarray(rows, dtype=np.int32).tofile(os.path.join(path, "postings.rows"))
+        np.asarray(tfs, dtype=np.float32).tofile(os.path.join(path, "postings.tfs"))
+        np.asarray(lengths, dtype=np.float32).tofile(os.path.join(path, "lengths.bin"))
+        return {"terms": len(terms), "term_width": term_width, "postings": len(rows)}
+
+    def get(
+        self, term: str
+    ) -> tuple[npt.NDArray[np.int32], npt.NDArray[np.float32]] | None:
+        key = term.encode()
+        if not len(self.terms) or len(key) > self.terms.itemsize:
+            return None
+        position = int(np.searchsorted(self.terms, np.asarray(key, self.terms.dtype)))
+        if position == len(self.terms) or self.terms[position] != key:
+            return None
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        return self.rows[start:end], self.tfs[start:end]
+
+
+class BM25Index:
+    """Lexical inverted index over the stored chunks, scored with BM25.
+
+    The directory holds `chunks.jsonl`, with one line per chunk (ID, text,
+    metadata and term counts), and `index.json` with the number of committed
+    rows and bytes. As with `NumpyVectorIndex`, the data file is append-only
+    and the header is replaced atomically, so the postings are rebuilt from
+    committed rows only when the index is opened.
+
+    A frozen index (see `freeze`) is read-only and isn't loaded: its chunks
+    are read through `MappedMetadata` and its postings through
+    `MappedPostings`, so all the processes serving it share the same pages.
+    """
+
+    def __init__(
+        self, path: str, k1: float = BM25_K1, b: float = BM25_B, read_only: bool = False
+    ):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.read_only = read_only
+        self._lock = threading.Lock()
+
+        header_path = os.path.join(path, "index.json")
+        header: dict[str, Any] = {"count": 0, "bytes": 0}  # pyright: ignore[reportExplicitAny]
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                header = json.load(f)
+        elif read_only:
+            raise FileNotFoundError(f"No lexical index in {path}")
+        self._count: int = header["count"]
+        self._bytes: int = header["bytes"]
+        self.frozen: bool = header.get("frozen", False)
+        if self.frozen:
+            self.read_only = True
+
+        self.ids: list[str] = []
+        self.texts: list[str] = []
+        self.metadatas: list[dict[str, Any]] = []  # pyright: ignore[reportExplicitAny]
+        self.lengths: list[int] = []
+        self.postings: dict[str, tuple[list[int], list[int]]] = {}
+        self._rows: dict[str, int] = {}
+        self._total_length: float = 0
+        self._mapped: MappedMetadata | None = None
+        self._mapped_postings: MappedPostings | None = None
+        if self.frozen:
+            self._mapped = MappedMetadata(
+                path, self._count, header["id_width"], name="chunks"  # pyright: ignore[reportAny]
+            )
+            self._mapped_postings = MappedPostings(
+                path,
+                self._count,
+                header["terms"],  # pyright: ignore[reportAny]
+                header["term_width"],  # pyright: ignore[reportAny]
+                header["postings"],  # pyright: ignore[reportAny]
+            )
+            self._total_length = header["total_length"]
+        elif self._count > 0:
+            with open(self._file("chunks.jsonl"), "rb") as f:
+                for line in f.read(self._bytes).splitlines():
+                    row: dict[str, Any] = json.loads(line)  # pyright: ignore[reportExplicitAny]
+                    self._add_row(
+                        row["id"],  # pyright: ignore[reportAny]
+                        row["text"],  # pyright: ignore[reportAny]
+                        row["metadata"],  # pyright: ignore[reportAny]
+                        row["terms"],  # pyright: ignore[reportAny]
+                    )
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _add_row(
+        self,
+        id: str,
+        text: str,
+        metadata: dict[str, Any],  # pyright: ignore[reportExplicitAny]
+        terms: dict[str, int],
+    ) -> None:
+        row = len(self.ids)
+        self._rows[id] = row
+        self.ids.append(id)
+        self.texts.append(text)
+        self.metadatas.append(metadata)
+        length = sum(terms.values())
+        self.lengths.append(length)
+        self._total_length += length
+        for term, tf in terms.items():
+            rows, tfs = self.postings.setdefault(term, ([], []))
+            rows.append(row)
+            tfs.append(tf)
+
+    def count(self) -> int:
+        return self._count if self.frozen else len(self.ids)
+
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        if self._mapped is not None:
+            rows = self._mapped.find(ids)
+            return {id for id, row in zip(ids, rows) if row is not None}
+        return {id for id in ids if id in self._rows}
+
+    def _postings(self, term: str) -> tuple[Any, Any] | None:  # pyright: ignore[reportExplicitAny]
+        if self._mapped_postings is not None:
+            return self._mapped_postings.get(term)
+        return self.postings.get(term)
+
+    def document_frequency(self, term: str) -> int:
+        postings = self._postings(term)
+        return 0 if postings is None else len(postings[0])
+
+    def document(self, row: int) -> Document:
+        if self._mapped is not None:
+            data = self._mapped.row(row)
+            return Document(
+                id=data["id"], page_content=data["text"], metadata=data["metadata"]  # pyright: ignore[reportAny]
+            )
+        return Document(
+            id=self.ids[row], page_content=self.texts[row], metadata=self.metadatas[row]
+        )
+
+    def add(self, ids: list[str], chunks: list[Document]) -> None:
+        """Indexes and persists new chunks. Known IDs are skipped."""
+        if self.read_only:
+            raise PermissionError(f"Lexical index {self.path} is read-only")
+        with self._lock:
+            rows = [
+                {
+                    "id": id,
+                    "text": chunk.page_content,
+                    "metadata": chunk.metadata,
+                    "terms": dict(Counter(tokenize(chunk.page_content))),
+                }
+                for id, chunk in zip(ids, chunks)
+                if id not in self._rows
+            ]
+            if not rows:
+                return
+
+            lines = b"".join(json.dumps(row).encode() + b"\n" for row in rows)
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file("chunks.jsonl"), "ab") as f:
+                # Drop anything written after the last commit (e.g. a crash)
+                _ = f.truncate(self._bytes)
+                _ = f.write(lines)
+
+            for row in rows:
+                self._add_row(row["id"], row["text"], row["metadata"], row["terms"])  # pyright: ignore[reportArgumentType]
+            self._count = len(self.ids)
+            self._bytes += len(lines)
+            tmp_path = self._file("index.json.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"count": self._count, "bytes": self._bytes}, f)
+            os.replace(tmp_path, self._file("index.json"))
+            self.save_document_frequencies()
+
+    def save_document_frequencies(self) -> None:
+        """Writes the `DocumentFrequencies` table of the committed chunks."""
+        DocumentFrequencies.write(
+            self.path,
+            self.count(),
+            {term: len(rows) for term, (rows, _) in self.postings.items()},
+        )
+
+    def copy_to(self, path: str) -> "BM25Index":
+        """Copies the committed chunks to a new (writable) index directory."""
+        os.makedirs(path)
+        copy_prefix(
+            self._file("chunks.jsonl"), os.path.join(path, "chunks.jsonl"), self._bytes
+        )
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({"count": self._count, "bytes": self._bytes}, f)
+        return BM25Index(path, self.k1, self.b)
+
+    def freeze(self) -> None:
+        """Makes the index read-only, with memory-mappable chunks and postings.
+
+        Writes the files of `MappedMetadata` and `MappedPostings`; reopen the
+        index to serve it that way.
+        """
+        if self.frozen:
+            return
+        with self._lock:
+            id_width = write_mapped_metadata(self.path, "chunks", self._bytes, self.ids)
+            self.save_document_frequencies()
+            sizes = MappedPostings.write(self.path, self.lengths, self.postings)
+            tmp_path = self._file("index.json.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {
+                        "count": self._count,
+                        "bytes": self._bytes,
+                        "frozen": True,
+                        "id_width": id_width,
+                        "total_length": self._total_length,
+                        **sizes,
+                    },
+                    f,
+                )
+            os.replace(tmp_path, self._file("index.json"))
+            self.frozen = True
+            self.read_only = True
+
+    @timed("lexical_search")
+    def search(self, query: str, k: int) -> Hits:
+        count = self.count()
+        if count == 0:
+            return []
+        average_length = self._total_length / count
+        lengths = (
+            self._mapped_postings.lengths
+            if self._mapped_postings is not None
+            else np.asarray(self.lengths, dtype=np.float32)
+        )
+        scores = np.zeros(count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            postings = self._postings(term)
+            if postings is None:
+                continue
+            rows, tfs = postings
+            idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+            tf = np.asarray(tfs, dtype=np.float32)
+            norm = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+            scores[rows] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        matched = np.flatnonzero(scores)
+        top = matched[np.argsort(-scores[matched])[:k]]
+        return [(self.document(int(row)), float(scores[row])) for row in top]
+
+
+def numpy_chunks(
+    index: NumpyVectorIndex, batch_size: int = 1000
+) -> list[tuple[list[str], list[Document]]]:
+    batches: list[tuple[list[str], list[Document]]] = []
+    for start in range(0, index.count(), batch_size):
+        chunks = [
+            index.document(row)
+            for row in range(start, min(start + batch_size, index.count()))
+        ]
+        batches.append(([chunk.id or "" for chunk in chunks], chunks))
+    return batches
+
+
+def stored_chunks(
+    batch_size: int = 1000,
+) -> list[tuple[list[str], list[Document]]]:
+    """All the chunks of the vector store, in batches of IDs and documents."""
+    from .pdf import get_vector_backend, get_vector_store
+
+    vector_backend = get_vector_backend()
+    if isinstance(vector_backend, NumpyVectorIndex):
+        return numpy_chunks(vector_backend, batch_size)
+
+    batches: list[tuple[list[str], list[Document]]] = []
+    vector_store_pdf = get_vector_store()
+    total = vector_store_pdf._collection.count()  # pyright: ignore[reportPrivateUsage]
+    for offset in range(0, total, batch_size):
+        batch = vector_store_pdf.get(
+            limit=batch_size, offset=offset, include=["documents", "metadatas"]
+        )
+        batches.append(
+            (
+                batch["ids"],  # pyright: ignore[reportAny]
+                [
+                    Document(page_content=text, metadata=metadata)  # pyright: ignore[reportAny]
+                    for text, metadata in zip(batch["documents"], batch["metadatas"])  # pyright: ignore[reportAny]
+                ],
+            )
+        )
+    return batches
+
+
+if __name__ == "__main__":
+    # Builds the lexical index from the chunks that are already in the vector
+    # store (new ingestions keep it up to date)
+    from .pdf import BM25_INDEX_PATH, get_lexical_index
+
+    lexical_index = get_lexical_index()
+    for ids, chunks in stored_chunks():
+        lexical_index.add(ids, chunks)
+    # Also written by `add`, but indexes that predate it may have nothing to add
+    lexical_index.save_document_frequencies()
+    print(f"Indexed {lexical_index.count()} chunks in {BM25_INDEX_PATH}")
@@ -0,0 +1,62 @@
+"""PDF parsing and splitting helpers that are cheap to import.
+
+This module is imported by the worker processes of the corpus ingestion, so
+it must not pull in the vector store or the OpenAI clients. It is also
+imported by the chat path (for CHUNK_OVERLAP), so the splitter and the PDF
+reader are only imported when used.
+"""
+
+import hashlib
+from typing import TYPE_CHECKING
+
+from langchain_core.documents.base import Document
+
+if TYPE_CHECKING:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+
+def make_text_splitter() -> "RecursiveCharacterTextSplitter":
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+    )
+
+
+def file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def inspect_pdf(file_path: str) -> tuple[str, int]:
+    """Returns the content digest and the number of pages of a PDF file."""
+    from pypdf import PdfReader
+
+    return file_digest(file_path), len(PdfReader(file_path).pages)
+
+
+def extract_pages(file_path: str, pages: list[int]) -> list[tuple[int, list[Document]]]:
+    """Extracts and splits the given pages, with the metadata PyPDFLoader uses."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    text_splitter = make_text_splitter()
+    results: list[tuple[int, list[Document]]] = []
+    for page_number in pages:
+        page = Document(
+            page_content=reader.pages[page_number].extract_text().strip(),
+            metadata={
+                "source": file_path,
+                "total_pages": len(reader.pages),
+                "page": page_number,
+                "page_label": reader.page_labels[page_number],
+            },
+        )
+        results.append((page_number, text_splitter.split_documents([page])))
+    return results
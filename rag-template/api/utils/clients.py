@@ -0,0 +1,217 @@
+import asyncio
+import os
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+from requests.adapters import HTTPAdapter
+
+from .lazy import lazy
+
+if TYPE_CHECKING:
+    from duckduckgo_search import DDGS
+    from exa_py import Exa
+
+_ = load_dotenv(".env.local")
+_ = load_dotenv("../.env")
+
+# Timeouts of the tool requests (web search, weather), in seconds
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+
+# Keep-alive connections per host, and concurrent requests per host
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "8"))
+
+# OpenAI calls stream long generations, so only the connect timeout is short
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "600"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "32"))
+
+DUCKDUCKGO_HOST = "duckduckgo.com"
+EXA_HOST = "api.exa.ai"
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.wait_seconds = 0.0
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+
+class HostLimiter:
+    """Bounds the number of concurrent requests to each host.
+
+    Threads and coroutines have separate semaphores (a blocking semaphore
+    would stall the event loop), but share the statistics.
+    """
+
+    def __init__(self, max_per_host: int = HTTP_MAX_PER_HOST):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._asemaphores: dict[str, asyncio.Semaphore] = {}
+        self.hosts: dict[str, HostStats] = {}
+
+    def _start(self, host: str, waited: float) -> None:
+        with self._lock:
+            stats = self.hosts.setdefault(host, HostStats())
+            stats.requests += 1
+            stats.in_flight += 1
+            stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+            stats.wait_seconds += waited
+
+    def _end(self, host: str) -> None:
+        with self._lock:
+            self.hosts[host].in_flight -= 1
+
+    @contextmanager
+    def limit(self, host: str) -> Iterator[None]:
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.max_per_host)
+            )
+        started_at = time.monotonic()
+        with semaphore:
+            self._start(host, time.monotonic() - started_at)
+            try:
+                yield
+            finally:
+                self._end(host)
+
+    @asynccontextmanager
+    async def alimit(self, host: str) -> AsyncIterator[None]:
+        semaphore = self._asemaphores.setdefault(
+            host, asyncio.Semaphore(self.max_per_host)
+        )
+        started_at = time.monotonic()
+        async with semaphore:
+            self._start(host, time.monotonic() - started_at)
+            try:
+                yield
+            finally:
+                self._end(host)
+
+    def stats(self) -> dict[str, dict[str, int | float]]:
+        with self._lock:
+            return {host: stats.as_dict() for host, stats in self.hosts.items()}
+
+
+host_limiter = HostLimiter()
+
+# Tool requests: a requests session for threads, an httpx client for the loop
+http_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+http_session.mount("http://", _adapter)
+http_session.mount("https://", _adapter)
+
+_limits = httpx.Limits(
+    max_connections=HTTP_POOL_SIZE * 4, max_keepalive_connections=HTTP_POOL_SIZE
+)
+async_http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    limits=_limits,
+)
+
+# OpenAI: one connection pool for chat completions and embeddings
+_openai_timeout = httpx.Timeout(OPENAI_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+_openai_limits = httpx.Limits(
+    max_connections=OPENAI_POOL_SIZE * 4, max_keepalive_connections=OPENAI_POOL_SIZE
+)
+openai_http_client = httpx.Client(timeout=_openai_timeout, limits=_openai_limits)
+openai_async_http_client = httpx.AsyncClient(
+    timeout=_openai_timeout, limits=_openai_limits
+)
+openai_client = OpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"), http_client=openai_http_client
+)
+async_openai_client = AsyncOpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"), http_client=openai_async_http_client
+)
+
+# The Exa client is stateless, and DDGS keeps cookies (so one per thread).
+# Their SDKs are only imported when a search runs.
+_ddgs = threading.local()
+
+
+@lazy
+def get_exa_client() -> "Exa":
+    from exa_py import Exa
+
+    return Exa(api_key=os.getenv("EXA_API_KEY"))
+
+
+def get_ddgs() -> "DDGS":
+    from duckduckgo_search import DDGS
+
+    ddgs: DDGS | None = getattr(_ddgs, "client", None)
+    if ddgs is None:
+        ddgs = _ddgs.client = DDGS(timeout=int(HTTP_READ_TIMEOUT))
+    return ddgs
+
+
+def http_get(url: str, **kwargs: Any) -> requests.Response:  # pyright: ignore[reportExplicitAny, reportAny]
+    with host_limiter.limit(urlsplit(url).netloc):
+        return http_session.get(
+            url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **kwargs  # pyright: ignore[reportAny]
+        )
+
+
+async def ahttp_get(url: str, **kwargs: Any) -> httpx.Response:  # pyright: ignore[reportExplicitAny, reportAny]
+    async with host_limiter.alimit(urlsplit(url).netloc):
+        return await async_http_client.get(url, **kwargs)  # pyright: ignore[reportAny]
+
+
+def httpx_pool_stats(http_client: httpx.Client | httpx.AsyncClient) -> dict[str, int]:
+    connections: list[Any] = http_client._transport._pool.connections  # pyright: ignore[reportAttributeAccessIssue, reportUnknownMemberType, reportExplicitAny, reportPrivateUsage]
+    return {
+        "connections": len(connections),
+        "idle": sum(1 for connection in connections if connection.is_idle()),  # pyright: ignore[reportAny]
+        "max_keepalive": int(http_client._transport._pool._max_keepalive_connections),  # pyright: ignore[reportAttributeAccessIssue, reportUnknownMemberType, reportUnknownArgumentType, reportPrivateUsage]
+    }
+
+
+def requests_pool_stats() -> dict[str, dict[str, int]]:
+    pools = _adapter.poolmanager.pools  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+    stats: dict[str, dict[str, int]] = {}
+    for key in pools.keys():  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+        pool = pools[key]  # pyright: ignore[reportUnknownVariableType]
+        if pool is None:
+            continue
+        stats[pool.host] = {  # pyright: ignore[reportUnknownMemberType]
+            "connections_opened": pool.num_connections,  # pyright: ignore[reportUnknownMemberType]
+            "requests": pool.num_requests,  # pyright: ignore[reportUnknownMemberType]
+            # The queue is padded with None up to its size: count the real ones
+            "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None)  # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType, reportUnknownVariableType]
+            if pool.pool
+            else 0,
+            "max_size": HTTP_POOL_SIZE,
+        }
+    return stats
+
+
+def pool_stats() -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+    """Connection pool usage, to size HTTP_POOL_SIZE and HTTP_MAX_PER_HOST."""
+    return {
+        "max_per_host": host_limiter.max_per_host,
+        "hosts": host_limiter.stats(),
+        "requests_pools": requests_pool_stats(),
+        "httpx_pool": httpx_pool_stats(async_http_client),
+        "openai_pool": httpx_pool_stats(openai_http_client),
+        "openai_async_pool": httpx_pool_stats(openai_async_http_client),
+    }
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+from collections.abc import Awaitable, Callable
+from concurrent.futures import Future
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Shares one execution between concurrent calls with the same key.
+
+    The first caller for a key runs the function, and the callers arriving
+    while it runs wait for its result (or its exception) instead of running
+    it again. Nothing is kept once the call is over: `ToolCache` adds a TTL
+    cache on top of this.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, Future[T]] = {}
+        self._ain_flight: dict[str, asyncio.Task[T]] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def call(self, key: str, fn: Callable[[], T]) -> T:
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if future is None:
+                future = self._in_flight[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            value = fn()
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def acall(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._ain_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = self._ain_flight[key] = asyncio.create_task(self._arun(key, fn))
+        else:
+            self.coalesced += 1
+        # Shielded, so a cancelled caller doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def _arun(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        try:
+            return await fn()
+        finally:
+            del self._ain_flight[key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight) + len(self._ain_flight),
+        }
@@ -0,0 +1,166 @@
+import logging
+import os
+from functools import lru_cache
+from typing import NamedTuple
+
+import tiktoken
+from langchain_core.documents.base import Document
+from pydantic import BaseModel
+
+from .chunking import CHUNK_OVERLAP
+from .log import get_logger
+
+# Prompt tokens that retrieved passages may use, in a single message
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "6000"))
+CONTEXT_ENCODING_MODEL = "gpt-4o"
+
+# Shortest suffix/prefix match considered as splitter overlap (in characters)
+MIN_OVERLAP = 20
+
+logger = get_logger(__name__)
+
+
+@lru_cache(maxsize=1)
+def get_encoding() -> tiktoken.Encoding | None:
+    try:
+        return tiktoken.encoding_for_model(CONTEXT_ENCODING_MODEL)
+    except Exception as e:
+        # The encoding is downloaded on first use; without it, we estimate
+        logger.warning("Could not load the tokenizer, estimating token counts: %s", e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_raw_tokens(payload: object) -> int | None:
+    """Tokens of a payload as it would be sent unpacked, for the packing stats.
+
+    Tokenizing the whole payload is only worth it when the stats are logged,
+    so this is None (not counted) when INFO logs are off.
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return None
+    return count_tokens(str(payload))
+
+
+class Passage(NamedTuple):
+    source: str
+    page: int
+    page_label: str
+    text: str
+
+
+class PackingStats(BaseModel):
+    chunks: int = 0
+    passages: int = 0
+    merged: int = 0
+    duplicates: int = 0
+    dropped: int = 0
+    # None when the unpacked payload wasn't tokenized (see `count_raw_tokens`)
+    raw_tokens: int | None = None
+    packed_tokens: int = 0
+
+    @property
+    def saved_tokens(self) -> int | None:
+        if self.raw_tokens is None:
+            return None
+        return self.raw_tokens - self.packed_tokens
+
+    def report(self) -> str:
+        report = (
+            f"{self.chunks} chunks -> {self.passages} passages "
+            + f"({self.merged} merged, {self.duplicates} duplicates, "
+            + f"{self.dropped} over budget): {self.packed_tokens} tokens"
+        )
+        if self.raw_tokens is None:
+            return report
+        return report + f" instead of {self.raw_tokens} ({self.saved_tokens} saved)"
+
+
+class PackedContext(NamedTuple):
+    text: str
+    stats: PackingStats
+
+
+def merge_overlap(first: str, second: str) -> str | None:
+    """Joins two chunks if the end of the first is the start of the second."""
+    if second in first:
+        return first
+    # Collapsing whitespace only shortens the overlap
+    longest = min(len(first), len(second), CHUNK_OVERLAP)
+    for size in range(longest, MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return None
+
+
+def to_passage(doc: Document) -> Passage:
+    metadata = doc.metadata
+    page = int(metadata.get("page", 0))  # pyright: ignore[reportAny]
+    return Passage(
+        source=os.path.basename(str(metadata.get("source", ""))),  # pyright: ignore[reportAny]
+        page=page,
+        page_label=str(metadata.get("page_label", page + 1)),  # pyright: ignore[reportAny]
+        # PDF text is full of tabs and runs of spaces, which cost tokens
+        text=" ".join(doc.page_content.split()),
+    )
+
+
+def pack_documents(docs: list[Document], budget: int = RAG_CONTEXT_TOKENS) -> PackedContext:
+    """Formats retrieved chunks into a compact, page-tagged context.
+
+    Chunks are taken in relevance order. Duplicates are dropped, and chunks
+    of the same page that overlap (the splitter repeats up to
+    `chunk_overlap` characters) are merged into one passage, ranked where
+    its most relevant chunk was. Passages are then added until the token
+    budget is spent.
+    """
+    stats = PackingStats(chunks=len(docs), raw_tokens=count_raw_tokens(docs))
+    passages: list[Passage] = []
+    seen: set[str] = set()
+    for doc in docs:
+        passage = to_passage(doc)
+        if passage.text in seen:
+            stats.duplicates += 1
+            continue
+        seen.add(passage.text)
+
+        for i, other in enumerate(passages):
+            if (other.source, other.page) != (passage.source, passage.page):
+                continue
+            merged = merge_overlap(other.text, passage.text) or merge_overlap(
+                passage.text, other.text
+            )
+            if merged is not None:
+                passages[i] = other._replace(text=merged)
+                stats.merged += 1
+                break
+        else:
+            passages.append(passage)
+
+    sources = {passage.source for passage in passages}
+    blocks: list[str] = []
+    used = 0
+    for passage in passages:
+        tag = f"p. {passage.page_label}"
+        if len(sources) > 1:
+            tag = f"{passage.source}, {tag}"
+        block = f"[{tag}] {passage.text}"
+        tokens = count_tokens(block) + 1
+        if used + tokens > budget:
+            # A later (shorter) passage may still fit
+            stats.dropped += 1
+            continue
+        blocks.append(block)
+        used += tokens
+
+    text = "\n".join(blocks)
+    stats.passages = len(blocks)
+    stats.packed_tokens = count_tokens(text)
+    return PackedContext(text, stats)
+
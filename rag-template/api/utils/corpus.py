@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import os
+import time
+from collections.abc import AsyncIterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+from langchain_core.documents.base import Document
+
+from .chunking import extract_pages, inspect_pdf
+from .ingest import (
+    CHECKPOINT_PATH,
+    INGEST_BATCH_SIZE,
+    INGEST_CONCURRENCY,
+    IngestCheckpoint,
+    IngestUnit,
+    ingest_units,
+    unit_key,
+)
+
+# Pages extracted and split by one worker task
+PAGES_PER_TASK = int(os.getenv("CORPUS_PAGES_PER_TASK", "16"))
+CORPUS_WORKERS = int(os.getenv("CORPUS_WORKERS", str(os.cpu_count() or 1)))
+
+
+class ParseStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.files = 0
+        self.pages = 0
+        self.chunks = 0
+
+    def report(self) -> str:
+        seconds = max(time.monotonic() - self.started_at, 1e-9)
+        return (
+            f"{self.files} files, {self.pages} pages, {self.chunks} chunks parsed "
+            + f"in {seconds:.1f}s: {self.pages / seconds:.1f} pages/s, "
+            + f"{self.chunks / seconds:.1f} chunks/s"
+        )
+
+
+def find_pdfs(paths: list[str]) -> list[str]:
+    files: list[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(
+                    os.path.join(root, name)
+                    for name in sorted(names)
+                    if name.lower().endswith(".pdf")
+                )
+        else:
+            files.append(path)
+    return files
+
+
+def page_tasks(pages: list[int], pages_per_task: int) -> list[list[int]]:
+    return [pages[i : i + pages_per_task] for i in range(0, len(pages), pages_per_task)]
+
+
+async def iter_corpus_units(
+    file_paths: list[str],
+    checkpoint: IngestCheckpoint,
+    executor: Executor,
+    workers: int,
+    pages_per_task: int = PAGES_PER_TASK,
+    stats: ParseStats | None = None,
+) -> AsyncIterator[IngestUnit]:
+    """Extracts and splits pages across a process pool, as they complete.
+
+    Files are split into tasks of `pages_per_task` pages, skipping the pages
+    recorded in the checkpoint. At most two tasks per worker are in flight,
+    so parsing never runs far ahead of the embedding stage.
+    """
+    stats = stats or ParseStats()
+    loop = asyncio.get_running_loop()
+    infos = await asyncio.gather(
+        *(loop.run_in_executor(executor, inspect_pdf, path) for path in file_paths)
+    )
+
+    tasks: list[tuple[str, str, list[int]]] = []
+    for path, (digest, page_count) in zip(file_paths, infos):
+        pending = [p for p in range(page_count) if unit_key(digest, p) not in checkpoint]
+        tasks.extend((path, digest, pages) for pages in page_tasks(pending, pages_per_task))
+    stats.files = len(file_paths)
+    print(f"{len(tasks)} parsing tasks for {len(file_paths)} files")
+
+    next_task = iter(tasks)
+    in_flight: dict[asyncio.Future[list[tuple[int, list[Document]]]], str] = {}
+
+    def submit_next() -> None:
+        task = next(next_task, None)
+        if task is not None:
+            path, digest, pages = task
+            future: Future[list[tuple[int, list[Document]]]] = executor.submit(
+                extract_pages, path, pages
+            )
+            in_flight[asyncio.wrap_future(future)] = digest
+
+    for _ in range(2 * workers):
+        submit_next()
+
+    try:
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                digest = in_flight.pop(future)
+                submit_next()
+                for page, chunks in future.result():
+                    stats.pages += 1
+                    stats.chunks += len(chunks)
+                    yield IngestUnit(unit_key(digest, page), 1, chunks)
+            print(f"Parsed {stats.report()}")
+    finally:
+        for future in in_flight:
+            _ = future.cancel()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Ingests a corpus of PDF files (or directories of PDF "
+        + "files), parsing and splitting pages in a process pool."
+    )
+    _ = parser.add_argument("paths", nargs="+")
+    _ = parser.add_argument("--workers", type=int, default=CORPUS_WORKERS)
+    _ = parser.add_argument("--pages-per-task", type=int, default=PAGES_PER_TASK)
+    _ = parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    _ = parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY)
+    _ = parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    args = parser.parse_args()
+
+    file_paths = find_pdfs(args.paths)  # pyright: ignore[reportAny]
+    checkpoint = IngestCheckpoint(args.checkpoint)  # pyright: ignore[reportAny]
+    parse_stats = ParseStats()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:  # pyright: ignore[reportAny]
+        stats = await ingest_units(
+            iter_corpus_units(
+                file_paths,
+                checkpoint,
+                executor,
+                workers=args.workers,  # pyright: ignore[reportAny]
+                pages_per_task=args.pages_per_task,  # pyright: ignore[reportAny]
+                stats=parse_stats,
+            ),
+            checkpoint,
+            batch_size=args.batch_size,  # pyright: ignore[reportAny]
+            concurrency=args.concurrency,  # pyright: ignore[reportAny]
+        )
+    print(f"Parsing: {parse_stats.report()}")
+    print(f"Done: {stats.report()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
+
+from langchain_core.embeddings import Embeddings
+
+from .metrics import SIZE_BUCKETS, registry
+
+# Query embeddings requested within EMBEDDING_BATCH_WINDOW_MS of the first
+# one are sent together, up to EMBEDDING_BATCH_SIZE texts per call; at most
+# EMBEDDING_BATCH_CONCURRENCY calls are in flight
+EMBEDDING_BATCHING = os.getenv("EMBEDDING_BATCHING", "1") == "1"
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_CONCURRENCY = int(os.getenv("EMBEDDING_BATCH_CONCURRENCY", "4"))
+
+# Seconds a synchronous caller waits for its embedding before giving up
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "30"))
+
+
+class _Request(NamedTuple):
+    text: str
+    future: Future[list[float]]
+    queued_at: float
+
+
+class EmbeddingBatcher:
+    """Gathers concurrent query embeddings into batched embedding calls.
+
+    Callers (threads, or coroutines through `aembed`) enqueue their text and
+    wait on a future. A collector thread takes the first queued text, waits
+    up to the window for more (or until the batch is full), and hands the
+    batch to a small pool that calls `embed_documents` once, so the next
+    batch is collected while this one is in flight. Identical texts in a
+    batch are embedded once, and requests cancelled while queued (a
+    cancelled `aembed`, or a timed out `embed`) are dropped from the batch.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        window: float = EMBEDDING_BATCH_WINDOW_MS / 1000,
+        max_batch_size: int = EMBEDDING_BATCH_SIZE,
+        concurrency: int = EMBEDDING_BATCH_CONCURRENCY,
+    ):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.batch_sizes = registry.histogram(
+            "embedding_batch_size", "Distinct texts per embeddings call", SIZE_BUCKETS
+        )
+        self.wait_seconds = registry.histogram(
+            "embedding_batch_wait_seconds", "Time queries wait for their batch"
+        )
+        self.call_seconds = registry.histogram(
+            "embedding_batch_call_seconds", "Duration of batched embeddings calls"
+        )
+        self.errors = 0
+        self._queue: queue.SimpleQueue[_Request] = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="embedding-batch"
+        )
+        self._collector: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._collector is not None:
+            return
+        with self._start_lock:
+            if self._collector is None:
+                self._collector = threading.Thread(
+                    target=self._collect, name="embedding-batcher", daemon=True
+                )
+                self._collector.start()
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            _ = self._executor.submit(self._run, batch)
+
+    def _run(self, batch: list[_Request]) -> None:
+        batch = [
+            request for request in batch if request.future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            return
+        started_at = time.monotonic()
+        for request in batch:
+            self.wait_seconds.observe(started_at - request.queued_at)
+        texts = list(dict.fromkeys(request.text for request in batch))
+        self.batch_sizes.observe(len(texts))
+        try:
+            vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+        except Exception as e:
+            self.errors += 1
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        finally:
+            self.call_seconds.observe(time.monotonic() - started_at)
+        for request in batch:
+            request.future.set_result(vectors[request.text])
+
+    def submit(self, text: str) -> Future[list[float]]:
+        self._ensure_started()
+        future: Future[list[float]] = Future()
+        self._queue.put(_Request(text, future, time.monotonic()))
+        return future
+
+    def embed(self, text: str, timeout: float = EMBEDDING_TIMEOUT) -> list[float]:
+        return self.embed_many([text], timeout)[0]
+
+    def embed_many(
+        self, texts: list[str], timeout: float = EMBEDDING_TIMEOUT
+    ) -> list[list[float]]:
+        """Embeds several texts, waiting at most `timeout` for all of them.
+
+        They are all queued before waiting, so they can share batches. On
+        timeout, the requests not yet sent are cancelled.
+        """
+        futures = [self.submit(text) for text in texts]
+        deadline = time.monotonic() + timeout
+        try:
+            return [
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+                for future in futures
+            ]
+        except TimeoutError:
+            for future in futures:
+                _ = future.cancel()
+            raise
+
+    async def aembed(self, text: str, timeout: float = EMBEDDING_TIMEOUT) -> list[float]:
+        # On timeout, `wait_for` cancels the request (if it wasn't sent yet)
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(text)), timeout)
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_batch_size,
+            "errors": self.errors,
+            "batch_size": self.batch_sizes.as_dict(),
+            "wait_seconds": self.wait_seconds.as_dict(),
+            "call_seconds": self.call_seconds.as_dict(),
+        }
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from langchain_core.embeddings import Embeddings
+
+from .embedding_batcher import EmbeddingBatcher
+from .metrics import timed
+
+if TYPE_CHECKING:
+    from langchain_openai import OpenAIEmbeddings
+
+# Number of query embeddings kept in memory (~12 KB each for 3072 dimensions)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+
+# Optional SQLite file that keeps query embeddings across restarts
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+EMBEDDING_CACHE_DISK_SIZE = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "100000"))
+
+
+def normalize_query(text: str) -> str:
+    """Normalizes a query so that trivial variations share a cache entry."""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split()).casefold()
+
+
+class EmbeddingDiskCache:
+    """On-disk tier of the query-embedding cache, stored in SQLite."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        _ = self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings "
+            + "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> list[float] | None:
+        with self._lock:
+            row: tuple[bytes] | None = self._conn.execute(
+                "SELECT vector FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return array("f", row[0]).tolist()
+
+    def set(self, key: str, vector: list[float]) -> None:
+        with self._lock:
+            _ = self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                (key, array("f", vector).tobytes(), time.time()),
+            )
+            self._writes += 1
+            # Pruning is cheap but not free, so we only do it every 100 writes
+            if self._writes % 100 == 0:
+                _ = self._conn.execute(
+                    "DELETE FROM query_embeddings WHERE key NOT IN "
+                    + "(SELECT key FROM query_embeddings ORDER BY created_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedding model with a two-tier cache for query embeddings.
+
+    Queries are looked up in an in-memory LRU first, then in the optional
+    on-disk tier. Misses go through the batcher, when there is one, so that
+    concurrent queries share embedding calls. Document embeddings (used for
+    ingestion) are neither cached nor batched.
+    """
+
+    def __init__(
+        self,
+        embeddings: "OpenAIEmbeddings",
+        max_entries: int = EMBEDDING_CACHE_SIZE,
+        disk_path: str | None = EMBEDDING_CACHE_PATH,
+        max_disk_entries: int = EMBEDDING_CACHE_DISK_SIZE,
+        batcher: EmbeddingBatcher | None = None,
+    ):
+        self.embeddings = embeddings
+        self.batcher = batcher
+        self.model = embeddings.model
+        self.max_entries = max_entries
+        self.disk = EmbeddingDiskCache(disk_path, max_disk_entries) if disk_path else None
+        self._memory: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def cache_key(self, text: str) -> str:
+        return hashlib.sha256(
+            f"{self.model}\0{normalize_query(text)}".encode()
+        ).hexdigest()
+
+    def _get_memory(self, key: str) -> list[float] | None:
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            return vector
+
+    def _set_memory(self, key: str, vector: list[float]) -> None:
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                _ = self._memory.popitem(last=False)
+
+    def _get_disk(self, key: str) -> list[float] | None:
+        if self.disk is None:
+            return None
+        vector = self.disk.get(key)
+        if vector is not None:
+            self.disk_hits += 1
+            self._set_memory(key, vector)
+        return vector
+
+    def _store(self, key: str, vector: list[float]) -> None:
+        self.misses += 1
+        self._set_memory(key, vector)
+        if self.disk is not None:
+            self.disk.set(key, vector)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_queries([text])[0]
+
+    @timed("embedding")
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Embeds several queries, with all the misses sent at once."""
+        keys = [self.cache_key(text) for text in texts]
+        vectors = [self._get_memory(key) or self._get_disk(key) for key in keys]
+        if self.batcher is not None:
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            embedded = self.batcher.embed_many([texts[i] for i in missing])
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+                self._store(keys[i], vector)
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                vectors[i] = self.embeddings.embed_query(texts[i])
+                self._store(keys[i], vectors[i])
+        return [vector for vector in vectors if vector is not None]
+
+    @timed("embedding")
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self.cache_key(text)
+        vector = self._get_memory(key)
+        if vector is None and self.disk is not None:
+            vector = await asyncio.to_thread(self._get_disk, key)
+        if vector is None:
+            vector = await (
+                self.batcher.aembed(text)
+                if self.batcher is not None
+                else self.embeddings.aembed_query(text)
+            )
+            if self.disk is not None:
+                await asyncio.to_thread(self._store, key, vector)
+            else:
+                self._store(key, vector)
+        return vector
+
+    def stats(self) -> dict[str, int | float | str]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "model": self.model,
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,198 @@
+import asyncio
+import inspect
+import json
+import os
+import time
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from typing import Any, Callable, TypedDict
+
+from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
+
+from .log import get_logger
+from .metrics import stage
+from .passages import pack_tool_result
+
+ToolsDict = dict[str, tuple[ChatCompletionToolParam, Callable[..., Any]]]  # pyright: ignore[reportExplicitAny]
+
+# Maximum number of tools running at the same time (shared by all requests)
+MAX_TOOL_WORKERS = int(os.getenv("MAX_TOOL_WORKERS", "8"))
+
+# Seconds a tool call may take (queueing included) before we give up on it
+DEFAULT_TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "20"))
+TOOL_TIMEOUTS: dict[str, float] = {
+    "get_current_weather": 10.0,
+    "similarity_search_pdf": 15.0,
+}
+
+tool_executor = ThreadPoolExecutor(
+    max_workers=MAX_TOOL_WORKERS, thread_name_prefix="tool"
+)
+_tool_semaphore: asyncio.Semaphore | None = None
+
+logger = get_logger(__name__)
+
+
+class DraftToolCall(TypedDict):
+    id: str
+    name: str
+    arguments: str
+
+
+def tool_timeout(name: str) -> float:
+    return TOOL_TIMEOUTS.get(name, DEFAULT_TOOL_TIMEOUT)
+
+
+def serialize_tool_result(tool_result: Any, arguments: dict[str, Any]) -> str:  # pyright: ignore[reportExplicitAny, reportAny]
+    try:
+        return json.dumps(pack_tool_result(tool_result, arguments))
+    except Exception as e:
+        return str(e)
+
+
+def error_result(message: str) -> str:
+    logger.warning(message)
+    return json.dumps(message)
+
+
+def call_tool(tools: ToolsDict, tool_call: DraftToolCall) -> str:
+    arguments: dict[str, Any] = json.loads(tool_call["arguments"])  # pyright: ignore[reportExplicitAny]
+    with stage(f"tool:{tool_call['name']}"):
+        tool_result = tools[tool_call["name"]][1](**arguments)  # pyright: ignore[reportAny]
+    return serialize_tool_result(tool_result, arguments)
+
+
+async def acall_tool(tools: ToolsDict, tool_call: DraftToolCall) -> str:
+    """Runs a tool without blocking the event loop.
+
+    Coroutine functions are awaited directly, while plain functions are
+    offloaded to a worker thread.
+    """
+    fn = tools[tool_call["name"]][1]
+    arguments = json.loads(tool_call["arguments"])  # pyright: ignore[reportAny]
+    with stage(f"tool:{tool_call['name']}"):
+        if inspect.iscoroutinefunction(fn):
+            tool_result = await fn(**arguments)  # pyright: ignore[reportAny]
+        else:
+            tool_result = await asyncio.to_thread(fn, **arguments)  # pyright: ignore[reportAny]
+    return serialize_tool_result(tool_result, arguments)
+
+
+def arguments_complete(arguments: str) -> bool:
+    """Whether streamed tool-call arguments already form a complete JSON object."""
+    if not arguments.rstrip().endswith("}"):
+        return False
+    try:
+        _ = json.loads(arguments)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+def start_tool_call(
+    tools: ToolsDict, tool_call: DraftToolCall
+) -> tuple[Future[str], float]:
+    """Submits a tool call and returns its future along with its deadline."""
+    deadline = time.monotonic() + tool_timeout(tool_call["name"])
+    # The context is copied so that the tool's stages join the request's trace
+    future = tool_executor.submit(copy_context().run, call_tool, tools, tool_call)
+    return future, deadline
+
+
+def tool_call_result(
+    tool_call: DraftToolCall, future: Future[str], deadline: float
+) -> str:
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except TimeoutError:
+        _ = future.cancel()
+        return error_result(
+            f"Tool {tool_call['name']} timed out after {tool_timeout(tool_call['name'])}s"
+        )
+    except Exception as e:
+        return error_result(f"Error calling tool {tool_call['name']}: {e}")
+
+
+def run_tool_calls(
+    tools: ToolsDict, tool_calls: list[DraftToolCall]
+) -> Iterator[tuple[DraftToolCall, str]]:
+    """Runs the tool calls of one turn concurrently on the shared executor.
+
+    Results are yielded in completion order. A tool that exceeds its timeout
+    is reported as an error; its thread is left to finish in the background.
+    """
+    futures: dict[Future[str], DraftToolCall] = {
+        tool_executor.submit(copy_context().run, call_tool, tools, tool_call): tool_call
+        for tool_call in tool_calls
+    }
+    start = time.monotonic()
+    deadlines = {
+        future: start + tool_timeout(tool_call["name"])
+        for future, tool_call in futures.items()
+    }
+    pending = set(futures)
+
+    while pending:
+        timeout = max(0.0, min(deadlines[f] for f in pending) - time.monotonic())
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            tool_call = futures[future]
+            try:
+                yield tool_call, future.result()
+            except Exception as e:
+                yield tool_call, error_result(
+                    f"Error calling tool {tool_call['name']}: {e}"
+                )
+
+        now = time.monotonic()
+        expired = {future for future in pending if deadlines[future] <= now}
+        for future in expired:
+            tool_call = futures[future]
+            _ = future.cancel()
+            yield tool_call, error_result(
+                f"Tool {tool_call['name']} timed out after {tool_timeout(tool_call['name'])}s"
+            )
+        pending -= expired
+
+
+def get_tool_semaphore() -> asyncio.Semaphore:
+    global _tool_semaphore
+    if _tool_semaphore is None:
+        _tool_semaphore = asyncio.Semaphore(MAX_TOOL_WORKERS)
+    return _tool_semaphore
+
+
+async def arun_tool_call(
+    tools: ToolsDict, tool_call: DraftToolCall
+) -> tuple[DraftToolCall, str]:
+    async def bounded_call() -> str:
+        async with get_tool_semaphore():
+            return await acall_tool(tools, tool_call)
+
+    timeout = tool_timeout(tool_call["name"])
+    try:
+        return tool_call, await asyncio.wait_for(bounded_call(), timeout)
+    except TimeoutError:
+        return tool_call, error_result(
+            f"Tool {tool_call['name']} timed out after {timeout}s"
+        )
+    except Exception as e:
+        return tool_call, error_result(f"Error calling tool {tool_call['name']}: {e}")
+
+
+async def arun_tool_calls(
+    tools: ToolsDict, tool_calls: list[DraftToolCall]
+) -> AsyncIterator[tuple[DraftToolCall, str]]:
+    """Async version of `run_tool_calls`, bounded by a shared semaphore."""
+    tasks = [
+        asyncio.create_task(arun_tool_call(tools, tool_call))
+        for tool_call in tool_calls
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            _ = task.cancel()
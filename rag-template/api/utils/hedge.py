@@ -0,0 +1,258 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, NamedTuple
+
+import httpx
+import numpy as np
+import requests
+
+from .log import get_logger
+
+# Delay before the secondary provider is fired, when the primary's latency is
+# unknown, and the bounds of the adaptive delay (seconds)
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "1.5"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "4"))
+
+# Above this recent error rate, both providers are fired at once
+HEDGE_ERROR_RATE = float(os.getenv("HEDGE_ERROR_RATE", "0.5"))
+
+# Recent calls used for the latency percentile and the error rate
+STATS_WINDOW = 100
+
+logger = get_logger(__name__)
+
+SearchResults = list[Any]  # pyright: ignore[reportExplicitAny]
+
+
+class SearchError(Exception):
+    """A search provider failed (rate limited, unavailable, or no results)."""
+
+
+# What counts as a provider failure, and fires the other provider; anything
+# else is a bug, and is raised as is
+SEARCH_ERRORS: tuple[type[Exception], ...] = (
+    SearchError,
+    TimeoutError,
+    requests.RequestException,
+    httpx.HTTPError,
+)
+
+
+def no_cache(_: str) -> SearchResults | None:
+    return None
+
+
+class ProviderStats:
+    def __init__(self, window: int = STATS_WINDOW):
+        self._lock = threading.Lock()
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.wins = 0
+        self.cancelled = 0
+
+    def record(self, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.calls += 1
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(seconds)
+            else:
+                self.errors += 1
+
+    def p95(self) -> float | None:
+        with self._lock:
+            if not self.latencies:
+                return None
+            return float(np.percentile(np.asarray(self.latencies), 95))
+
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self.outcomes:
+                return 0.0
+            return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def as_dict(self) -> dict[str, int | float | None]:
+        p95 = self.p95()
+        with self._lock:
+            p50 = (
+                float(np.percentile(np.asarray(self.latencies), 50))
+                if self.latencies
+                else None
+            )
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "wins": self.wins,
+            "cancelled": self.cancelled,
+            "error_rate": round(self.error_rate(), 3),
+            "p50_seconds": p50,
+            "p95_seconds": p95,
+        }
+
+
+class SearchProvider(NamedTuple):
+    name: str
+    search: Callable[[str], SearchResults]
+    asearch: Callable[[str], Awaitable[SearchResults]]
+    timeout: float
+    # Results already in the provider's cache, without calling it
+    cached: Callable[[str], SearchResults | None] = no_cache
+
+
+class HedgedSearch:
+    """Runs a primary search provider, hedged with a secondary one.
+
+    The secondary provider is fired when the primary fails, or hasn't
+    answered within the hedge delay: the primary's recent p95 latency
+    (bounded by HEDGE_MIN_DELAY and HEDGE_MAX_DELAY), or no delay at all
+    when its recent error rate is above HEDGE_ERROR_RATE. The first non-empty
+    result wins, and the other call is cancelled (in the sync version, its
+    thread finishes in the background and its result is ignored).
+
+    Cached results are returned without any call, and are left out of the
+    latency stats, which should only describe the providers themselves.
+    """
+
+    def __init__(self, primary: SearchProvider, secondary: SearchProvider):
+        self.primary = primary
+        self.secondary = secondary
+        self.stats = {primary.name: ProviderStats(), secondary.name: ProviderStats()}
+        self.hedges = 0
+        self.cache_hits = 0
+        self._executor = ThreadPoolExecutor(thread_name_prefix="hedged-search")
+
+    def hedge_delay(self) -> float:
+        stats = self.stats[self.primary.name]
+        if stats.error_rate() > HEDGE_ERROR_RATE:
+            return 0.0
+        p95 = stats.p95()
+        if p95 is None:
+            return HEDGE_DEFAULT_DELAY
+        return min(max(p95, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def _call(self, provider: SearchProvider, query: str) -> SearchResults:
+        started_at = time.monotonic()
+        try:
+            results = provider.search(query)
+        except SEARCH_ERRORS:
+            self.stats[provider.name].record(time.monotonic() - started_at, False)
+            raise
+        self.stats[provider.name].record(time.monotonic() - started_at, bool(results))
+        if not results:
+            raise SearchError(f"No results from {provider.name}")
+        return results
+
+    async def _acall(self, provider: SearchProvider, query: str) -> SearchResults:
+        started_at = time.monotonic()
+        try:
+            results = await asyncio.wait_for(provider.asearch(query), provider.timeout)
+        except SEARCH_ERRORS:
+            self.stats[provider.name].record(time.monotonic() - started_at, False)
+            raise
+        self.stats[provider.name].record(time.monotonic() - started_at, bool(results))
+        if not results:
+            raise SearchError(f"No results from {provider.name}")
+        return results
+
+    def _win(self, provider: SearchProvider, losers: list[SearchProvider]) -> None:
+        self.stats[provider.name].wins += 1
+        for loser in losers:
+            self.stats[loser.name].cancelled += 1
+        logger.info("Web search: %s answered first", provider.name)
+
+    def from_cache(self, query: str) -> tuple[str, SearchResults] | None:
+        for provider in (self.primary, self.secondary):
+            results = provider.cached(query)
+            if results:
+                self.cache_hits += 1
+                return provider.name, results
+        return None
+
+    def search(self, query: str) -> tuple[str, SearchResults]:
+        if (cached := self.from_cache(query)) is not None:
+            return cached
+        running: dict[Future[SearchResults], SearchProvider] = {
+            self._executor.submit(self._call, self.primary, query): self.primary
+        }
+        deadlines = {self.primary.name: time.monotonic() + self.primary.timeout}
+        done, _ = wait(running, timeout=self.hedge_delay())
+        errors: list[BaseException] = []
+        hedged = False
+        while True:
+            for future in done:
+                provider = running.pop(future)
+                error = future.exception()
+                if error is not None and not isinstance(error, SEARCH_ERRORS):
+                    raise error
+                if error is None:
+                    self._win(provider, list(running.values()))
+                    for loser in running:
+                        _ = loser.cancel()
+                    return provider.name, future.result()
+                errors.append(error)
+            if not hedged:
+                hedged = True
+                self.hedges += 1
+                running[self._executor.submit(self._call, self.secondary, query)] = (
+                    self.secondary
+                )
+                deadlines[self.secondary.name] = (
+                    time.monotonic() + self.secondary.timeout
+                )
+            if not running:
+                raise errors[-1]
+            timeout = max(deadlines[p.name] for p in running.values()) - time.monotonic()
+            done, _ = wait(running, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                # The calls still running record their own outcome when they end
+                raise TimeoutError(f"No search provider answered for {query!r}")
+
+    async def asearch(self, query: str) -> tuple[str, SearchResults]:
+        if (cached := self.from_cache(query)) is not None:
+            return cached
+        running: dict[asyncio.Task[SearchResults], SearchProvider] = {
+            asyncio.create_task(self._acall(self.primary, query)): self.primary
+        }
+        errors: list[BaseException] = []
+        hedged = False
+        try:
+            done, _ = await asyncio.wait(running, timeout=self.hedge_delay())
+            while True:
+                for task in done:
+                    provider = running.pop(task)
+                    error = task.exception()
+                    if error is not None and not isinstance(error, SEARCH_ERRORS):
+                        raise error
+                    if error is None:
+                        self._win(provider, list(running.values()))
+                        return provider.name, task.result()
+                    errors.append(error)
+                if not hedged:
+                    hedged = True
+                    self.hedges += 1
+                    running[asyncio.create_task(self._acall(self.secondary, query))] = (
+                        self.secondary
+                    )
+                if not running:
+                    raise errors[-1]
+                # Each call is bounded by its provider's timeout
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in running:
+                _ = task.cancel()
+
+    def report(self) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+        return {
+            "hedge_delay": self.hedge_delay(),
+            "hedges": self.hedges,
+            "cache_hits": self.cache_hits,
+            "providers": {name: stats.as_dict() for name, stats in self.stats.items()},
+        }
@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from typing import NamedTuple
+
+from langchain_core.documents.base import Document
+from pydantic import BaseModel
+
+from .chunking import file_digest
+from .pdf import (
+    SNAPSHOT_PATH,
+    VECTOR_BACKEND,
+    VECTOR_STORE_PATH,
+    get_embeddings,
+    get_lexical_index,
+    get_text_splitter,
+    get_vector_backend,
+    iter_pdf_pages,
+)
+from .snapshot import publish_snapshot
+
+DEFAULT_PDF = "api/data/short-history-england.pdf"
+
+# Number of chunks embedded per request, and embedding requests in flight
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+
+# The checkpoint lives with the store it describes
+CHECKPOINT_PATH = os.path.join(VECTOR_STORE_PATH, "ingest-checkpoint.json")
+
+
+class IngestUnit(NamedTuple):
+    """A unit of work that is checkpointed as a whole (typically a PDF page)."""
+
+    key: str
+    pages: int
+    chunks: list[Document]
+
+
+class IngestStats(BaseModel):
+    pages: int = 0
+    chunks: int = 0
+    embedded: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+
+    def report(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        return (
+            f"{self.pages} pages, {self.chunks} chunks "
+            + f"({self.embedded} embedded, {self.skipped} already stored) "
+            + f"in {self.seconds:.1f}s: {self.pages / seconds:.1f} pages/s, "
+            + f"{self.chunks / seconds:.1f} chunks/s"
+        )
+
+
+class IngestCheckpoint:
+    """Keys of the units that are fully stored, so a run can resume."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: set[str] = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = set(json.load(f)["done"])  # pyright: ignore[reportAny]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.done
+
+    def mark_done(self, keys: list[str]) -> None:
+        self.done.update(keys)
+
+    def clear(self) -> None:
+        self.done = set()
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"done": sorted(self.done)}, f)
+        os.replace(tmp_path, self.path)
+
+
+class IngestBatch:
+    def __init__(self):
+        self.chunks: dict[str, Document] = {}
+        self.units: list[str] = []
+        self.pages: int = 0
+        self.chunk_count: int = 0
+
+    def add(self, unit: IngestUnit) -> None:
+        for chunk in unit.chunks:
+            self.chunks[chunk_id(chunk)] = chunk
+        self.units.append(unit.key)
+        self.pages += unit.pages
+        self.chunk_count += len(unit.chunks)
+
+
+def unit_key(digest: str, page: int) -> str:
+    return f"{digest[:16]}:{page}"
+
+
+def chunk_id(chunk: Document) -> str:
+    """Content-hash ID, so re-ingesting an unchanged chunk is a no-op."""
+    source = os.path.basename(str(chunk.metadata.get("source", "")))  # pyright: ignore[reportAny]
+    page = chunk.metadata.get("page", "")  # pyright: ignore[reportAny]
+    return hashlib.sha256(
+        json.dumps([source, page, chunk.page_content]).encode()
+    ).hexdigest()
+
+
+async def iter_pdf_units(
+    file_path: str, checkpoint: IngestCheckpoint
+) -> AsyncIterator[IngestUnit]:
+    digest = await asyncio.to_thread(file_digest, file_path)
+    async for page in iter_pdf_pages(file_path):
+        key = unit_key(digest, page.metadata.get("page", 0))  # pyright: ignore[reportAny]
+        if key in checkpoint:
+            continue
+        yield IngestUnit(key, 1, get_text_splitter().split_documents([page]))
+
+
+async def embed_batch(
+    batch: IngestBatch,
+) -> tuple[list[str], list[Document], list[list[float]]]:
+    ids = list(batch.chunks)
+    stored = (
+        await asyncio.to_thread(get_vector_backend().existing_ids, ids) if ids else set[str]()
+    )
+    new_ids = [id for id in ids if id not in stored]
+    new_chunks = [batch.chunks[id] for id in new_ids]
+    vectors = (
+        await get_embeddings().aembed_documents([chunk.page_content for chunk in new_chunks])
+        if new_chunks
+        else []
+    )
+    return new_ids, new_chunks, vectors
+
+
+async def ingest_units(
+    units: AsyncIterator[IngestUnit],
+    checkpoint: IngestCheckpoint,
+    batch_size: int = INGEST_BATCH_SIZE,
+    concurrency: int = INGEST_CONCURRENCY,
+) -> IngestStats:
+    """Embeds and stores chunks as they are produced, in bounded batches.
+
+    Up to `concurrency` batches are embedded at the same time, but they are
+    written (and checkpointed) in order, so the checkpoint only ever covers
+    units whose chunks are all stored.
+    """
+    stats = IngestStats()
+    started_at = time.monotonic()
+    in_flight: deque[
+        tuple[IngestBatch, asyncio.Task[tuple[list[str], list[Document], list[list[float]]]]]
+    ] = deque()
+
+    async def write_next() -> None:
+        batch, task = in_flight.popleft()
+        new_ids, new_chunks, vectors = await task
+        if new_ids:
+            await asyncio.to_thread(
+                get_vector_backend().upsert, new_ids, new_chunks, vectors
+            )
+        # All the chunks, not only the new ones, so that re-ingesting a file
+        # backfills the lexical index without any embedding call
+        await asyncio.to_thread(
+            get_lexical_index().add, list(batch.chunks), list(batch.chunks.values())
+        )
+        checkpoint.mark_done(batch.units)
+        await asyncio.to_thread(checkpoint.save)
+
+        stats.pages += batch.pages
+        stats.chunks += batch.chunk_count
+        stats.embedded += len(new_ids)
+        stats.skipped += batch.chunk_count - len(new_ids)
+        stats.seconds = time.monotonic() - started_at
+        print(f"Ingested {stats.report()}")
+
+    async def flush(batch: IngestBatch) -> None:
+        while len(in_flight) >= concurrency:
+            await write_next()
+        in_flight.append((batch, asyncio.create_task(embed_batch(batch))))
+
+    try:
+        batch = IngestBatch()
+        async for unit in units:
+            batch.add(unit)
+            if len(batch.chunks) >= batch_size:
+                await flush(batch)
+                batch = IngestBatch()
+        if batch.units:
+            await flush(batch)
+        while in_flight:
+            await write_next()
+    finally:
+        for _, task in in_flight:
+            _ = task.cancel()
+
+    stats.seconds = time.monotonic() - started_at
+    return stats
+
+
+async def iter_files_units(
+    file_paths: list[str], checkpoint: IngestCheckpoint
+) -> AsyncIterator[IngestUnit]:
+    for file_path in file_paths:
+        async for unit in iter_pdf_units(file_path, checkpoint):
+            yield unit
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Embeds PDF files into the vector store, skipping the "
+        + "chunks that are already stored and resuming interrupted runs."
+    )
+    _ = parser.add_argument("files", nargs="*", default=[DEFAULT_PDF])
+    _ = parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    _ = parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY)
+    _ = parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    _ = parser.add_argument(
+        "--restart", action="store_true", help="Ignore the existing checkpoint"
+    )
+    _ = parser.add_argument(
+        "--publish",
+        action="store_true",
+        help="Then publish a read-only snapshot (see `api.utils.snapshot`)",
+    )
+    args = parser.parse_args()
+    if VECTOR_BACKEND == "snapshot":
+        parser.error(
+            "Snapshots are read-only: ingest with VECTOR_BACKEND=chroma or numpy"
+        )
+
+    checkpoint = IngestCheckpoint(args.checkpoint)  # pyright: ignore[reportAny]
+    if args.restart:  # pyright: ignore[reportAny]
+        checkpoint.clear()
+
+    stats = await ingest_units(
+        iter_files_units(args.files, checkpoint),  # pyright: ignore[reportAny]
+        checkpoint,
+        batch_size=args.batch_size,  # pyright: ignore[reportAny]
+        concurrency=args.concurrency,  # pyright: ignore[reportAny]
+    )
+    print(f"Done: {stats.report()}")
+
+    if args.publish:  # pyright: ignore[reportAny]
+        snapshot = await asyncio.to_thread(
+            publish_snapshot, SNAPSHOT_PATH, get_vector_backend(), get_lexical_index()
+        )
+        print(f"Published snapshot {snapshot.version} to {SNAPSHOT_PATH}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
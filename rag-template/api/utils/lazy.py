@@ -0,0 +1,67 @@
+import asyncio
+import functools
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, Generic, TypeVar
+
+from .metrics import stage
+
+T = TypeVar("T")
+
+
+class Lazy(Generic[T]):
+    """A resource built on its first use, once, even under concurrent uses.
+
+    Heavy clients and stores (and the imports they need) are built this way,
+    so that a process only pays for the pipelines it actually runs. The build
+    is recorded as an `init:<name>` stage, in the trace of the request that
+    triggered it.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self.factory = factory
+        self.name = factory.__name__.removeprefix("get_")
+        self.seconds: float | None = None
+        self._value: T | None = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        _ = functools.update_wrapper(self, factory)
+        resources.append(self)
+
+    def __call__(self) -> T:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    started_at = time.monotonic()
+                    with stage(f"init:{self.name}"):
+                        self._value = self.factory()
+                    self.seconds = time.monotonic() - started_at
+                    self._loaded = True
+        return self._value  # pyright: ignore[reportReturnType]
+
+    async def aget(self) -> T:
+        """Same as calling it, but builds the resource off the event loop."""
+        if self._loaded:
+            return self._value  # pyright: ignore[reportReturnType]
+        return await asyncio.to_thread(self)
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def peek(self) -> T | None:
+        """The resource if it was built, without building it."""
+        return self._value if self._loaded else None
+
+
+resources: list[Lazy[Any]] = []  # pyright: ignore[reportExplicitAny]
+
+
+def lazy(factory: Callable[[], T]) -> Lazy[T]:
+    return Lazy(factory)
+
+
+def startup_report() -> dict[str, float | None]:
+    """Seconds each lazy resource took to build (None if not built yet)."""
+    return {resource.name: resource.seconds for resource in resources}
@@ -0,0 +1,38 @@
+import logging
+import os
+import random
+from typing import Any
+
+# Level of the application logs, and the fraction of `log_payload` calls whose
+# payloads (prompts, model outputs, retrieved chunks) are logged at DEBUG level
+# (each call is sampled on its own, not each request)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv("PAYLOAD_LOG_SAMPLE_RATE", "0.01"))
+PAYLOAD_LOG_MAX_CHARS = int(os.getenv("PAYLOAD_LOG_MAX_CHARS", "2000"))
+
+_root = logging.getLogger("api")
+if not _root.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    _root.addHandler(_handler)
+    _root.setLevel(LOG_LEVEL)
+    _root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+def log_payload(logger: logging.Logger, label: str, payload: Any) -> None:  # pyright: ignore[reportExplicitAny, reportAny]
+    """Logs a (truncated) payload at DEBUG level, for a sample of the calls.
+
+    The payload is only formatted when it is actually logged.
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= PAYLOAD_LOG_SAMPLE_RATE:
+        return
+    text = str(payload)  # pyright: ignore[reportAny]
+    if len(text) > PAYLOAD_LOG_MAX_CHARS:
+        text = text[:PAYLOAD_LOG_MAX_CHARS] + f"... ({len(text)} chars)"
+    logger.debug("%s: %s", label, text)
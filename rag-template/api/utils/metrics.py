@@ -0,0 +1,191 @@
+import bisect
+import functools
+import inspect
+import json
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])  # pyright: ignore[reportExplicitAny]
+
+# Bucket upper bounds for latencies and waits (seconds) and for sizes
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, in the style of Prometheus.
+
+    Only the bucket counts, the total and the number of observations are
+    kept, so observing is O(log buckets) and memory doesn't grow.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = SECONDS_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # One count per bucket, plus the implicit +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the q-quantile."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return float("inf")
+
+    def as_dict(self) -> dict[str, object]:
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        with self._lock:
+            cumulative: dict[str, int] = {}
+            seen = 0
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                cumulative[f"{bound:g}"] = seen
+            cumulative["+Inf"] = self.count
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "p50": p50,
+                "p95": p95,
+                "buckets": cumulative,
+            }
+
+
+def format_labels(labels: dict[str, str], **extra: str) -> str:
+    pairs = {**labels, **extra}
+    if not pairs:
+        return ""
+    return "{" + ",".join(f"{key}={json.dumps(value)}" for key, value in pairs.items()) + "}"
+
+
+class Registry:
+    """Named, labelled histograms, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.help: dict[str, str] = {}
+        self.histograms: dict[tuple[str, tuple[tuple[str, str], ...]], Histogram] = {}
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...] = SECONDS_BUCKETS,
+        **labels: str,
+    ) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+                _ = self.help.setdefault(name, help)
+        return histogram
+
+    def render(self) -> str:
+        lines: list[str] = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name != name:
+                    continue
+                label_dict = dict(labels)
+                snapshot = histogram.as_dict()
+                buckets: dict[str, int] = snapshot["buckets"]  # pyright: ignore[reportAssignmentType]
+                for bound, count in buckets.items():
+                    lines.append(
+                        f"{name}_bucket{format_labels(label_dict, le=bound)} {count}"
+                    )
+                lines.append(f"{name}_sum{format_labels(label_dict)} {snapshot['sum']}")
+                lines.append(f"{name}_count{format_labels(label_dict)} {snapshot['count']}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = "chat_stage_seconds"
+
+
+class Trace:
+    """The stages of one chat request, with their durations."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:8]
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.stages: list[tuple[str, float]] = []
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages.append((stage, seconds))
+
+    def summary(self) -> str:
+        with self._lock:
+            stages = " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in self.stages)
+        return f"trace={self.id} total={(time.monotonic() - self.started_at) * 1000:.0f}ms {stages}"
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+def observe_stage(stage: str, seconds: float, trace: Trace | None = None) -> None:
+    """Records a stage duration in its histogram and in the (current) trace."""
+    registry.histogram(
+        STAGE_SECONDS, "Duration of each stage of the chat pipeline", stage=stage
+    ).observe(seconds)
+    trace = trace or current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.monotonic() - started_at)
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator recording each call of a function (sync or async) as a stage."""
+
+    def decorator(fn: F) -> F:
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:  # pyright: ignore[reportExplicitAny, reportAny]
+                with stage(name):
+                    return await fn(*args, **kwargs)  # pyright: ignore[reportAny]
+
+            return async_wrapper  # pyright: ignore[reportReturnType]
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:  # pyright: ignore[reportExplicitAny, reportAny]
+            with stage(name):
+                return fn(*args, **kwargs)  # pyright: ignore[reportAny]
+
+        return wrapper  # pyright: ignore[reportReturnType]
+
+    return decorator
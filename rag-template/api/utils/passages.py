@@ -0,0 +1,128 @@
+import os
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+from langchain_core.documents.base import Document
+
+from .bm25 import bm25_scores
+from .context import (
+    PackedContext,
+    PackingStats,
+    count_raw_tokens,
+    count_tokens,
+    pack_documents,
+)
+from .lazy import lazy
+from .log import get_logger
+
+if TYPE_CHECKING:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# Prompt tokens that web search passages may use, per search
+WEB_CONTEXT_TOKENS = int(os.getenv("WEB_CONTEXT_TOKENS", "3000"))
+
+# Web pages are split into passages of about this many characters
+PASSAGE_SIZE = int(os.getenv("PASSAGE_SIZE", "600"))
+
+
+@lazy
+def get_passage_splitter() -> "RecursiveCharacterTextSplitter":
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(chunk_size=PASSAGE_SIZE, chunk_overlap=0)
+
+
+logger = get_logger(__name__)
+
+
+class WebResult(NamedTuple):
+    title: str
+    url: str
+    text: str
+
+
+def to_web_result(result: Any) -> WebResult | None:  # pyright: ignore[reportExplicitAny, reportAny]
+    """Reads a DuckDuckGo result (a dict) or an Exa result (an object)."""
+    if isinstance(result, dict):
+        return WebResult(
+            str(result.get("title", "")),  # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
+            str(result.get("href", result.get("url", ""))),  # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
+            str(result.get("body", result.get("text", ""))),  # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
+        )
+    if hasattr(result, "url"):  # pyright: ignore[reportAny]
+        return WebResult(
+            str(getattr(result, "title", "") or ""),  # pyright: ignore[reportAny]
+            str(getattr(result, "url", "") or ""),  # pyright: ignore[reportAny]
+            str(getattr(result, "text", "") or ""),  # pyright: ignore[reportAny]
+        )
+    return None
+
+
+def compact_search_results(
+    query: str, results: list[Any], budget: int = WEB_CONTEXT_TOKENS  # pyright: ignore[reportExplicitAny]
+) -> PackedContext:
+    """Keeps the passages of the search results that best match the query.
+
+    Each result is split into passages, which are scored with BM25 (title
+    included) against the query. The best passages are kept up to the token
+    budget, then grouped under their result, in the search engine's order.
+    Passages that share no term with the query are only kept when they are
+    the whole result (like a DuckDuckGo snippet).
+    """
+    web_results = [r for r in map(to_web_result, results) if r is not None]
+    candidates: list[tuple[int, str, bool]] = []
+    seen: set[str] = set()
+    stats = PackingStats(raw_tokens=count_raw_tokens(results))
+    for rank, result in enumerate(web_results):
+        texts = [" ".join(t.split()) for t in get_passage_splitter().split_text(result.text)]
+        for text in texts:
+            if text in seen:
+                stats.duplicates += 1
+                continue
+            seen.add(text)
+            candidates.append((rank, text, len(texts) == 1))
+    stats.chunks = len(candidates)
+
+    scores = bm25_scores(
+        query, [f"{web_results[rank].title} {text}" for rank, text, _ in candidates]
+    )
+    order = sorted(
+        range(len(candidates)), key=lambda i: (-scores[i], candidates[i][0])
+    )
+    selected: list[int] = []
+    used = 0
+    for i in order:
+        _, text, whole = candidates[i]
+        tokens = count_tokens(text) + 1
+        if (scores[i] <= 0 and not whole) or used + tokens > budget:
+            stats.dropped += 1
+            continue
+        selected.append(i)
+        used += tokens
+
+    blocks: list[str] = []
+    number = 0
+    for rank, result in enumerate(web_results):
+        texts = [candidates[i][1] for i in sorted(selected) if candidates[i][0] == rank]
+        if texts:
+            number += 1
+            blocks.append(f"[{number}] {result.title} ({result.url})")
+            blocks.extend(texts)
+
+    text = "\n".join(blocks)
+    stats.passages = len(selected)
+    stats.packed_tokens = count_tokens(text)
+    return PackedContext(text, stats)
+
+
+def pack_tool_result(result: Any, arguments: dict[str, Any]) -> Any:  # pyright: ignore[reportExplicitAny, reportAny]
+    """Packs the documents or web results returned by a tool for the prompt."""
+    if not isinstance(result, list) or not result:
+        return result  # pyright: ignore[reportAny]
+    if isinstance(result[0], Document):
+        packed = pack_documents(result)  # pyright: ignore[reportUnknownArgumentType]
+    elif "query" in arguments and to_web_result(result[0]) is not None:
+        packed = compact_search_results(str(arguments["query"]), result)  # pyright: ignore[reportUnknownArgumentType]
+    else:
+        return result  # pyright: ignore[reportUnknownVariableType]
+    logger.info("Context packing: %s", packed.stats.report())
+    return packed.text
@@ -1,29 +1,149 @@
 import asyncio
+import os
+from collections.abc import AsyncIterator
+from typing import TYPE_CHECKING, cast
 
 from dotenv import load_dotenv
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_core.documents.base import Document
-from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from .bm25 import BM25Index, DocumentFrequencies
+from .clients import openai_async_http_client, openai_http_client
+from .embedding_batcher import EMBEDDING_BATCHING, EmbeddingBatcher
+from .embedding_cache import CachedEmbeddings
+from .lazy import lazy
+from .snapshot import OpenSnapshot, load_snapshot
+from .vector_index import (
+    ChromaBackend,
+    NumpyVectorIndex,
+    Quantization,
+    VectorBackend,
+)
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+    from langchain_openai import OpenAIEmbeddings
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 _ = load_dotenv(".env.local")
 _ = load_dotenv("../.env")
 
-embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+# "chroma" (default), "numpy", the memory-mapped exact-search index, or
+# "snapshot", the current read-only snapshot published under SNAPSHOT_PATH
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+NUMPY_INDEX_PATH = os.getenv("NUMPY_INDEX_PATH", "./api/numpy_index")
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "./api/snapshots")
+NUMPY_INDEX_DTYPE = "float16" if os.getenv("NUMPY_INDEX_DTYPE") == "float16" else "float32"
 
-vector_store_pdf = Chroma(
-    collection_name="pdf_vector",
-    embedding_function=embeddings,
-    persist_directory="./api/chroma_db",
+# Quantized scan ("int8" or "binary") with full-precision rescoring of
+# k * NUMPY_INDEX_RESCORE candidates; "none" keeps the search exact
+NUMPY_INDEX_QUANTIZATION = cast(
+    Quantization, os.getenv("NUMPY_INDEX_QUANTIZATION", "none")
 )
+NUMPY_INDEX_RESCORE = int(os.getenv("NUMPY_INDEX_RESCORE", "0")) or None
 
+VECTOR_STORE_PATH = NUMPY_INDEX_PATH if VECTOR_BACKEND == "numpy" else "./api/chroma_db"
+
+# The BM25 index is built during ingestion and lives with the vector store
+BM25_INDEX_PATH = os.getenv("BM25_INDEX_PATH", os.path.join(VECTOR_STORE_PATH, "bm25"))
+
+# Everything below is built on first use (see `Lazy`): importing langchain's
+# OpenAI and Chroma integrations takes seconds, and STEP 0 needs neither
+
+
+@lazy
+def get_openai_embeddings() -> "OpenAIEmbeddings":
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(
+        model="text-embedding-3-large",
+        http_client=openai_http_client,
+        http_async_client=openai_async_http_client,
+    )
+
+
+@lazy
+def get_embedding_batcher() -> EmbeddingBatcher | None:
+    if not EMBEDDING_BATCHING:
+        return None
+    return EmbeddingBatcher(get_openai_embeddings())
+
+
+# Query embeddings are cached, so repeated retrievals skip the API round-trip,
+# and the misses of concurrent requests are batched into single calls
+@lazy
+def get_embeddings() -> CachedEmbeddings:
+    return CachedEmbeddings(get_openai_embeddings(), batcher=get_embedding_batcher())
+
+
+@lazy
+def get_vector_store() -> "Chroma":
+    from langchain_chroma import Chroma
+
+    return Chroma(
+        collection_name="pdf_vector",
+        embedding_function=get_embeddings(),
+        persist_directory="./api/chroma_db",
+    )
+
+
+# Resolved once per process, with its vector and BM25 indexes opened together
+# so they always come from the same snapshot (and a snapshot pruned later
+# can't leave one of them missing); publishing a new one doesn't affect it
+# until restart
+@lazy
+def get_snapshot() -> OpenSnapshot:
+    return load_snapshot(SNAPSHOT_PATH, NUMPY_INDEX_QUANTIZATION, NUMPY_INDEX_RESCORE)
+
+
+@lazy
+def get_vector_backend() -> VectorBackend:
+    if VECTOR_BACKEND == "snapshot":
+        return get_snapshot().vectors
+    if VECTOR_BACKEND == "numpy":
+        return NumpyVectorIndex(
+            NUMPY_INDEX_PATH,
+            dtype=NUMPY_INDEX_DTYPE,
+            quantization=NUMPY_INDEX_QUANTIZATION,
+            rescore_multiplier=NUMPY_INDEX_RESCORE,
+        )
+    return ChromaBackend(get_vector_store())
+
+
+@lazy
+def get_lexical_index() -> BM25Index:
+    if VECTOR_BACKEND == "snapshot":
+        return get_snapshot().bm25
+    return BM25Index(BM25_INDEX_PATH)
+
+
+# How rare each term is, without loading the BM25 postings (a snapshot's
+# index is memory-mapped, so it is used directly)
+@lazy
+def get_document_frequencies() -> BM25Index | DocumentFrequencies:
+    if VECTOR_BACKEND == "snapshot":
+        return get_snapshot().bm25
+    return DocumentFrequencies(BM25_INDEX_PATH)
+
+
+@lazy
+def get_text_splitter() -> "RecursiveCharacterTextSplitter":
+    from .chunking import make_text_splitter
+
+    return make_text_splitter()
+
+
+async def iter_pdf_pages(file_path: str) -> AsyncIterator[Document]:
+    from langchain_community.document_loaders import PyPDFLoader
 
-async def load_pdf(file_path: str) -> list[Document]:
     loader = PyPDFLoader(file_path)
+    async for page in loader.alazy_load():
+        yield page
+
+
+async def load_pdf(file_path: str) -> list[Document]:
     pages: list[Document] = []
     i = 0
-    async for page in loader.alazy_load():
+    async for page in iter_pdf_pages(file_path):
         print(f"Processing page {i}")
         i += 1
         pages.append(page)
@@ -31,10 +151,7 @@ async def load_pdf(file_path: str) -> list[Document]:
 
 
 if __name__ == "__main__":
-    pages = asyncio.run(load_pdf("api/data/short-history-england.pdf"))
-    print("Pages processed, splitting...")
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    all_splits = text_splitter.split_documents(pages)
+    # Ingestion lives in `api.utils.ingest`, which only embeds new chunks
+    from .ingest import main
 
-    print("Pages split, embedding...")
-    _ = vector_store_pdf.add_documents(documents=all_splits)
+    asyncio.run(main())
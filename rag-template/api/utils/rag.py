@@ -1,5 +1,10 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
 from langchain_core.documents.base import Document
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from openai.types.chat import (
     ChatCompletionDeveloperMessageParam,
     ChatCompletionMessageParam,
@@ -7,22 +12,267 @@ from openai.types.chat import (
 )
 from pydantic import BaseModel
 
-from .pdf import vector_store_pdf
+from .bm25 import tokenize
+from .coalesce import SingleFlight
+from .context import pack_documents
+from .embedding_cache import normalize_query
+from .log import get_logger, log_payload
+from .metrics import timed
+from .pdf import (
+    get_document_frequencies,
+    get_embeddings,
+    get_lexical_index,
+    get_vector_backend,
+)
+from .rerank import candidate_k, rerank
+from .tool_cache import ToolCache
+from .vector_index import Hits
+
+# "dense" (embeddings only), "lexical" (BM25 only) or "hybrid" (both, fused)
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "dense")
+
+# Reciprocal-rank fusion constant, and candidates fetched by each retriever
+# in hybrid mode, as a multiple of k
+RRF_K = int(os.getenv("RRF_K", "60"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "2"))
+
+# The lexical search runs here while the query is embedded
+lexical_executor = ThreadPoolExecutor(thread_name_prefix="lexical-search")
+
+# Pipelined refinement (STEP 3): the raw query is searched with RAW_QUERY_K
+# while it is refined, and refinements taking longer than REFINEMENT_TIMEOUT
+# are given up on. Queries with at least SPECIFIC_QUERY_TERMS terms that are
+# rare in the corpus (in less than RARE_TERM_RATIO of the chunks) are not
+# refined at all.
+RAW_QUERY_K = int(os.getenv("RAW_QUERY_K", "10"))
+REFINEMENT_TIMEOUT = float(os.getenv("REFINEMENT_TIMEOUT", "8"))
+REFINEMENT_CACHE_TTL = float(os.getenv("REFINEMENT_CACHE_TTL", "86400"))
+SPECIFIC_QUERY_TERMS = int(os.getenv("SPECIFIC_QUERY_TERMS", "3"))
+RARE_TERM_RATIO = float(os.getenv("RARE_TERM_RATIO", "0.01"))
+
+refinement_cache = ToolCache[tuple[str, int]]("rag_refinement", REFINEMENT_CACHE_TTL)
+# Concurrent searches for the same query and k share one embedding, search
+# and rerank
+search_flight = SingleFlight[list[Document]]("pdf_search")
+speculative_executor = ThreadPoolExecutor(thread_name_prefix="speculative-search")
+
+logger = get_logger(__name__)
+
+
+def reciprocal_rank_fusion(rankings: list[Hits], k: int) -> list[Document]:
+    """Merges rankings by summing 1 / (RRF_K + rank) for each document."""
+    scores: dict[str, float] = {}
+    docs: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, (doc, _) in enumerate(ranking):
+            key = doc.id or doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1 / (RRF_K + rank + 1)
+            _ = docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.__getitem__, reverse=True)[:k]]
+
+
+@timed("vector_search")
+def search_pdf_hits(
+    vectors: list[list[float]], lexical: list[Hits], k: int
+) -> list[list[Document]]:
+    """Dense search, fused with the lexical hits in hybrid mode."""
+    vector_backend = get_vector_backend()
+    if RAG_SEARCH_MODE != "hybrid":
+        return [[doc for doc, _ in hits] for hits in vector_backend.search(vectors, k)]
+    dense = vector_backend.search(vectors, k * HYBRID_CANDIDATES)
+    return [
+        reciprocal_rank_fusion([dense_hits, lexical_hits], k)
+        for dense_hits, lexical_hits in zip(dense, lexical)
+    ]
+
+
+def search_key(query: str, k: int) -> str:
+    return f"{k}\0{normalize_query(query)}"
 
 
 def similarity_search_pdf(query: str, k: int = 10) -> list[Document]:
-    return vector_store_pdf.similarity_search(query, k=k)
+    docs = search_flight.call(
+        search_key(query, k), lambda: batch_similarity_search_pdf([query], k)[0]
+    )
+    # Copied, since the list is shared with the coalesced callers
+    return list(docs)
 
 
-def do_rag_similarity_search(
-    messages: list[ChatCompletionMessageParam], query: str, k: int = 10
+async def asimilarity_search_pdf(query: str, k: int = 10) -> list[Document]:
+    docs = await search_flight.acall(
+        search_key(query, k), lambda: arun_similarity_search_pdf(query, k)
+    )
+    return list(docs)
+
+
+async def arun_similarity_search_pdf(query: str, k: int) -> list[Document]:
+    candidates = candidate_k(k)
+    # Built off the event loop on first use
+    vector_backend = await get_vector_backend.aget()
+    if RAG_SEARCH_MODE == "lexical":
+        lexical_index = await get_lexical_index.aget()
+        hits = await asyncio.to_thread(lexical_index.search, query, candidates)
+        docs, vector = [doc for doc, _ in hits], None
+    elif RAG_SEARCH_MODE != "hybrid":
+        embeddings = await get_embeddings.aget()
+        vector = await embeddings.aembed_query(query)
+        results = await asyncio.to_thread(search_pdf_hits, [vector], [], candidates)
+        docs = results[0]
+    else:
+        embeddings = await get_embeddings.aget()
+        lexical_index = await get_lexical_index.aget()
+        vector, lexical = await asyncio.gather(
+            embeddings.aembed_query(query),
+            asyncio.to_thread(
+                lexical_index.search, query, candidates * HYBRID_CANDIDATES
+            ),
+        )
+        results = await asyncio.to_thread(search_pdf_hits, [vector], [lexical], candidates)
+        docs = results[0]
+    return await asyncio.to_thread(
+        rerank, query, vector, docs, k, vector_backend.vectors
+    )
+
+
+def batch_similarity_search_pdf(queries: list[str], k: int = 10) -> list[list[Document]]:
+    """Runs several queries through a single (vectorized) search."""
+    candidates = candidate_k(k)
+    vector_backend = get_vector_backend()
+    if RAG_SEARCH_MODE == "lexical":
+        return [
+            rerank(
+                query,
+                None,
+                [doc for doc, _ in get_lexical_index().search(query, candidates)],
+                k,
+                vector_backend.vectors,
+            )
+            for query in queries
+        ]
+    lexical = (
+        [
+            lexical_executor.submit(
+                get_lexical_index().search, query, candidates * HYBRID_CANDIDATES
+            )
+            for query in queries
+        ]
+        if RAG_SEARCH_MODE == "hybrid"
+        else []
+    )
+    vectors = get_embeddings().embed_queries(queries)
+    results = search_pdf_hits(vectors, [future.result() for future in lexical], candidates)
+    return [
+        rerank(query, vector, docs, k, vector_backend.vectors)
+        for query, vector, docs in zip(queries, vectors, results)
+    ]
+
+
+def warm_up_retrieval(lexical: bool = RAG_SEARCH_MODE != "dense") -> None:
+    """Builds the retrieval resources and loads the vector index."""
+    _ = get_embeddings()
+    if lexical:
+        _ = get_lexical_index()
+    get_vector_backend().warm_up()
+
+
+def merge_results(refined: list[Document], raw: list[Document], k: int) -> list[Document]:
+    """Fuses the refined query's results with the raw query's results."""
+    return reciprocal_rank_fusion(
+        [[(doc, 0.0) for doc in refined], [(doc, 0.0) for doc in raw]],
+        max(k, len(refined)),
+    )
+
+
+def is_specific_query(query: str) -> bool:
+    """Whether a query has enough rare terms to be searched as is.
+
+    The BM25 index is used if the search mode already loaded it, and the
+    document-frequency table saved with it otherwise.
+    """
+    frequencies = get_lexical_index.peek() or get_document_frequencies()
+    count = frequencies.count()
+    if count == 0:
+        return False
+    rare_terms = {
+        term
+        for term in tokenize(query)
+        if 0 < frequencies.document_frequency(term) < RARE_TERM_RATIO * count
+    }
+    return len(rare_terms) >= SPECIFIC_QUERY_TERMS
+
+
+def pipelined_rag_search(raw_query: str, client: OpenAI) -> list[Document]:
+    """Searches the raw query while it is refined, then merges both results."""
+    raw_search = speculative_executor.submit(
+        copy_context().run, similarity_search_pdf, raw_query, RAW_QUERY_K
+    )
+    if is_specific_query(raw_query):
+        logger.info("Refinement skipped for a specific query")
+        return raw_search.result()
+
+    refinement = speculative_executor.submit(
+        copy_context().run,
+        refinement_cache.get_or_call,
+        normalize_query(raw_query),
+        lambda: generate_rag_parameters(raw_query, client),
+    )
+    try:
+        query, k = refinement.result(timeout=REFINEMENT_TIMEOUT)
+    except Exception as e:
+        logger.warning("Refinement failed, using the raw query: %r", e)
+        return raw_search.result()
+    return merge_results(similarity_search_pdf(query, k), raw_search.result(), k)
+
+
+async def apipelined_rag_search(raw_query: str, client: AsyncOpenAI) -> list[Document]:
+    raw_search = asyncio.create_task(asimilarity_search_pdf(raw_query, RAW_QUERY_K))
+    # Loaded off the event loop, since `is_specific_query` reads them
+    if RAG_SEARCH_MODE != "dense":
+        _ = await get_lexical_index.aget()
+    else:
+        _ = await get_document_frequencies.aget()
+    if is_specific_query(raw_query):
+        logger.info("Refinement skipped for a specific query")
+        return await raw_search
+
+    try:
+        query, k = await asyncio.wait_for(
+            refinement_cache.aget_or_call(
+                normalize_query(raw_query),
+                lambda: agenerate_rag_parameters(raw_query, client),
+            ),
+            REFINEMENT_TIMEOUT,
+        )
+    except Exception as e:
+        logger.warning("Refinement failed, using the raw query: %r", e)
+        return await raw_search
+    refined, raw = await asyncio.gather(asimilarity_search_pdf(query, k), raw_search)
+    return merge_results(refined, raw, k)
+
+
+def do_pipelined_rag_search(
+    messages: list[ChatCompletionMessageParam], raw_query: str, client: OpenAI
 ) -> list[ChatCompletionMessageParam]:
-    print(f"QUERY: {query}")
-    docs: list[Document] = similarity_search_pdf(query, k)
-    print(f"RAG SEARCH RESULTS: {docs}")
+    log_payload(logger, "Query", raw_query)
+    return append_rag_results(messages, pipelined_rag_search(raw_query, client))
+
+
+async def ado_pipelined_rag_search(
+    messages: list[ChatCompletionMessageParam], raw_query: str, client: AsyncOpenAI
+) -> list[ChatCompletionMessageParam]:
+    log_payload(logger, "Query", raw_query)
+    return append_rag_results(messages, await apipelined_rag_search(raw_query, client))
+
+
+def append_rag_results(
+    messages: list[ChatCompletionMessageParam], docs: list[Document]
+) -> list[ChatCompletionMessageParam]:
+    log_payload(logger, "RAG search results", docs)
+    context = pack_documents(docs)
+    logger.info("Context packing: %s", context.stats.report())
     messages.append(
         ChatCompletionUserMessageParam(
-            content=("Result from RAG search => \n" + str(docs)), role="user"
+            content=("Result from RAG search => \n" + context.text), role="user"
         )
     )
     messages.append(
@@ -34,12 +284,30 @@ def do_rag_similarity_search(
     return messages
 
 
+def do_rag_similarity_search(
+    messages: list[ChatCompletionMessageParam], query: str, k: int = 10
+) -> list[ChatCompletionMessageParam]:
+    log_payload(logger, "Query", query)
+    docs: list[Document] = similarity_search_pdf(query, k)
+    return append_rag_results(messages, docs)
+
+
+async def ado_rag_similarity_search(
+    messages: list[ChatCompletionMessageParam], query: str, k: int = 10
+) -> list[ChatCompletionMessageParam]:
+    log_payload(logger, "Query", query)
+    docs: list[Document] = await asimilarity_search_pdf(query, k)
+    return append_rag_results(messages, docs)
+
+
 class RagParameters(BaseModel):
     refined_query: str
     k: int
 
 
-def generate_rag_parameters(raw_query: str, client: OpenAI) -> tuple[str, int]:
+def rag_parameters_messages(
+    raw_query: str,
+) -> list[ChatCompletionMessageParam]:
     developer_msg = ChatCompletionDeveloperMessageParam(
         content="Your job is to take a raw query for a RAG system and return the 'refined' query (so that it's longer, generally), and the right 'k' (higher for requests that need to look at more documents, lower for information that would be contained in only one document). k needs to be between 5 and 40.",
         role="developer",
@@ -48,15 +316,36 @@ def generate_rag_parameters(raw_query: str, client: OpenAI) -> tuple[str, int]:
         content=("Query from user => \n" + str(raw_query)), role="user"
     )
 
-    print(developer_msg)
-    print(query_msg)
+    log_payload(logger, "Refinement prompt", [developer_msg, query_msg])
+    return [developer_msg, query_msg]
+
+
+@timed("query_refinement")
+def generate_rag_parameters(raw_query: str, client: OpenAI) -> tuple[str, int]:
     completion = client.beta.chat.completions.parse(
-        messages=[developer_msg, query_msg],
+        messages=rag_parameters_messages(raw_query),
+        model="gpt-4.1",
+        response_format=RagParameters,
+    )
+    params = completion.choices[0].message
+    log_payload(logger, "Refinement completion", completion)
+
+    if params.parsed:
+        return params.parsed.refined_query, params.parsed.k
+    return raw_query, 10
+
+
+@timed("query_refinement")
+async def agenerate_rag_parameters(
+    raw_query: str, client: AsyncOpenAI
+) -> tuple[str, int]:
+    completion = await client.beta.chat.completions.parse(
+        messages=rag_parameters_messages(raw_query),
         model="gpt-4.1",
         response_format=RagParameters,
     )
     params = completion.choices[0].message
-    print(completion)
+    log_payload(logger, "Refinement completion", completion)
 
     if params.parsed:
         return params.parsed.refined_query, params.parsed.k
@@ -0,0 +1,185 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from functools import lru_cache
+
+import numpy as np
+import numpy.typing as npt
+from langchain_core.documents.base import Document
+
+from .bm25 import bm25_scores
+from .log import get_logger
+from .metrics import observe_stage
+
+# Rerank stage: candidates fetched as a multiple of k, then diversified with
+# maximal marginal relevance, which keeps RERANK_KEEP_RATIO of k
+RAG_RERANK = os.getenv("RAG_RERANK", "mmr")  # "mmr" or "none"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "4"))
+RERANK_KEEP_RATIO = float(os.getenv("RERANK_KEEP_RATIO", "0.6"))
+
+# Trade-off between relevance (1) and diversity (0)
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+
+# Optional local reranker scoring the candidates against the query text:
+# "" (cosine similarity only), "bm25" or "cross-encoder" (needs the
+# sentence-transformers package)
+RAG_RERANKER = os.getenv("RAG_RERANKER", "")
+CROSS_ENCODER_MODEL = os.getenv(
+    "CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2"
+)
+
+Reranker = Callable[[str, list[Document]], list[float]]
+
+logger = get_logger(__name__)
+
+
+def bm25_reranker(query: str, docs: list[Document]) -> list[float]:
+    return bm25_scores(query, [doc.page_content for doc in docs])
+
+
+def cross_encoder_reranker() -> Reranker:
+    from sentence_transformers import CrossEncoder  # pyright: ignore[reportMissingImports]
+
+    model = CrossEncoder(CROSS_ENCODER_MODEL)  # pyright: ignore[reportUnknownVariableType]
+
+    def rerank(query: str, docs: list[Document]) -> list[float]:
+        scores = model.predict([(query, doc.page_content) for doc in docs])  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+        return [float(score) for score in scores]  # pyright: ignore[reportUnknownArgumentType, reportUnknownVariableType]
+
+    return rerank
+
+
+RERANKERS: dict[str, Callable[[], Reranker]] = {
+    "bm25": lambda: bm25_reranker,
+    "cross-encoder": cross_encoder_reranker,
+}
+
+
+@lru_cache(maxsize=1)
+def get_reranker() -> Reranker | None:
+    if not RAG_RERANKER:
+        return None
+    try:
+        return RERANKERS[RAG_RERANKER]()
+    except Exception as e:
+        logger.warning(
+            "Could not load the %r reranker, using MMR only: %r", RAG_RERANKER, e
+        )
+        return None
+
+
+def candidate_k(k: int) -> int:
+    """Candidates to retrieve for a final k."""
+    return k * RERANK_CANDIDATES if RAG_RERANK == "mmr" else k
+
+
+def final_k(k: int) -> int:
+    """Documents sent to the prompt for a requested k."""
+    return max(1, math.ceil(k * RERANK_KEEP_RATIO)) if RAG_RERANK == "mmr" else k
+
+
+def rescale(scores: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    """Maps scores to [0, 1], so they are comparable to cosine similarities."""
+    spread = scores.max() - scores.min()
+    if spread <= 0:
+        return np.ones_like(scores)
+    return (scores - scores.min()) / spread
+
+
+def mmr(
+    relevance: npt.NDArray[np.float32],
+    similarities: npt.NDArray[np.float32],
+    k: int,
+    trade_off: float = MMR_LAMBDA,
+) -> list[int]:
+    """Maximal marginal relevance over a candidate similarity matrix.
+
+    Each step picks the candidate maximizing
+    `trade_off * relevance - (1 - trade_off) * max similarity to the selected`,
+    with the maxima updated in place (one vectorized pass per pick).
+    """
+    count = len(relevance)
+    selected: list[int] = []
+    redundancy = np.full(count, -np.inf, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    for _ in range(min(k, count)):
+        scores = trade_off * relevance - (1 - trade_off) * np.maximum(redundancy, 0)
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarities[best])
+    return selected
+
+
+class RerankStats:
+    """Calls, candidates in and documents out, and latency of the stage."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.candidates = 0
+        self.kept = 0
+
+    def record(self, seconds: float, candidates: int, kept: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.candidates += candidates
+            self.kept += kept
+            self.latencies.append(seconds)
+
+    def report(self) -> dict[str, object]:
+        with self._lock:
+            latencies = np.asarray(self.latencies)
+            return {
+                "mode": RAG_RERANK,
+                "reranker": RAG_RERANKER or None,
+                "calls": self.calls,
+                "candidates": self.candidates,
+                "kept": self.kept,
+                "p50_seconds": float(np.percentile(latencies, 50)) if self.calls else None,
+                "p95_seconds": float(np.percentile(latencies, 95)) if self.calls else None,
+            }
+
+
+rerank_stats = RerankStats()
+
+
+def rerank(
+    query: str,
+    vector: list[float] | None,
+    docs: list[Document],
+    k: int,
+    stored_vectors: Callable[[list[str]], npt.NDArray[np.float32]],
+) -> list[Document]:
+    """Keeps `final_k(k)` relevant and diverse documents out of the candidates.
+
+    Relevance is the reranker's score if one is configured, else the cosine
+    similarity to the query vector, else (lexical search) the candidate rank.
+    Diversity is measured with the stored embeddings of the candidates, so
+    overlapping chunks of the same page don't crowd out the rest.
+    """
+    keep = final_k(k)
+    if RAG_RERANK != "mmr" or len(docs) <= keep:
+        return docs[:keep]
+
+    started_at = time.monotonic()
+    matrix = stored_vectors([doc.id or "" for doc in docs])
+    reranker = get_reranker()
+    if reranker is not None:
+        relevance = rescale(np.asarray(reranker(query, docs), dtype=np.float32))
+    elif vector is not None:
+        query_vector = np.asarray(vector, dtype=np.float32)
+        relevance = matrix @ (query_vector / (np.linalg.norm(query_vector) + 1e-12))
+    else:
+        relevance = 1 - np.arange(len(docs), dtype=np.float32) / len(docs)
+    selected = mmr(relevance, matrix @ matrix.T, keep)
+
+    seconds = time.monotonic() - started_at
+    rerank_stats.record(seconds, len(docs), len(selected))
+    observe_stage("rerank", seconds)
+    return [docs[i] for i in selected]
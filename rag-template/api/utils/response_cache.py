@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Iterator
+from typing import NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
+
+from .log import get_logger
+
+# Minimum cosine similarity between two questions to reuse an answer
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.92"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+
+logger = get_logger(__name__)
+
+
+class CachedResponse(NamedTuple):
+    scope: str
+    vector: npt.NDArray[np.float32]
+    frames: list[str]
+    created_at: float
+
+
+def cache_scope(
+    step: int,
+    tools: list[str],
+    messages: list[ChatCompletionMessageParam],
+    route: str | None = None,
+) -> str:
+    """What must match exactly for two questions to share an answer.
+
+    That's the pipeline (STEP, tool set, and in STEP 7 the route chosen for
+    the question) and the conversation before the last message, so that a
+    follow-up is never answered out of context.
+    """
+    history = json.dumps(messages[:-1], sort_keys=True, default=str)
+    return f"{step}:{route or ''}:{','.join(sorted(tools))}:" + hashlib.sha256(
+        history.encode()
+    ).hexdigest()
+
+
+def cacheable(frames: list[str]) -> bool:
+    """Only plain text answers are cached: tool calls must run every time."""
+    return bool(frames) and not any(
+        frame.startswith(("9:", "a:")) for frame in frames
+    )
+
+
+class SemanticResponseCache:
+    """Answers of /api/chat, looked up by the embedding of the last message.
+
+    A question hits the cache when a stored question of the same scope is at
+    least `threshold` similar and younger than `ttl` seconds. The stored
+    answer is the list of data-stream frames that were sent, so replaying it
+    is indistinguishable from the original stream. The least recently used
+    entries are evicted beyond `max_entries`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = RESPONSE_CACHE_THRESHOLD,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[int, CachedResponse] = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def lookup(self, scope: str, vector: list[float]) -> list[str] | None:
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) + 1e-12
+        now = time.time()
+        with self._lock:
+            expired = [
+                id
+                for id, entry in self._entries.items()
+                if now - entry.created_at > self.ttl
+            ]
+            for id in expired:
+                del self._entries[id]
+
+            candidates = [
+                (id, entry) for id, entry in self._entries.items() if entry.scope == scope
+            ]
+            if candidates:
+                similarities = np.stack([entry.vector for _, entry in candidates]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    id, entry = candidates[best]
+                    self._entries.move_to_end(id)
+                    self.hits += 1
+                    logger.info("Response cache hit: similarity %.3f", similarities[best])
+                    return entry.frames
+            self.misses += 1
+            return None
+
+    def store(self, scope: str, vector: list[float], frames: list[str]) -> None:
+        if not cacheable(frames):
+            return
+        normalized = np.asarray(vector, dtype=np.float32)
+        normalized /= np.linalg.norm(normalized) + 1e-12
+        with self._lock:
+            self._entries[self._next_id] = CachedResponse(
+                scope, normalized, frames, time.time()
+            )
+            self._next_id += 1
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                _ = self._entries.popitem(last=False)
+
+    def record(
+        self, frames: Iterator[str], scope: str, vector: list[float]
+    ) -> Iterator[str]:
+        """Passes the frames through, and stores them once the stream is complete."""
+        sent: list[str] = []
+        for frame in frames:
+            sent.append(frame)
+            yield frame
+        self.store(scope, vector, sent)
+
+    async def arecord(
+        self, frames: AsyncIterator[str], scope: str, vector: list[float]
+    ) -> AsyncIterator[str]:
+        sent: list[str] = []
+        async for frame in frames:
+            sent.append(frame)
+            yield frame
+        self.store(scope, vector, sent)
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def replay(frames: list[str]) -> Iterator[str]:
+    yield from frames
+
+
+async def areplay(frames: list[str]) -> AsyncIterator[str]:
+    for frame in frames:
+        yield frame
@@ -0,0 +1,195 @@
+import asyncio
+import os
+import re
+import threading
+from typing import Literal
+
+import numpy as np
+import numpy.typing as npt
+
+from .log import get_logger, log_payload
+from .metrics import timed
+from .pdf import get_embeddings, get_snapshot, get_vector_backend, get_vector_store
+from .vector_index import BLOCK_ROWS, NumpyVectorIndex, VectorBackend
+
+Route = Literal["direct", "pdf_rag", "web_search", "tools"]
+ROUTES: list[Route] = ["direct", "pdf_rag", "web_search", "tools"]
+
+# Minimum cosine similarity between a question and the centroid of the
+# corpus embeddings for the question to be sent to PDF retrieval
+ROUTER_CENTROID_THRESHOLD = float(os.getenv("ROUTER_CENTROID_THRESHOLD", "0.35"))
+
+# Cheap lexical cues, checked before the embedding gate
+TOOL_CUES = re.compile(
+    r"\b(weather|temperature|forecast|rain(ing)?|snow(ing)?|sunny|sunrise|sunset|wind)\b",
+    re.IGNORECASE,
+)
+WEB_CUES = re.compile(
+    r"\b(today|tonight|tomorrow|yesterday|latest|recent(ly)?|news|current(ly)?|"
+    + r"right now|this (week|month|year)|20[2-9]\d|price|stock|score|search the web)\b",
+    re.IGNORECASE,
+)
+PDF_CUES = re.compile(
+    r"\b(the|this) (book|author|text|document|pdf)\b|\b(chapter|page)s?\b",
+    re.IGNORECASE,
+)
+
+logger = get_logger(__name__)
+
+
+def compute_centroid(vector_backend: VectorBackend) -> npt.NDArray[np.float32] | None:
+    """The normalized mean of the stored chunk embeddings (None if there are none)."""
+    total: npt.NDArray[np.float64] | None = None
+    count = 0
+    if isinstance(vector_backend, NumpyVectorIndex):
+        blocks = (
+            np.asarray(vector_backend.matrix[start : start + BLOCK_ROWS], np.float64)
+            for start in range(0, vector_backend.count(), BLOCK_ROWS)
+        )
+    else:
+        vector_store_pdf = get_vector_store()
+        store_count = vector_store_pdf._collection.count()  # pyright: ignore[reportPrivateUsage]
+        blocks = (
+            np.asarray(
+                vector_store_pdf.get(
+                    limit=1000, offset=offset, include=["embeddings"]
+                )["embeddings"],
+                np.float64,
+            )
+            for offset in range(0, store_count, 1000)
+        )
+    for block in blocks:
+        total = block.sum(axis=0) if total is None else total + block.sum(axis=0)
+        count += len(block)
+    if total is None or count == 0:
+        return None
+    return (total / (np.linalg.norm(total) + 1e-12)).astype(np.float32)
+
+
+class CorpusCentroid:
+    """The corpus centroid, cached for the index it was computed from.
+
+    The cache is keyed on the loaded snapshot (if any) and the number of
+    stored chunks, so the centroid is recomputed after an ingestion or once a
+    new snapshot is loaded, and an empty index (before the first ingestion)
+    is never cached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key: tuple[str | None, int] | None = None
+        self._centroid: npt.NDArray[np.float32] | None = None
+
+    def __call__(self) -> npt.NDArray[np.float32] | None:
+        vector_backend = get_vector_backend()
+        snapshot = get_snapshot.peek()
+        key = (
+            snapshot.snapshot.version if snapshot is not None else None,
+            vector_backend.count(),
+        )
+        with self._lock:
+            if self._key == key:
+                return self._centroid
+            centroid = compute_centroid(vector_backend)
+            if centroid is not None:
+                self._key, self._centroid = key, centroid
+            return centroid
+
+
+corpus_centroid = CorpusCentroid()
+
+
+def centroid_similarity(vector: list[float]) -> float | None:
+    centroid = corpus_centroid()
+    if centroid is None or len(centroid) != len(vector):
+        return None
+    query = np.asarray(vector, dtype=np.float32)
+    return float(query @ centroid / (np.linalg.norm(query) + 1e-12))
+
+
+def lexical_route(query: str) -> Route | None:
+    if TOOL_CUES.search(query):
+        return "tools"
+    if WEB_CUES.search(query):
+        return "web_search"
+    if PDF_CUES.search(query):
+        return "pdf_rag"
+    return None
+
+
+def embedding_route(vector: list[float]) -> Route:
+    similarity = centroid_similarity(vector)
+    if similarity is not None and similarity >= ROUTER_CENTROID_THRESHOLD:
+        return "pdf_rag"
+    return "direct"
+
+
+@timed("routing")
+def route_query(query: str) -> Route:
+    """Picks a pipeline for a question: lexical cues first, then the corpus gate.
+
+    The embedding computed for the gate is cached, so PDF retrieval reuses it.
+    """
+    route = lexical_route(query) or embedding_route(get_embeddings().embed_query(query))
+    logger.info("Route: %s", route)
+    log_payload(logger, f"Routed to {route}", query)
+    return route
+
+
+@timed("routing")
+async def aroute_query(query: str) -> Route:
+    route = lexical_route(query)
+    if route is None:
+        embeddings = await get_embeddings.aget()
+        vector = await embeddings.aembed_query(query)
+        route = await asyncio.to_thread(embedding_route, vector)
+    logger.info("Route: %s", route)
+    log_payload(logger, f"Routed to {route}", query)
+    return route
+
+
+class RouterStats:
+    """Routing decisions, and the time spent preparing each route.
+
+    The latency saved is estimated against PDF retrieval, the pipeline that
+    STEP 2 runs for every question: each request routed elsewhere saves the
+    average preparation time of `pdf_rag` minus its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: dict[Route, int] = {route: 0 for route in ROUTES}
+        self.seconds: dict[Route, float] = {route: 0.0 for route in ROUTES}
+
+    def record(self, route: Route, seconds: float) -> None:
+        with self._lock:
+            self.counts[route] += 1
+            self.seconds[route] += seconds
+
+    def mean_seconds(self, route: Route) -> float | None:
+        if self.counts[route] == 0:
+            return None
+        return self.seconds[route] / self.counts[route]
+
+    def report(self) -> dict[str, object]:
+        with self._lock:
+            rag_seconds = self.mean_seconds("pdf_rag")
+            saved = (
+                sum(
+                    max(rag_seconds * self.counts[route] - self.seconds[route], 0.0)
+                    for route in ROUTES
+                    if route != "pdf_rag"
+                )
+                if rag_seconds is not None
+                else None
+            )
+            return {
+                "counts": dict(self.counts),
+                "mean_prepare_seconds": {
+                    route: self.mean_seconds(route) for route in ROUTES
+                },
+                "estimated_seconds_saved": saved,
+            }
+
+
+router_stats = RouterStats()
@@ -1,33 +1,103 @@
+import os
+from typing import Any
+
 from openai.types.chat import ChatCompletionMessageParam, ChatCompletionUserMessageParam
 
-from .tools import duckduckgo_search, exa_search
+from .hedge import HedgedSearch, SearchProvider
+from .log import get_logger
+from .metrics import stage
+from .passages import compact_search_results
+from .tools import (
+    aduckduckgo_search,
+    aexa_search,
+    cached_duckduckgo_search,
+    cached_exa_search,
+    duckduckgo_search,
+    exa_search,
+)
 
+DUCKDUCKGO_SEARCH_TIMEOUT = float(os.getenv("DUCKDUCKGO_SEARCH_TIMEOUT", "8"))
+EXA_SEARCH_TIMEOUT = float(os.getenv("EXA_SEARCH_TIMEOUT", "10"))
 
-def do_duckduckgo_search(
+logger = get_logger(__name__)
+
+# DuckDuckGo first (free), hedged with Exa when it is slow or failing
+web_search = HedgedSearch(
+    SearchProvider(
+        "duckduckgo",
+        duckduckgo_search,
+        aduckduckgo_search,
+        DUCKDUCKGO_SEARCH_TIMEOUT,
+        cached_duckduckgo_search,
+    ),
+    SearchProvider("exa", exa_search, aexa_search, EXA_SEARCH_TIMEOUT, cached_exa_search),
+)
+
+
+def append_search_results(
     query: str,
+    results: Any,  # pyright: ignore[reportExplicitAny, reportAny]
     messages: list[ChatCompletionMessageParam],
 ) -> list[ChatCompletionMessageParam]:
-    results = duckduckgo_search(query)
+    context = compact_search_results(query, results)  # pyright: ignore[reportAny]
+    logger.info("Context packing: %s", context.stats.report())
     messages.append(
         ChatCompletionUserMessageParam(
             role="user",
-            content=(f"Search results for '{query}':\n\n" + f"\n{str(results)}"),
+            content=(f"Search results for '{query}':\n\n" + f"\n{context.text}"),
         )
     )
 
     return messages
 
 
+def do_duckduckgo_search(
+    query: str,
+    messages: list[ChatCompletionMessageParam],
+) -> list[ChatCompletionMessageParam]:
+    results = duckduckgo_search(query)
+    return append_search_results(query, results, messages)
+
+
+async def ado_duckduckgo_search(
+    query: str,
+    messages: list[ChatCompletionMessageParam],
+) -> list[ChatCompletionMessageParam]:
+    results = await aduckduckgo_search(query)
+    return append_search_results(query, results, messages)
+
+
 def do_exa_search(
     query: str,
     messages: list[ChatCompletionMessageParam],
 ) -> list[ChatCompletionMessageParam]:
     result = exa_search(query)
-    messages.append(
-        ChatCompletionUserMessageParam(
-            role="user",
-            content=(f"Search results for '{query}':\n\n" + f"\n{str(result)}"),
-        )
-    )
+    return append_search_results(query, result, messages)
 
-    return messages
+
+async def ado_exa_search(
+    query: str,
+    messages: list[ChatCompletionMessageParam],
+) -> list[ChatCompletionMessageParam]:
+    result = await aexa_search(query)
+    return append_search_results(query, result, messages)
+
+
+def do_web_search(
+    query: str,
+    messages: list[ChatCompletionMessageParam],
+) -> list[ChatCompletionMessageParam]:
+    with stage("web_search"):
+        provider, results = web_search.search(query)
+    logger.info("%s search results: %d", provider, len(results))
+    return append_search_results(query, results, messages)
+
+
+async def ado_web_search(
+    query: str,
+    messages: list[ChatCompletionMessageParam],
+) -> list[ChatCompletionMessageParam]:
+    with stage("web_search"):
+        provider, results = await web_search.asearch(query)
+    logger.info("%s search results: %d", provider, len(results))
+    return append_search_results(query, results, messages)
@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import secrets
+import shutil
+import time
+from typing import Any, NamedTuple
+
+from .bm25 import BM25Index, numpy_chunks
+from .vector_index import (
+    ChromaBackend,
+    NumpyVectorIndex,
+    Quantization,
+    VectorBackend,
+    export_chroma,
+)
+
+# Snapshots kept when a new one is published (the current one included), so
+# that workers still serving an older one can finish with it
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))
+
+CURRENT = "CURRENT"
+
+
+class Snapshot(NamedTuple):
+    """An immutable copy of the indexes, in `<root>/<version>`.
+
+    It holds a frozen `NumpyVectorIndex` (`vectors`), a frozen `BM25Index`
+    (`bm25`) and a `snapshot.json` manifest. Snapshots are never modified once
+    published: ingestion writes to the live store, and a new snapshot is
+    published from it, so the processes serving a snapshot never wait for (or
+    see a partial write from) the ingestion.
+    """
+
+    version: str
+    path: str
+    manifest: dict[str, Any]  # pyright: ignore[reportExplicitAny]
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.path, "vectors")
+
+    @property
+    def bm25_path(self) -> str:
+        return os.path.join(self.path, "bm25")
+
+
+class OpenSnapshot(NamedTuple):
+    """A snapshot with both of its indexes open."""
+
+    snapshot: Snapshot
+    vectors: NumpyVectorIndex
+    bm25: BM25Index
+
+
+def open_snapshot(root: str, version: str) -> Snapshot:
+    path = os.path.join(root, version)
+    with open(os.path.join(path, "snapshot.json")) as f:
+        manifest: dict[str, Any] = json.load(f)  # pyright: ignore[reportExplicitAny]
+    return Snapshot(version, path, manifest)
+
+
+def current_snapshot(root: str) -> Snapshot:
+    """The snapshot that `CURRENT` points to, when this is called."""
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"No snapshot published in {root} (run `python -m api.utils.snapshot`)"
+        ) from None
+    return open_snapshot(root, version)
+
+
+def load_snapshot(
+    root: str,
+    quantization: Quantization = "none",
+    rescore_multiplier: int | None = None,
+) -> OpenSnapshot:
+    """Opens both indexes of the current snapshot, together.
+
+    Their files are memory-mapped (or loaded) as soon as they are opened, so
+    pruning the snapshot afterwards can't take them away from this process.
+    If it is pruned before that, this raises `FileNotFoundError` rather than
+    serving an empty index.
+    """
+    snapshot = current_snapshot(root)
+    return OpenSnapshot(
+        snapshot,
+        NumpyVectorIndex(
+            snapshot.vectors_path,
+            read_only=True,
+            quantization=quantization,
+            rescore_multiplier=rescore_multiplier,
+        ),
+        BM25Index(snapshot.bm25_path, read_only=True),
+    )
+
+
+def list_snapshots(root: str) -> list[str]:
+    """Published versions, oldest first (versions start with a timestamp)."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(root)
+        if os.path.exists(os.path.join(root, name, "snapshot.json"))
+    )
+
+
+def publish_snapshot(
+    root: str,
+    vector_backend: VectorBackend,
+    lexical_index: BM25Index,
+    keep: int = SNAPSHOT_KEEP,
+) -> Snapshot:
+    """Copies the indexes to a new snapshot, then makes it the current one.
+
+    The snapshot is built in a temporary directory, renamed into place, and
+    `CURRENT` is replaced atomically, so readers only ever see complete
+    snapshots. The oldest snapshots beyond `keep` are then deleted.
+    """
+    os.makedirs(root, exist_ok=True)
+    timestamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    version = f"{timestamp}-{secrets.token_hex(3)}"
+    tmp_path = os.path.join(root, f".tmp-{version}")
+    started_at = time.monotonic()
+    try:
+        if isinstance(vector_backend, NumpyVectorIndex):
+            vectors = vector_backend.copy_to(os.path.join(tmp_path, "vectors"))
+        elif isinstance(vector_backend, ChromaBackend):
+            vectors = NumpyVectorIndex(os.path.join(tmp_path, "vectors"))
+            _ = export_chroma(vector_backend.store, vectors)
+        else:
+            raise TypeError(f"Can't snapshot a {type(vector_backend).__name__}")
+        vectors.freeze()
+
+        bm25 = lexical_index.copy_to(os.path.join(tmp_path, "bm25"))
+        if bm25.count() < vectors.count():
+            # The lexical index was never built (or is behind): catch it up
+            for ids, chunks in numpy_chunks(vectors):
+                bm25.add(ids, chunks)
+        bm25.freeze()
+
+        manifest = {
+            "version": version,
+            "created_at": time.time(),
+            "source": type(vector_backend).__name__,
+            "count": vectors.count(),
+            "dim": vectors.dim,
+            "dtype": vectors.dtype,
+            "bm25_count": bm25.count(),
+            "build_seconds": time.monotonic() - started_at,
+        }
+        with open(os.path.join(tmp_path, "snapshot.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp_path, os.path.join(root, version))
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    pointer_path = os.path.join(root, f"{CURRENT}.tmp")
+    with open(pointer_path, "w") as f:
+        _ = f.write(version + "\n")
+    os.replace(pointer_path, os.path.join(root, CURRENT))
+
+    for old in list_snapshots(root)[:-keep] if keep > 0 else []:
+        if old != version:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return open_snapshot(root, version)
+
+
+def main() -> None:
+    from .pdf import (
+        SNAPSHOT_PATH,
+        VECTOR_BACKEND,
+        get_lexical_index,
+        get_vector_backend,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Publishes a read-only snapshot of the vector store and the "
+        + "BM25 index, for VECTOR_BACKEND=snapshot."
+    )
+    _ = parser.add_argument(
+        "command", nargs="?", default="publish", choices=["publish", "list"]
+    )
+    _ = parser.add_argument("--root", default=SNAPSHOT_PATH)
+    _ = parser.add_argument("--keep", type=int, default=SNAPSHOT_KEEP)
+    args = parser.parse_args()
+
+    if args.command == "list":  # pyright: ignore[reportAny]
+        try:
+            current = current_snapshot(args.root).version  # pyright: ignore[reportAny]
+        except FileNotFoundError:
+            current = None
+        for version in list_snapshots(args.root):  # pyright: ignore[reportAny]
+            manifest = open_snapshot(args.root, version).manifest  # pyright: ignore[reportAny]
+            marker = "*" if version == current else " "
+            print(f"{marker} {version}  {manifest['count']} chunks")
+        return
+
+    if VECTOR_BACKEND == "snapshot":
+        parser.error("Publish from the live store (VECTOR_BACKEND=chroma or numpy)")
+    snapshot = publish_snapshot(
+        args.root, get_vector_backend(), get_lexical_index(), args.keep  # pyright: ignore[reportAny]
+    )
+    print(
+        f"Published snapshot {snapshot.version} ({snapshot.manifest['count']} chunks) "
+        + f"in {snapshot.manifest['build_seconds']:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
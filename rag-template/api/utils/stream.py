@@ -1,85 +1,245 @@
+import asyncio
 import json
-from typing import Any, Callable, TypedDict
+import time
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import Future
 
-from langchain_core.utils import try_load_from_hub
+from openai import AsyncStream
 from openai._streaming import Stream
-from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
-from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, Choice
 
-ToolsDict = dict[str, tuple[ChatCompletionToolParam, Callable[..., Any]]]  # pyright: ignore[reportExplicitAny]
+from .executor import (
+    DraftToolCall,
+    ToolsDict,
+    arguments_complete,
+    arun_tool_call,
+    arun_tool_calls,
+    run_tool_calls,
+    start_tool_call,
+    tool_call_result,
+)
+from .log import get_logger
+from .metrics import Trace, observe_stage
 
+logger = get_logger(__name__)
 
-class DraftToolCall(TypedDict):
-    id: str
-    name: str
-    arguments: str
+
+def text_frame(text: str | None) -> str:
+    return "0:{text}\n".format(text=json.dumps(text))
+
+
+def tool_call_frame(tool_call: DraftToolCall) -> str:
+    return '9:{{"toolCallId":"{id}","toolName":"{name}","args":{args}}}\n'.format(
+        id=tool_call["id"],
+        name=tool_call["name"],
+        args=tool_call["arguments"],
+    )
+
+
+def tool_result_frame(tool_call: DraftToolCall, result: str) -> str:
+    return 'a:{{"toolCallId":"{id}","toolName":"{name}","args":{args},"result":{result}}}\n'.format(
+        id=tool_call["id"],
+        name=tool_call["name"],
+        args=tool_call["arguments"],
+        result=result,
+    )
+
+
+def finish_frame(
+    has_tool_calls: bool, prompt_tokens: int, completion_tokens: int
+) -> str:
+    return 'e:{{"finishReason":"{reason}","usage":{{"promptTokens":{prompt},"completionTokens":{completion}}},"isContinued":false}}\n'.format(
+        reason="tool-calls" if has_tool_calls else "stop",
+        prompt=prompt_tokens,
+        completion=completion_tokens,
+    )
+
+
+def add_tool_call_delta(choice: Choice, draft_tool_calls: list[DraftToolCall]) -> None:
+    for tool_call in choice.delta.tool_calls or []:
+        id = tool_call.id
+        function = tool_call.function
+        name = (function.name if function else "") or ""
+        arguments = (function.arguments if function else "") or ""
+
+        if id is not None:
+            draft_tool_calls.append({"id": id, "name": name, "arguments": ""})
+
+        else:
+            draft_tool_calls[-1]["arguments"] += arguments
+
+
+def ready_tool_calls(draft_tool_calls: list[DraftToolCall]) -> list[DraftToolCall]:
+    """Drafts whose arguments will not change anymore.
+
+    A draft is final once the next tool call has begun, or as soon as its
+    arguments parse as a complete JSON object.
+    """
+    if not draft_tool_calls:
+        return []
+    last = draft_tool_calls[-1]
+    ready = draft_tool_calls[:-1]
+    if arguments_complete(last["arguments"]):
+        ready.append(last)
+    return ready
+
+
+def usage_frame(chunk: ChatCompletionChunk, has_tool_calls: bool) -> str:
+    usage = chunk.usage
+    prompt_tokens = usage.prompt_tokens if usage else 0
+    completion_tokens = usage.completion_tokens if usage else 0
+    return finish_frame(has_tool_calls, prompt_tokens, completion_tokens)
 
 
 def stream_text(
     stream: Stream[ChatCompletionChunk],
     tools: ToolsDict,
-):
+    speculative: bool = False,
+) -> Iterator[str]:
+    """Converts an OpenAI stream into the Vercel AI data stream protocol.
+
+    With `speculative=True`, each tool starts running as soon as its
+    arguments are final instead of after the whole model stream, and the
+    results are emitted in the original tool-call order.
+    """
     draft_tool_calls: list[DraftToolCall] = []
-    draft_tool_calls_index = -1
-
-    for chunk in stream:
-        for choice in chunk.choices:
-            if choice.finish_reason == "stop":
-                continue
-
-            elif choice.finish_reason == "tool_calls":
-                for tool_call in draft_tool_calls:
-                    yield '9:{{"toolCallId":"{id}","toolName":"{name}","args":{args}}}\n'.format(
-                        id=tool_call["id"],
-                        name=tool_call["name"],
-                        args=tool_call["arguments"],
-                    )
-
-                for tool_call in draft_tool_calls:
-                    tool_result = tools[tool_call["name"]][1](  # pyright: ignore[reportAny]
-                        **json.loads(tool_call["arguments"])
-                    )
-
-                    try:
-                        result = json.dumps(tool_result)
-                    except Exception as e:
-                        result = str(e)
-
-                    yield 'a:{{"toolCallId":"{id}","toolName":"{name}","args":{args},"result":{result}}}\n'.format(
-                        id=tool_call["id"],
-                        name=tool_call["name"],
-                        args=tool_call["arguments"],
-                        result=result,
-                    )
-
-            elif choice.delta.tool_calls:
-                for tool_call in choice.delta.tool_calls:
-                    id = tool_call.id
-                    function = tool_call.function
-                    name = (function.name if function else "") or ""
-                    arguments = (function.arguments if function else "") or ""
-
-                    if id is not None:
-                        draft_tool_calls_index += 1
-                        draft_tool_calls.append(
-                            {"id": id, "name": name, "arguments": ""}
+    started: dict[str, tuple[Future[str], float]] = {}
+
+    try:
+        for chunk in stream:
+            for choice in chunk.choices:
+                if choice.finish_reason == "stop":
+                    continue
+
+                elif choice.finish_reason == "tool_calls":
+                    for tool_call in draft_tool_calls:
+                        yield tool_call_frame(tool_call)
+
+                    if not speculative:
+                        for tool_call, result in run_tool_calls(
+                            tools, draft_tool_calls
+                        ):
+                            yield tool_result_frame(tool_call, result)
+                        continue
+
+                    for tool_call in draft_tool_calls:
+                        if tool_call["id"] not in started:
+                            started[tool_call["id"]] = start_tool_call(
+                                tools, tool_call
+                            )
+                    for tool_call in draft_tool_calls:
+                        future, deadline = started[tool_call["id"]]
+                        yield tool_result_frame(
+                            tool_call, tool_call_result(tool_call, future, deadline)
                         )
 
-                    else:
-                        draft_tool_calls[draft_tool_calls_index]["arguments"] += (
-                            arguments
-                        )
+                elif choice.delta.tool_calls:
+                    add_tool_call_delta(choice, draft_tool_calls)
+                    if speculative:
+                        for tool_call in ready_tool_calls(draft_tool_calls):
+                            if tool_call["id"] not in started:
+                                started[tool_call["id"]] = start_tool_call(
+                                    tools, tool_call
+                                )
+
+                else:
+                    yield text_frame(choice.delta.content)
 
-            else:
-                yield "0:{text}\n".format(text=json.dumps(choice.delta.content))
+            if chunk.choices == []:
+                yield usage_frame(chunk, len(draft_tool_calls) > 0)
+    finally:
+        for future, _ in started.values():
+            _ = future.cancel()
 
-        if chunk.choices == []:
-            usage = chunk.usage
-            prompt_tokens = usage.prompt_tokens if usage else 0
-            completion_tokens = usage.completion_tokens if usage else 0
 
-            yield 'e:{{"finishReason":"{reason}","usage":{{"promptTokens":{prompt},"completionTokens":{completion}}},"isContinued":false}}\n'.format(
-                reason="tool-calls" if len(draft_tool_calls) > 0 else "stop",
-                prompt=prompt_tokens,
-                completion=completion_tokens,
-            )
+async def astream_text(
+    stream: AsyncStream[ChatCompletionChunk],
+    tools: ToolsDict,
+    speculative: bool = False,
+) -> AsyncIterator[str]:
+    """Async-generator version of `stream_text`, for use with `AsyncOpenAI`."""
+    draft_tool_calls: list[DraftToolCall] = []
+    started: dict[str, asyncio.Task[tuple[DraftToolCall, str]]] = {}
+
+    try:
+        async for chunk in stream:
+            for choice in chunk.choices:
+                if choice.finish_reason == "stop":
+                    continue
+
+                elif choice.finish_reason == "tool_calls":
+                    for tool_call in draft_tool_calls:
+                        yield tool_call_frame(tool_call)
+
+                    if not speculative:
+                        async for tool_call, result in arun_tool_calls(
+                            tools, draft_tool_calls
+                        ):
+                            yield tool_result_frame(tool_call, result)
+                        continue
+
+                    for tool_call in draft_tool_calls:
+                        if tool_call["id"] not in started:
+                            started[tool_call["id"]] = asyncio.create_task(
+                                arun_tool_call(tools, tool_call)
+                            )
+                    for tool_call in draft_tool_calls:
+                        _, result = await started[tool_call["id"]]
+                        yield tool_result_frame(tool_call, result)
+
+                elif choice.delta.tool_calls:
+                    add_tool_call_delta(choice, draft_tool_calls)
+                    if speculative:
+                        for tool_call in ready_tool_calls(draft_tool_calls):
+                            if tool_call["id"] not in started:
+                                started[tool_call["id"]] = asyncio.create_task(
+                                    arun_tool_call(tools, tool_call)
+                                )
+
+                else:
+                    yield text_frame(choice.delta.content)
+
+            if chunk.choices == []:
+                yield usage_frame(chunk, len(draft_tool_calls) > 0)
+    finally:
+        for task in started.values():
+            _ = task.cancel()
+
+
+def finish_trace(trace: Trace, llm_started_at: float) -> None:
+    observe_stage("llm_stream", time.monotonic() - llm_started_at, trace)
+    observe_stage("request", time.monotonic() - trace.started_at, trace)
+    logger.info("%s", trace.summary())
+
+
+def trace_frames(
+    frames: Iterator[str], trace: Trace, llm_started_at: float
+) -> Iterator[str]:
+    """Records the model's time to first frame and total stream time.
+
+    The trace is passed explicitly, since the response is streamed from
+    another context than the one that handled the request.
+    """
+    first = True
+    try:
+        for frame in frames:
+            if first:
+                first = False
+                observe_stage("llm_first_token", time.monotonic() - llm_started_at, trace)
+            yield frame
+    finally:
+        finish_trace(trace, llm_started_at)
+
+
+async def atrace_frames(
+    frames: AsyncIterator[str], trace: Trace, llm_started_at: float
+) -> AsyncIterator[str]:
+    first = True
+    try:
+        async for frame in frames:
+            if first:
+                first = False
+                observe_stage("llm_first_token", time.monotonic() - llm_started_at, trace)
+            yield frame
+    finally:
+        finish_trace(trace, llm_started_at)
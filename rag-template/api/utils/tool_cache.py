@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Generic, TypeVar
+
+from .coalesce import SingleFlight
+
+T = TypeVar("T")
+
+# Seconds a result is reused: weather changes within the hour, search
+# results within days
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "600"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "21600"))
+TOOL_CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", "1024"))
+
+# Size of the weather grid, in degrees (0.05° is about 5 km)
+WEATHER_GRID = float(os.getenv("WEATHER_GRID", "0.05"))
+
+
+def snap_to_grid(value: float, grid: float = WEATHER_GRID) -> float:
+    return round(round(value / grid) * grid, 6)
+
+
+class ToolCache(Generic[T]):
+    """TTL cache for tool results, with single-flight lookups.
+
+    Concurrent calls for the same key share one upstream request (see
+    `SingleFlight`): the first caller runs it, and the others wait for its
+    result. `None` results (the tools' way of reporting an error) and
+    exceptions are not cached.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int = TOOL_CACHE_SIZE):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, T]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight[T](name)
+        self.hits = 0
+
+    def get(self, key: str) -> T | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() > expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: T) -> None:
+        if value is None:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                _ = self._entries.popitem(last=False)
+
+    def get_or_call(self, key: str, fn: Callable[[], T]) -> T:
+        value = self.get(key)
+        if value is not None:
+            return value
+        return self._flight.call(key, lambda: self._fill(key, fn()))
+
+    async def aget_or_call(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        value = self.get(key)
+        if value is not None:
+            return value
+        return await self._flight.acall(key, lambda: self._afill(key, fn))
+
+    def _fill(self, key: str, value: T) -> T:
+        self.set(key, value)
+        return value
+
+    async def _afill(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        return self._fill(key, await fn())
+
+    def stats(self) -> dict[str, int | float]:
+        misses, coalesced = self._flight.calls, self._flight.coalesced
+        lookups = self.hits + misses + coalesced
+        return {
+            "ttl": self.ttl,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": misses,
+            "coalesced": coalesced,
+            "hit_rate": (self.hits + coalesced) / lookups if lookups else 0.0,
+        }
@@ -1,31 +1,127 @@
+import asyncio
+import os
 from typing import Any, cast
 
+import httpx
 import requests
-from duckduckgo_search import DDGS
-from exa_py import Exa
-import os
+
+from .clients import (
+    DUCKDUCKGO_HOST,
+    EXA_HOST,
+    ahttp_get,
+    get_ddgs,
+    get_exa_client,
+    host_limiter,
+    http_get,
+)
+from .embedding_cache import normalize_query
+from .hedge import SearchError
+from .log import get_logger
+from .tool_cache import (
+    SEARCH_CACHE_TTL,
+    WEATHER_CACHE_TTL,
+    ToolCache,
+    snap_to_grid,
+)
+
+duckduckgo_cache = ToolCache[list[dict[str, str]]](
+    "duckduckgo_search", SEARCH_CACHE_TTL
+)
+exa_cache = ToolCache[list[dict[str, str]]]("exa_search", SEARCH_CACHE_TTL)
+weather_cache = ToolCache[dict[str, Any]]("get_current_weather", WEATHER_CACHE_TTL)  # pyright: ignore[reportExplicitAny]
+
+# Overridden by the load tests in `bench/`, which use a local stand-in
+WEATHER_API_URL = os.getenv("WEATHER_API_URL", "https://api.open-meteo.com/v1/forecast")
+
+logger = get_logger(__name__)
+
+
+def tool_cache_stats() -> dict[str, dict[str, int | float]]:
+    return {
+        cache.name: cache.stats() for cache in (duckduckgo_cache, exa_cache, weather_cache)
+    }
+
+
+def fetch_duckduckgo_search(query: str) -> list[dict[str, str]]:
+    from duckduckgo_search.exceptions import DuckDuckGoSearchException
+
+    with host_limiter.limit(DUCKDUCKGO_HOST):
+        try:
+            return get_ddgs().text(query, max_results=20)
+        except DuckDuckGoSearchException as e:
+            raise SearchError(f"DuckDuckGo search failed: {e}") from e
 
 
 def duckduckgo_search(query: str) -> list[dict[str, str]]:
-    return DDGS().text(query, max_results=20)
+    return duckduckgo_cache.get_or_call(
+        normalize_query(query), lambda: fetch_duckduckgo_search(query)
+    )
+
+
+def cached_duckduckgo_search(query: str) -> list[dict[str, str]] | None:
+    return duckduckgo_cache.get(normalize_query(query))
+
+
+async def aduckduckgo_search(query: str) -> list[dict[str, str]]:
+    cached = cached_duckduckgo_search(query)
+    if cached is not None:
+        return cached
+    # DDGS has no async API, so we run it in a worker thread
+    return await asyncio.to_thread(duckduckgo_search, query)
+
+
+def fetch_exa_search(query: str) -> list[dict[str, str]]:
+    with host_limiter.limit(EXA_HOST):
+        try:
+            return cast(
+                list[dict[str, str]],
+                get_exa_client()
+                .search_and_contents(query, text=True, type="keyword")
+                .results,
+            )
+        except ValueError as e:
+            # exa_py reports API errors (and a missing API key) as ValueError
+            raise SearchError(f"Exa search failed: {e}") from e
 
 
 def exa_search(query: str) -> list[dict[str, str]]:
-    return cast(
-        list[dict[str, str]],
-        Exa(api_key=os.getenv("EXA_API_KEY"))
-        .search_and_contents(query, text=True, type="keyword")
-        .results,
-    )
+    return exa_cache.get_or_call(normalize_query(query), lambda: fetch_exa_search(query))
 
 
-def get_current_weather(latitude: float, longitude: float) -> dict[str, Any] | None:  # pyright: ignore[reportExplicitAny]
+def cached_exa_search(query: str) -> list[dict[str, str]] | None:
+    return exa_cache.get(normalize_query(query))
+
+
+async def aexa_search(query: str) -> list[dict[str, str]]:
+    cached = cached_exa_search(query)
+    if cached is not None:
+        return cached
+    return await asyncio.to_thread(exa_search, query)
+
+
+def weather_url(latitude: float, longitude: float) -> str:
     # Format the URL with proper parameter substitution
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current=temperature_2m&hourly=temperature_2m&daily=sunrise,sunset&timezone=auto"
+    return f"{WEATHER_API_URL}?latitude={latitude}&longitude={longitude}&current=temperature_2m&hourly=temperature_2m&daily=sunrise,sunset&timezone=auto"
+
+
+def weather_key(latitude: float, longitude: float) -> str:
+    # Nearby coordinates share a grid cell, and thus a cache entry
+    return f"{snap_to_grid(latitude)},{snap_to_grid(longitude)}"
+
+
+def get_current_weather(latitude: float, longitude: float) -> dict[str, Any] | None:  # pyright: ignore[reportExplicitAny]
+    return weather_cache.get_or_call(
+        weather_key(latitude, longitude),
+        lambda: fetch_current_weather(snap_to_grid(latitude), snap_to_grid(longitude)),  # pyright: ignore[reportArgumentType]
+    )
+
+
+def fetch_current_weather(latitude: float, longitude: float) -> dict[str, Any] | None:  # pyright: ignore[reportExplicitAny]
+    url = weather_url(latitude, longitude)
 
     try:
         # Make the API call
-        response = requests.get(url)
+        response = http_get(url)
 
         # Raise an exception for bad status codes
         response.raise_for_status()
@@ -35,5 +131,29 @@ def get_current_weather(latitude: float, longitude: float) -> dict[str, Any] | N
 
     except requests.RequestException as e:
         # Handle any errors that occur during the request
-        print(f"Error fetching weather data: {e}")
+        logger.warning("Error fetching weather data: %s", e)
+        return None
+
+
+async def aget_current_weather(
+    latitude: float, longitude: float
+) -> dict[str, Any] | None:  # pyright: ignore[reportExplicitAny]
+    return await weather_cache.aget_or_call(
+        weather_key(latitude, longitude),
+        lambda: afetch_current_weather(snap_to_grid(latitude), snap_to_grid(longitude)),  # pyright: ignore[reportArgumentType]
+    )
+
+
+async def afetch_current_weather(
+    latitude: float, longitude: float
+) -> dict[str, Any] | None:  # pyright: ignore[reportExplicitAny]
+    url = weather_url(latitude, longitude)
+
+    try:
+        response = await ahttp_get(url)
+        _ = response.raise_for_status()
+        return response.json()  # pyright: ignore[reportAny]
+
+    except httpx.HTTPError as e:
+        logger.warning("Error fetching weather data: %s", e)
         return None
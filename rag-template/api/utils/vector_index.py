@@ -0,0 +1,661 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Literal, Protocol
+
+import numpy as np
+import numpy.typing as npt
+from langchain_core.documents.base import Document
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+
+Hits = list[tuple[Document, float]]
+StorageDtype = Literal["float32", "float16"]
+Quantization = Literal["none", "int8", "binary"]
+
+# Candidates rescored with full-precision vectors, as a multiple of k
+RESCORE_MULTIPLIERS: dict[str, int] = {"int8": 4, "binary": 10}
+
+# Rows processed at once when scanning, to bound temporary memory
+BLOCK_ROWS = 65536
+
+# Embeddings of the latest Chroma hits kept for reranking, so the candidates'
+# vectors come with the query instead of a second round trip
+CHROMA_HIT_VECTORS = int(os.getenv("CHROMA_HIT_VECTORS", "4096"))
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits: npt.NDArray[np.uint8]) -> npt.NDArray[np.uint8]:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bits)  # pyright: ignore[reportAttributeAccessIssue, reportUnknownMemberType, reportUnknownVariableType]
+    return _POPCOUNT[bits]
+
+
+def normalize(matrix: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    return matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12)
+
+
+def quantize(
+    matrix: npt.NDArray[np.float32],
+) -> tuple[npt.NDArray[np.int8], npt.NDArray[np.float32], npt.NDArray[np.uint8]]:
+    """Returns int8 codes with their per-row scales, and packed sign bits."""
+    scales = np.abs(matrix).max(axis=1) / 127 + 1e-12
+    int8_codes = np.round(matrix / scales[:, None]).astype(np.int8)
+    binary_codes = np.packbits(matrix > 0, axis=1)
+    return int8_codes, scales.astype(np.float32), binary_codes
+
+
+def top_rows(scores: npt.NDArray[np.float32], k: int) -> list[npt.NDArray[np.intp]]:
+    """For each column, the rows of the k highest scores, best first."""
+    top = np.argpartition(-scores, k - 1, axis=0)[:k]
+    return [
+        top[:, column][np.argsort(-scores[top[:, column], column])]
+        for column in range(scores.shape[1])
+    ]
+
+
+def copy_prefix(source: str, target: str, size: int) -> None:
+    """Copies the first `size` bytes of a file (its committed part)."""
+    with open(target, "wb") as dst:
+        if size == 0:
+            return
+        with open(source, "rb") as src:
+            remaining = size
+            while remaining > 0:
+                block = src.read(min(remaining, 1 << 24))
+                if not block:
+                    raise ValueError(f"{source} is shorter than its header says")
+                _ = dst.write(block)
+                remaining -= len(block)
+
+
+class VectorBackend(Protocol):
+    """What retrieval and ingestion need from a vector store.
+
+    Scores are cosine similarities (higher is better).
+    """
+
+    def search(self, vectors: list[list[float]], k: int) -> list[Hits]: ...
+
+    def existing_ids(self, ids: list[str]) -> set[str]: ...
+
+    def upsert(
+        self, ids: list[str], chunks: list[Document], vectors: list[list[float]]
+    ) -> None: ...
+
+    def count(self) -> int: ...
+
+    def vectors(self, ids: list[str]) -> npt.NDArray[np.float32]:
+        """The stored unit vectors of some chunks, in the order of `ids`."""
+        ...
+
+    def warm_up(self) -> None:
+        """Loads the index (with a first search), so requests don't wait for it."""
+        ...
+
+
+class ChromaBackend:
+    def __init__(self, store: "Chroma", hit_vectors: int = CHROMA_HIT_VECTORS):
+        self.store = store
+        self.hit_vectors = hit_vectors
+        self._lock = threading.Lock()
+        self._hit_vectors: OrderedDict[str, npt.NDArray[np.float32]] = OrderedDict()
+
+    def _remember(self, ids: list[str], embeddings: Any) -> None:  # pyright: ignore[reportExplicitAny]
+        if self.hit_vectors <= 0:
+            return
+        with self._lock:
+            for id, embedding in zip(ids, embeddings):  # pyright: ignore[reportAny]
+                self._hit_vectors[id] = np.asarray(embedding, dtype=np.float32)
+                self._hit_vectors.move_to_end(id)
+            while len(self._hit_vectors) > self.hit_vectors:
+                _ = self._hit_vectors.popitem(last=False)
+
+    def search(self, vectors: list[list[float]], k: int) -> list[Hits]:
+        results = self.store._collection.query(  # pyright: ignore[reportPrivateUsage]
+            query_embeddings=vectors,  # pyright: ignore[reportArgumentType]
+            n_results=k,
+            include=["documents", "metadatas", "distances", "embeddings"],  # pyright: ignore[reportArgumentType]
+        )
+        hits: list[Hits] = []
+        for ids, texts, metadatas, distances, embeddings in zip(
+            results["ids"],
+            results["documents"] or [],
+            results["metadatas"] or [],
+            results["distances"] or [],
+            results["embeddings"] if results["embeddings"] is not None else [],  # pyright: ignore[reportAny]
+        ):
+            self._remember(ids, embeddings)
+            # The collection uses squared L2 distances, and OpenAI embeddings
+            # are unit vectors, so the cosine similarity is 1 - d / 2
+            hits.append(
+                [
+                    (
+                        Document(id=id, page_content=text, metadata=dict(metadata)),
+                        1.0 - distance / 2,
+                    )
+                    for id, text, metadata, distance in zip(
+                        ids, texts, metadatas, distances
+                    )
+                ]
+            )
+        return hits
+
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        return set(self.store.get(ids=ids, include=[])["ids"])  # pyright: ignore[reportAny]
+
+    def upsert(
+        self, ids: list[str], chunks: list[Document], vectors: list[list[float]]
+    ) -> None:
+        self.store._collection.upsert(  # pyright: ignore[reportPrivateUsage]
+            ids=ids,
+            embeddings=vectors,  # pyright: ignore[reportArgumentType]
+            metadatas=[chunk.metadata for chunk in chunks],  # pyright: ignore[reportArgumentType]
+            documents=[chunk.page_content for chunk in chunks],
+        )
+
+    def count(self) -> int:
+        return self.store._collection.count()  # pyright: ignore[reportPrivateUsage]
+
+    def vectors(self, ids: list[str]) -> npt.NDArray[np.float32]:
+        with self._lock:
+            by_id = {id: self._hit_vectors[id] for id in ids if id in self._hit_vectors}
+        missing = [id for id in ids if id not in by_id]
+        if missing:
+            # Only candidates that didn't come from `search` (lexical hits)
+            result = self.store.get(ids=missing, include=["embeddings"])
+            # The collection returns the rows in its own order
+            by_id.update(zip(result["ids"], result["embeddings"]))  # pyright: ignore[reportAny]
+        dim = len(next(iter(by_id.values()))) if by_id else 0  # pyright: ignore[reportAny]
+        return normalize(
+            np.asarray(
+                [by_id.get(id, np.zeros(dim)) for id in ids], dtype=np.float32  # pyright: ignore[reportAny]
+            ).reshape(len(ids), dim)
+        )
+
+    def warm_up(self) -> None:
+        # The HNSW index is only loaded by the first query
+        result = self.store.get(limit=1, include=["embeddings"])
+        if result["ids"]:
+            _ = self.search([list(result["embeddings"][0])], 1)  # pyright: ignore[reportAny]
+
+
+def map_file(
+    path: str, name: str, dtype: npt.DTypeLike, length: int
+) -> npt.NDArray[Any]:  # pyright: ignore[reportExplicitAny]
+    """Memory-maps the first `length` items of a file, read-only."""
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(os.path.join(path, name), dtype=dtype, mode="r", shape=(length,))
+
+
+def write_mapped_metadata(path: str, name: str, size: int, ids: list[str]) -> int:
+    """Writes the files `MappedMetadata` reads for `<name>.jsonl`.
+
+    Only the first `size` (committed) bytes are indexed. Returns the width
+    of the stored IDs.
+    """
+    lines = (
+        np.fromfile(os.path.join(path, f"{name}.jsonl"), np.uint8, size)
+        if ids
+        else np.zeros(0, np.uint8)
+    )
+    ends = np.flatnonzero(lines == ord("\n")) + 1
+    if len(ends) != len(ids):
+        raise ValueError(f"{path}/{name}.jsonl doesn't match its header")
+    offsets = np.concatenate([[0], ends]).astype(np.uint64)
+    offsets.tofile(os.path.join(path, f"{name}.offsets"))
+
+    id_width = max((len(id.encode()) for id in ids), default=1)
+    sorted_ids = np.asarray([id.encode() for id in ids], dtype=f"S{id_width}")
+    order = np.argsort(sorted_ids, kind="stable")
+    sorted_ids[order].tofile(os.path.join(path, "ids.sorted"))
+    order.astype(np.int64).tofile(os.path.join(path, "ids.rows"))
+    return id_width
+
+
+class MappedMetadata:
+    """The rows of a frozen index, read from disk on demand.
+
+    `<name>.offsets` holds where each row starts in `<name>.jsonl`, and
+    `ids.sorted` and `ids.rows` hold the IDs in sorted order with their rows,
+    so that IDs are found with a binary search. Unlike Python lists, these
+    memory-mapped files are shared by all the processes serving the index.
+    """
+
+    def __init__(self, path: str, count: int, id_width: int, name: str = "meta"):
+        self.count = count
+        self.offsets = (
+            map_file(path, f"{name}.offsets", np.uint64, count + 1)
+            if count
+            else np.zeros(1, dtype=np.uint64)
+        )
+        self.lines = map_file(path, f"{name}.jsonl", np.uint8, int(self.offsets[-1]))
+        self.sorted_ids = map_file(path, "ids.sorted", f"S{id_width}", count)
+        self.sorted_rows = map_file(path, "ids.rows", np.int64, count)
+
+    def row(self, row: int) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return json.loads(self.lines[start:end].tobytes())  # pyright: ignore[reportAny]
+
+    def find(self, ids: list[str]) -> list[int | None]:
+        if self.count == 0 or not ids:
+            return [None for _ in ids]
+        keys = [id.encode() for id in ids]
+        # Longer IDs can't be stored, and would be truncated by the dtype
+        fits = np.asarray([len(key) <= self.sorted_ids.itemsize for key in keys])
+        needles = np.asarray(keys, dtype=self.sorted_ids.dtype)
+        positions = np.minimum(
+            np.searchsorted(self.sorted_ids, needles), self.count - 1
+        )
+        found = fits & (self.sorted_ids[positions] == needles)
+        return [
+            int(self.sorted_rows[position]) if hit else None
+            for position, hit in zip(positions, found)
+        ]
+
+
+class NumpyVectorIndex:
+    """Vector index backed by memory-mapped matrices.
+
+    The directory holds:
+    - `vectors.bin`: the unit-normalized vectors, one row per chunk, as a raw
+      float32 or float16 matrix that is memory-mapped for search;
+    - `int8.bin`, `int8_scales.bin` and `binary.bin`: quantized copies of the
+      vectors (scalar int8 with a scale per row, and sign bits);
+    - `meta.jsonl`: one line per row with the chunk ID, text and metadata;
+    - `index.json`: the dimension, dtype, and the number of committed rows.
+
+    All data files are append-only and `index.json` is replaced atomically
+    after each write, so a crash never leaves a partially written row visible.
+
+    A frozen index (see `freeze`) is read-only, and its metadata is read
+    through `MappedMetadata` rather than loaded, so everything it holds is
+    memory-mapped and shared between the processes that open it.
+
+    With `quantization="none"`, search is exact. Otherwise, candidates are
+    selected with an int8 dot product or a Hamming distance scan over the
+    quantized vectors, oversampled by `rescore_multiplier`, and rescored with
+    the full-precision rows (only those pages of `vectors.bin` are read).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dim: int = 3072,
+        dtype: StorageDtype = "float32",
+        read_only: bool = False,
+        quantization: Quantization = "none",
+        rescore_multiplier: int | None = None,
+    ):
+        self.path = path
+        self.read_only = read_only
+        self.quantization: Quantization = quantization
+        self.rescore_multiplier = rescore_multiplier or RESCORE_MULTIPLIERS.get(
+            quantization, 1
+        )
+        self._lock = threading.Lock()
+
+        header_path = os.path.join(path, "index.json")
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                header: dict[str, Any] = json.load(f)  # pyright: ignore[reportExplicitAny]
+        elif read_only:
+            raise FileNotFoundError(f"No vector index in {path}")
+        else:
+            header = {"dim": dim, "dtype": dtype, "count": 0, "meta_bytes": 0}
+            os.makedirs(path, exist_ok=True)
+
+        self.dim: int = header["dim"]
+        self.dtype: StorageDtype = header["dtype"]
+        self._count: int = header["count"]
+        self._meta_bytes: int = header["meta_bytes"]
+        self.frozen: bool = header.get("frozen", False)
+        if self.frozen:
+            self.read_only = True
+        self.ids: list[str] = []
+        self.texts: list[str] = []
+        self.metadatas: list[dict[str, Any]] = []  # pyright: ignore[reportExplicitAny]
+        self._mapped: MappedMetadata | None = None
+        if self.frozen:
+            self._mapped = MappedMetadata(path, self._count, header["id_width"])
+        else:
+            self._load_meta()
+        self._rows = {id: row for row, id in enumerate(self.ids)}
+        self.matrix = self._map_vectors()
+        self._codes_in_memory: (
+            tuple[npt.NDArray[np.int8], npt.NDArray[np.float32], npt.NDArray[np.uint8]]
+            | None
+        ) = None
+        if self._count > 0 and not header.get("codes"):
+            # Indexes written before quantization support have no codes yet
+            self._build_codes()
+        self._map_codes()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load_meta(self) -> None:
+        if self._count == 0:
+            return
+        with open(self._file("meta.jsonl"), "rb") as f:
+            for line in f.read(self._meta_bytes).splitlines():
+                row: dict[str, Any] = json.loads(line)  # pyright: ignore[reportExplicitAny]
+                self.ids.append(row["id"])  # pyright: ignore[reportAny]
+                self.texts.append(row["text"])  # pyright: ignore[reportAny]
+                self.metadatas.append(row["metadata"])  # pyright: ignore[reportAny]
+
+    def _map(
+        self, name: str, dtype: npt.DTypeLike, columns: int | None = None
+    ) -> npt.NDArray[Any]:  # pyright: ignore[reportExplicitAny]
+        shape = (self._count,) if columns is None else (self._count, columns)
+        if self._count == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode="r", shape=shape)
+
+    def _map_vectors(self) -> npt.NDArray[np.floating[Any]]:  # pyright: ignore[reportExplicitAny]
+        return self._map("vectors.bin", self.dtype, self.dim)
+
+    def _map_codes(self) -> None:
+        if self._codes_in_memory is not None:
+            self.int8_codes, self.int8_scales, self.binary_codes = self._codes_in_memory
+            return
+        self.int8_codes = self._map("int8.bin", np.int8, self.dim)
+        self.int8_scales = self._map("int8_scales.bin", np.float32)
+        self.binary_codes = self._map("binary.bin", np.uint8, (self.dim + 7) // 8)
+
+    def _build_codes(self) -> None:
+        blocks = [
+            quantize(np.asarray(self.matrix[start : start + BLOCK_ROWS], np.float32))
+            for start in range(0, self._count, BLOCK_ROWS)
+        ]
+        int8_codes = np.concatenate([b[0] for b in blocks])
+        int8_scales = np.concatenate([b[1] for b in blocks])
+        binary_codes = np.concatenate([b[2] for b in blocks])
+        if self.read_only:
+            self._codes_in_memory = (int8_codes, int8_scales, binary_codes)
+            return
+        with self._lock:
+            for name, codes in (
+                ("int8.bin", int8_codes),
+                ("int8_scales.bin", int8_scales),
+                ("binary.bin", binary_codes),
+            ):
+                with open(self._file(name), "wb") as f:
+                    _ = f.write(codes.tobytes())
+            self._write_header()
+
+    def _write_header(self, **extra: Any) -> None:  # pyright: ignore[reportExplicitAny, reportAny]
+        tmp_path = self._file("index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "dtype": self.dtype,
+                    "count": self._count,
+                    "meta_bytes": self._meta_bytes,
+                    "codes": True,
+                    **extra,
+                },
+                f,
+            )
+        os.replace(tmp_path, self._file("index.json"))
+
+    def copy_to(self, path: str) -> "NumpyVectorIndex":
+        """Copies the committed rows to a new (writable) index directory.
+
+        The files are append-only, so the copy is consistent even while
+        another process appends rows to this index.
+        """
+        os.makedirs(path)
+        itemsize = np.dtype(self.dtype).itemsize
+        copy_prefix(
+            self._file("vectors.bin"),
+            os.path.join(path, "vectors.bin"),
+            self._count * self.dim * itemsize,
+        )
+        copy_prefix(
+            self._file("meta.jsonl"), os.path.join(path, "meta.jsonl"), self._meta_bytes
+        )
+        for name, codes in (
+            ("int8.bin", self.int8_codes),
+            ("int8_scales.bin", self.int8_scales),
+            ("binary.bin", self.binary_codes),
+        ):
+            codes.tofile(os.path.join(path, name))
+        # Rows committed since this index was opened are left out
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "dtype": self.dtype,
+                    "count": self._count,
+                    "meta_bytes": self._meta_bytes,
+                    "codes": True,
+                },
+                f,
+            )
+        return NumpyVectorIndex(path)
+
+    def freeze(self) -> None:
+        """Makes the index read-only, with memory-mappable metadata.
+
+        Writes the offset of each row in `meta.jsonl` and the sorted IDs (see
+        `MappedMetadata`); reopen the index to serve it that way.
+        """
+        if self.frozen:
+            return
+        with self._lock:
+            id_width = write_mapped_metadata(
+                self.path, "meta", self._meta_bytes, self.ids
+            )
+            self._write_header(frozen=True, id_width=id_width)
+            self.frozen = True
+            self.read_only = True
+
+    def _append(self, name: str, row_bytes: int, data: bytes) -> None:
+        with open(self._file(name), "ab") as f:
+            # Drop anything written after the last commit (e.g. a crash)
+            _ = f.truncate(self._count * row_bytes)
+            _ = f.write(data)
+
+    def count(self) -> int:
+        return self._count
+
+    def warm_up(self) -> None:
+        # A search scans the whole (memory-mapped) matrix, so its pages are
+        # read in now rather than by the first request
+        if self._count > 0:
+            _ = self.search([np.asarray(self.matrix[0], np.float32).tolist()], 1)
+
+    def memory_report(self) -> dict[str, int | str]:
+        """Bytes scanned for each search, for the current quantization."""
+        full = self._count * self.dim * np.dtype(self.dtype).itemsize
+        scanned = {
+            "none": full,
+            "int8": self._count * (self.dim + 4),
+            "binary": self._count * ((self.dim + 7) // 8),
+        }[self.quantization]
+        return {
+            "frozen": self.frozen,
+            "quantization": self.quantization,
+            "full_precision_bytes": full,
+            "scanned_bytes": scanned,
+            "rescore_multiplier": self.rescore_multiplier,
+        }
+
+    def _find_rows(self, ids: list[str]) -> list[int | None]:
+        if self._mapped is not None:
+            return self._mapped.find(ids)
+        return [self._rows.get(id) for id in ids]
+
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        return {id for id, row in zip(ids, self._find_rows(ids)) if row is not None}
+
+    def upsert(
+        self, ids: list[str], chunks: list[Document], vectors: list[list[float]]
+    ) -> None:
+        """Appends new rows. IDs are content hashes, so known IDs are skipped."""
+        if self.read_only:
+            raise PermissionError(f"Vector index {self.path} is read-only")
+
+        with self._lock:
+            new = [
+                (id, chunk, vector)
+                for id, chunk, vector in zip(ids, chunks, vectors)
+                if id not in self._rows
+            ]
+            if not new:
+                return
+
+            matrix = normalize(np.asarray([vector for _, _, vector in new], np.float32))
+            if self._count == 0:
+                self.dim = matrix.shape[1]
+            int8_codes, int8_scales, binary_codes = quantize(matrix)
+            lines = b"".join(
+                json.dumps(
+                    {"id": id, "text": chunk.page_content, "metadata": chunk.metadata}
+                ).encode()
+                + b"\n"
+                for id, chunk, _ in new
+            )
+
+            itemsize = np.dtype(self.dtype).itemsize
+            self._append(
+                "vectors.bin", self.dim * itemsize, matrix.astype(self.dtype).tobytes()
+            )
+            self._append("int8.bin", self.dim, int8_codes.tobytes())
+            self._append("int8_scales.bin", 4, int8_scales.tobytes())
+            self._append("binary.bin", (self.dim + 7) // 8, binary_codes.tobytes())
+            with open(self._file("meta.jsonl"), "ab") as f:
+                _ = f.truncate(self._meta_bytes)
+                _ = f.write(lines)
+
+            for id, chunk, _ in new:
+                self._rows[id] = len(self.ids)
+                self.ids.append(id)
+                self.texts.append(chunk.page_content)
+                self.metadatas.append(chunk.metadata)
+            self._count += len(new)
+            self._meta_bytes += len(lines)
+            self._write_header()
+            self.matrix = self._map_vectors()
+            self._map_codes()
+
+    def exact_scores(
+        self, queries: npt.NDArray[np.float32], rows: npt.NDArray[np.intp] | None = None
+    ) -> npt.NDArray[np.float32]:
+        """Cosine similarities, with one row per stored vector and one column per query.
+
+        When `rows` is given, only those rows are read from the matrix.
+        """
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if self.dtype == "float32":
+            return np.asarray(matrix @ queries.T)
+        # NumPy has no fast float16 matmul, so we upcast block by block
+        scores = np.empty((len(matrix), len(queries)), dtype=np.float32)
+        for start in range(0, len(matrix), BLOCK_ROWS):
+            block = np.asarray(matrix[start : start + BLOCK_ROWS], np.float32)
+            scores[start : start + len(block)] = block @ queries.T
+        return scores
+
+    def approximate_scores(
+        self, queries: npt.NDArray[np.float32]
+    ) -> npt.NDArray[np.float32]:
+        """Scores from the quantized vectors (higher is better)."""
+        scores = np.empty((self._count, len(queries)), dtype=np.float32)
+        if self.quantization == "int8":
+            for start in range(0, self._count, BLOCK_ROWS):
+                block = np.asarray(self.int8_codes[start : start + BLOCK_ROWS], np.float32)
+                scales = self.int8_scales[start : start + BLOCK_ROWS, None]
+                scores[start : start + len(block)] = (block @ queries.T) * scales
+            return scores
+
+        query_bits = np.packbits(queries > 0, axis=1)
+        for column, bits in enumerate(query_bits):
+            for start in range(0, self._count, BLOCK_ROWS):
+                block = self.binary_codes[start : start + BLOCK_ROWS]
+                distances = popcount(np.bitwise_xor(block, bits)).sum(axis=1, dtype=np.int32)
+                scores[start : start + len(block), column] = -distances
+        return scores
+
+    def vectors(self, ids: list[str]) -> npt.NDArray[np.float32]:
+        found = self._find_rows(ids)
+        rows = [row for row in found if row is not None]
+        if len(rows) < len(ids):
+            raise KeyError(ids[found.index(None)])
+        # Sorted rows make the reads from the memory-mapped matrix sequential
+        order = np.argsort(rows)
+        matrix = np.empty((len(rows), self.dim), dtype=np.float32)
+        matrix[order] = self.matrix[np.asarray(rows, dtype=np.intp)[order]]
+        return matrix
+
+    def document(self, row: int) -> Document:
+        if self._mapped is not None:
+            data = self._mapped.row(row)
+            return Document(
+                id=data["id"], page_content=data["text"], metadata=data["metadata"]  # pyright: ignore[reportAny]
+            )
+        return Document(
+            id=self.ids[row], page_content=self.texts[row], metadata=self.metadatas[row]
+        )
+
+    def search(self, vectors: list[list[float]], k: int) -> list[Hits]:
+        if self._count == 0 or not vectors:
+            return [[] for _ in vectors]
+        k = min(k, self._count)
+        queries = normalize(np.asarray(vectors, dtype=np.float32))
+
+        if self.quantization == "none":
+            scores = self.exact_scores(queries)
+            top = top_rows(scores, k)
+            return [
+                [(self.document(int(row)), float(scores[row, column])) for row in rows]
+                for column, rows in enumerate(top)
+            ]
+
+        candidates = top_rows(
+            self.approximate_scores(queries),
+            min(self._count, k * self.rescore_multiplier),
+        )
+        hits: list[Hits] = []
+        for column, rows in enumerate(candidates):
+            # Sorted rows make the reads from the memory-mapped matrix sequential
+            rows = np.sort(rows)
+            scores = self.exact_scores(queries[column : column + 1], rows)[:, 0]
+            order = np.argsort(-scores)[:k]
+            hits.append(
+                [(self.document(int(rows[i])), float(scores[i])) for i in order]
+            )
+        return hits
+
+
+def export_chroma(store: "Chroma", index: NumpyVectorIndex, batch_size: int = 1000) -> int:
+    """Copies all the chunks (with their embeddings) from Chroma to the index."""
+    total = store._collection.count()  # pyright: ignore[reportPrivateUsage]
+    for offset in range(0, total, batch_size):
+        batch = store.get(
+            limit=batch_size,
+            offset=offset,
+            include=["documents", "metadatas", "embeddings"],
+        )
+        index.upsert(
+            batch["ids"],  # pyright: ignore[reportAny]
+            [
+                Document(page_content=text, metadata=metadata)  # pyright: ignore[reportAny]
+                for text, metadata in zip(batch["documents"], batch["metadatas"])  # pyright: ignore[reportAny]
+            ],
+            [list(vector) for vector in batch["embeddings"]],  # pyright: ignore[reportAny]
+        )
+    return total
+
+
+if __name__ == "__main__":
+    from .pdf import NUMPY_INDEX_DTYPE, NUMPY_INDEX_PATH, get_vector_store
+
+    index = NumpyVectorIndex(NUMPY_INDEX_PATH, dtype=NUMPY_INDEX_DTYPE)
+    total = export_chroma(get_vector_store(), index)
+    print(f"Exported {total} chunks from Chroma to {NUMPY_INDEX_PATH}")
@@ -0,0 +1,352 @@
+"""Local stand-in for the OpenAI API and the tool backends, for load tests.
+
+    uv run python -m bench.fake_openai --port 8911 --ttft 0.4 --tokens-per-second 60
+
+It implements what the app uses: streaming (and structured) chat
+completions, the Responses API used by the research agent, embeddings, the
+open-meteo forecast, and a web search endpoint standing in for DuckDuckGo
+and Exa. Latencies and token rates come from the command line (or the
+FAKE_* environment variables, when run with uvicorn directly); the jitter is
+seeded, so two runs with the same settings see the same latencies.
+`bench.load` starts it automatically.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+from collections.abc import AsyncIterator
+from typing import Any
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+WORDS = (
+    "the king parliament charles cromwell war army crown church england "
+    + "scotland london rights liberty law court people history century"
+).split()
+
+
+class FakeConfig(BaseModel):
+    ttft: float = float(os.getenv("FAKE_TTFT", "0.4"))
+    tokens_per_second: float = float(os.getenv("FAKE_TOKENS_PER_SECOND", "60"))
+    completion_tokens: int = int(os.getenv("FAKE_COMPLETION_TOKENS", "120"))
+    responses_latency: float = float(os.getenv("FAKE_RESPONSES_LATENCY", "1.5"))
+    embedding_latency: float = float(os.getenv("FAKE_EMBEDDING_LATENCY", "0.15"))
+    embedding_dim: int = int(os.getenv("FAKE_EMBEDDING_DIM", "3072"))
+    tool_latency: float = float(os.getenv("FAKE_TOOL_LATENCY", "0.5"))
+    search_results: int = int(os.getenv("FAKE_SEARCH_RESULTS", "10"))
+    jitter: float = float(os.getenv("FAKE_JITTER", "0.1"))
+    seed: int = int(os.getenv("FAKE_SEED", "0"))
+
+
+config = FakeConfig()
+rng = random.Random(config.seed)
+app = FastAPI()
+
+
+async def delay(seconds: float) -> None:
+    await asyncio.sleep(max(0.0, seconds * (1 + rng.uniform(-config.jitter, config.jitter))))
+
+
+def message_text(message: dict[str, Any]) -> str:  # pyright: ignore[reportExplicitAny]
+    content = message.get("content") or ""  # pyright: ignore[reportAny]
+    if isinstance(content, str):
+        return content
+    return " ".join(str(part.get("text") or "") for part in content)  # pyright: ignore[reportAny]
+
+
+def last_user_text(messages: list[dict[str, Any]]) -> str:  # pyright: ignore[reportExplicitAny]
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message_text(message)
+    return ""
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def completion_words(n: int) -> list[str]:
+    return [f" {WORDS[i % len(WORDS)]}" for i in range(n)]
+
+
+def pick_tool_call(
+    messages: list[dict[str, Any]], tools: list[dict[str, Any]]  # pyright: ignore[reportExplicitAny]
+) -> dict[str, str] | None:
+    """The tool call a model would plausibly make for the last user message."""
+    if not tools or messages[-1].get("role") != "user":
+        return None
+    names = [tool["function"]["name"] for tool in tools]  # pyright: ignore[reportAny]
+    text = last_user_text(messages)
+    if "get_current_weather" in names and re.search(r"weather|temperature", text, re.I):
+        arguments = {"latitude": 48.8566, "longitude": 2.3522}
+        name = "get_current_weather"
+    elif "similarity_search_pdf" in names:
+        arguments, name = {"query": text, "k": 10}, "similarity_search_pdf"
+    elif "exa_search" in names:
+        arguments, name = {"query": text}, "exa_search"
+    else:
+        return None
+    return {
+        "id": f"call_{uuid.uuid4().hex[:12]}",
+        "name": name,
+        "arguments": json.dumps(arguments),
+    }
+
+
+def chunk(
+    id: str, model: str, delta: dict[str, Any], finish_reason: str | None = None  # pyright: ignore[reportExplicitAny]
+) -> str:
+    payload = {
+        "id": id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+async def stream_completion(
+    body: dict[str, Any], tool_call: dict[str, str] | None  # pyright: ignore[reportExplicitAny]
+) -> AsyncIterator[str]:
+    id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    model = str(body.get("model", "gpt-4o"))  # pyright: ignore[reportAny]
+    await delay(config.ttft)
+    if tool_call is not None:
+        yield chunk(
+            id,
+            model,
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        "index": 0,
+                        "id": tool_call["id"],
+                        "type": "function",
+                        "function": {"name": tool_call["name"], "arguments": ""},
+                    }
+                ],
+            },
+        )
+        yield chunk(
+            id,
+            model,
+            {"tool_calls": [{"index": 0, "function": {"arguments": tool_call["arguments"]}}]},
+        )
+        yield chunk(id, model, {}, "tool_calls")
+    else:
+        for i, word in enumerate(completion_words(config.completion_tokens)):
+            if i > 0:
+                await asyncio.sleep(1 / config.tokens_per_second)
+            yield chunk(id, model, {"role": "assistant", "content": word} if i == 0 else {"content": word})
+        yield chunk(id, model, {}, "stop")
+    if (body.get("stream_options") or {}).get("include_usage"):  # pyright: ignore[reportAny]
+        usage = {
+            "prompt_tokens": count_tokens(json.dumps(body["messages"])),
+            "completion_tokens": config.completion_tokens,
+            "total_tokens": 0,
+        }
+        payload = {"id": id, "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+        yield f"data: {json.dumps(payload)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body: dict[str, Any] = await request.json()  # pyright: ignore[reportExplicitAny]
+    messages: list[dict[str, Any]] = body["messages"]  # pyright: ignore[reportExplicitAny]
+    if body.get("stream"):
+        return StreamingResponse(
+            stream_completion(body, pick_tool_call(messages, body.get("tools") or [])),  # pyright: ignore[reportAny]
+            media_type="text/event-stream",
+        )
+
+    # Structured outputs (query refinement) and plain completions
+    await delay(config.ttft + 30 / config.tokens_per_second)
+    text = last_user_text(messages).removeprefix("Query from user => \n")
+    content = (
+        json.dumps({"refined_query": f"{text} (in the book)", "k": 10})
+        if body.get("response_format")
+        else "".join(completion_words(config.completion_tokens))
+    )
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": count_tokens(json.dumps(messages)),
+            "completion_tokens": count_tokens(content),
+            "total_tokens": 0,
+        },
+    }
+
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    """The research agent: one round of PDF searches, then a final answer."""
+    body: dict[str, Any] = await request.json()  # pyright: ignore[reportExplicitAny]
+    items: list[dict[str, Any]] = body.get("input") or []  # pyright: ignore[reportExplicitAny, reportAny]
+    await delay(config.responses_latency)
+    query = last_user_text(items).removeprefix("The research query is: ")
+    answered = body.get("tool_choice") == "none" or any(
+        item.get("type") == "function_call_output" for item in items
+    )
+    if answered:
+        output: list[dict[str, Any]] = [  # pyright: ignore[reportExplicitAny]
+            {
+                "type": "message",
+                "id": f"msg_{uuid.uuid4().hex[:12]}",
+                "role": "assistant",
+                "status": "completed",
+                "content": [
+                    {
+                        "type": "output_text",
+                        "text": "".join(completion_words(config.completion_tokens)),
+                        "annotations": [],
+                    }
+                ],
+            }
+        ]
+    else:
+        output = [
+            {
+                "type": "function_call",
+                "id": f"fc_{uuid.uuid4().hex[:12]}",
+                "call_id": f"call_{uuid.uuid4().hex[:12]}",
+                "name": "similarity_search_pdf",
+                "arguments": json.dumps({"query": f"{query} {suffix}", "k": 5}),
+                "status": "completed",
+            }
+            for suffix in ("causes", "consequences")
+        ]
+    return {
+        "id": f"resp_{uuid.uuid4().hex[:12]}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body.get("model", "o4-mini"),
+        "status": "completed",
+        "output": output,
+        "parallel_tool_calls": True,
+        "tool_choice": body.get("tool_choice", "auto"),
+        "tools": [],
+        "usage": {
+            "input_tokens": count_tokens(json.dumps(items)),
+            "output_tokens": config.completion_tokens,
+            "total_tokens": 0,
+        },
+    }
+
+
+def fake_embedding(text: str) -> np.ndarray[Any, np.dtype[np.float32]]:  # pyright: ignore[reportExplicitAny]
+    """A deterministic unit vector for a text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=config.embedding_dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body: dict[str, Any] = await request.json()  # pyright: ignore[reportExplicitAny]
+    inputs: Any = body["input"]  # pyright: ignore[reportExplicitAny, reportAny]
+    # A string, a list of strings, or (token-counting clients) lists of token IDs
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    await delay(config.embedding_latency)
+    data: list[dict[str, Any]] = []  # pyright: ignore[reportExplicitAny]
+    for i, text in enumerate(inputs):  # pyright: ignore[reportAny]
+        vector = fake_embedding(json.dumps(text))
+        data.append(
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": base64.b64encode(vector.tobytes()).decode()
+                if body.get("encoding_format") == "base64"
+                else vector.tolist(),
+            }
+        )
+    tokens = sum(count_tokens(json.dumps(text)) for text in inputs)  # pyright: ignore[reportAny]
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "text-embedding-3-large"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.get("/weather")
+async def weather(latitude: float, longitude: float):
+    await delay(config.tool_latency)
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "timezone": "Europe/Paris",
+        "current": {"time": "2025-01-01T12:00", "temperature_2m": 11.5},
+        "hourly": {
+            "time": [f"2025-01-01T{hour:02d}:00" for hour in range(24)],
+            "temperature_2m": [8 + hour / 4 for hour in range(24)],
+        },
+        "daily": {"sunrise": ["2025-01-01T08:44"], "sunset": ["2025-01-01T17:04"]},
+    }
+
+
+@app.get("/search")
+async def search(q: str):
+    """Web results, in DuckDuckGo's shape (`href`, `body`) and Exa's (`url`, `text`)."""
+    await delay(config.tool_latency)
+    body = " ".join(
+        f"{q} is discussed in this page, along with{''.join(completion_words(12))}."
+        for _ in range(6)
+    )
+    return [
+        {
+            "title": f"{q} - result {i + 1}",
+            "href": f"https://example.com/{i}",
+            "url": f"https://example.com/{i}",
+            "body": body,
+            "text": body,
+        }
+        for i in range(config.search_results)
+    ]
+
+
+@app.get("/health")
+async def health():
+    return config.model_dump()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _ = parser.add_argument("--host", default="127.0.0.1")
+    _ = parser.add_argument("--port", type=int, default=8911)
+    for name, field in FakeConfig.model_fields.items():
+        _ = parser.add_argument(
+            f"--{name.replace('_', '-')}", type=field.annotation, default=field.default  # pyright: ignore[reportAny]
+        )
+    args = parser.parse_args()
+    for name in FakeConfig.model_fields:
+        setattr(config, name, getattr(args, name))
+    rng.seed(config.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")  # pyright: ignore[reportAny]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""Load test of /api/chat for each STEP, against a local OpenAI stand-in.
+
+Run it from the `rag-template` directory, once the PDF has been ingested:
+
+    uv run python -m bench.load --steps 0 2 5 7 --concurrency 1 8 32 --requests 64
+
+For each STEP, the app is started in its own process (`bench.serve`), with
+the OpenAI API, the weather API and web search pointed at `bench.fake_openai`,
+whose latencies and token rates are set by the `--fake-*` options. The
+conversations of `bench/conversations.json` are replayed at each concurrency
+level, and the time to the first text frame (TTFT), the total latency and the
+throughput are reported. With `--json`, the results are saved along with the
+commit and the settings; `--compare` prints the change against such a file,
+so runs on two commits can be compared (use the same settings for both).
+`--fake-embedding-dim` must match the dimension of the ingested vectors.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any
+
+import httpx
+import numpy as np
+
+STEPS = [0, 1, 2, 3, 4, 5, 6, 7]
+CONVERSATIONS_PATH = os.path.join(os.path.dirname(__file__), "conversations.json")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def wait_until_ready(
+    url: str,
+    process: subprocess.Popen[bytes],
+    timeout: float = 120,
+    interval: float = 0.2,
+) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(interval)
+    raise TimeoutError(f"{url} did not start within {timeout}s")
+
+
+def start(
+    command: list[str], env: dict[str, str], ready_url: str, interval: float = 0.2
+) -> subprocess.Popen[bytes]:
+    process = subprocess.Popen(command, env={**os.environ, **env})
+    try:
+        wait_until_ready(ready_url, process, interval=interval)
+    except Exception:
+        process.kill()
+        raise
+    return process
+
+
+def start_fake(settings: dict[str, Any]) -> tuple[subprocess.Popen[bytes], str]:  # pyright: ignore[reportExplicitAny]
+    """Starts `bench.fake_openai` with the given `--fake-*` settings."""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    process = start(
+        [
+            sys.executable,
+            "-m",
+            "bench.fake_openai",
+            "--port",
+            str(port),
+            *(
+                arg
+                for name, value in settings.items()  # pyright: ignore[reportAny]
+                for arg in (f"--{name.replace('_', '-')}", str(value))  # pyright: ignore[reportAny]
+            ),
+        ],
+        {},
+        f"{url}/health",
+    )
+    return process, url
+
+
+def app_env(step: int, fake_url: str, sync: bool = False) -> dict[str, str]:
+    """Environment of a `bench.serve` app pointed at the fake server."""
+    return {
+        "STEP": str(step),
+        "ASYNC_MODE": "0" if sync else "1",
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        "OPENAI_API_BASE": f"{fake_url}/v1",
+        "EXA_API_KEY": "fake",
+        "WEATHER_API_URL": f"{fake_url}/weather",
+        "FAKE_SERVER_URL": fake_url,
+        "LOG_LEVEL": "WARNING",
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(np.asarray(values), p)) if values else float("nan")
+
+
+async def chat(
+    client: httpx.AsyncClient, url: str, messages: list[dict[str, str]]
+) -> tuple[float, float]:
+    """Sends a conversation and returns its TTFT and total latency (seconds)."""
+    started_at = time.perf_counter()
+    ttft: float | None = None
+    first_frame: float | None = None
+    async with client.stream("POST", url, json={"messages": messages}) as response:
+        _ = response.raise_for_status()
+        async for line in response.aiter_lines():
+            if first_frame is None:
+                first_frame = time.perf_counter() - started_at
+            if ttft is None and line.startswith("0:"):
+                ttft = time.perf_counter() - started_at
+    total = time.perf_counter() - started_at
+    # Answers made only of tool results have no text frame
+    return ttft or first_frame or total, total
+
+
+async def run_level(
+    url: str,
+    conversations: list[list[dict[str, str]]],
+    concurrency: int,
+    requests: int,
+    unique: bool,
+) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+    ttfts: list[float] = []
+    totals: list[float] = []
+    errors = 0
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal errors
+        while not queue.empty():
+            i = queue.get_nowait()
+            messages = [dict(m) for m in conversations[i % len(conversations)]]
+            if unique:
+                # Defeats the caches, which would otherwise answer repeats
+                messages[-1]["content"] += f" (request {i})"
+            try:
+                ttft, total = await chat(client, url, messages)
+                ttfts.append(ttft)
+                totals.append(total)
+            except Exception as e:
+                errors += 1
+                print(f"  request {i} failed: {e!r}", file=sys.stderr)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    started_at = time.perf_counter()
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        _ = await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    seconds = time.perf_counter() - started_at
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "rps": len(totals) / seconds,
+        **{f"ttft_p{p}_ms": percentile(ttfts, p) * 1000 for p in (50, 95, 99)},
+        **{f"total_p{p}_ms": percentile(totals, p) * 1000 for p in (50, 95, 99)},
+    }
+
+
+def print_table(results: list[dict[str, Any]], baseline: list[dict[str, Any]] | None) -> None:  # pyright: ignore[reportExplicitAny]
+    columns = list(results[0])
+    print("  ".join(f"{column:>13}" for column in columns))
+    previous = {(r["step"], r["mode"], r["concurrency"]): r for r in baseline or []}  # pyright: ignore[reportAny]
+    for result in results:
+        print(
+            "  ".join(
+                f"{value:>13.1f}" if isinstance(value, float) else f"{value:>13}"
+                for value in result.values()  # pyright: ignore[reportAny]
+            )
+        )
+        before = previous.get((result["step"], result["mode"], result["concurrency"]))  # pyright: ignore[reportAny]
+        if before:
+            print(
+                "  ".join(
+                    f"{(value / before[column] - 1) * 100:>+12.1f}%"
+                    if isinstance(value, float)
+                    and math.isfinite(value)
+                    and math.isfinite(before.get(column) or math.nan)  # pyright: ignore[reportAny]
+                    and before[column]
+                    else f"{'':>13}"
+                    for column, value in result.items()  # pyright: ignore[reportAny]
+                )
+            )
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser) -> None:
+    _ = parser.add_argument("--fake-ttft", type=float, default=0.4)
+    _ = parser.add_argument("--fake-tokens-per-second", type=float, default=60)
+    _ = parser.add_argument("--fake-completion-tokens", type=int, default=120)
+    _ = parser.add_argument("--fake-responses-latency", type=float, default=1.5)
+    _ = parser.add_argument("--fake-embedding-latency", type=float, default=0.15)
+    _ = parser.add_argument("--fake-embedding-dim", type=int, default=3072)
+    _ = parser.add_argument("--fake-tool-latency", type=float, default=0.5)
+    _ = parser.add_argument("--fake-jitter", type=float, default=0.1)
+
+
+def get_fake_settings(args: argparse.Namespace) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+    return {
+        name.removeprefix("fake_"): value
+        for name, value in vars(args).items()  # pyright: ignore[reportAny]
+        if name.startswith("fake_")
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _ = parser.add_argument("--steps", type=int, nargs="+", default=STEPS)
+    _ = parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    _ = parser.add_argument("--requests", type=int, default=64)
+    _ = parser.add_argument("--sync", action="store_true", help="ASYNC_MODE=0")
+    _ = parser.add_argument(
+        "--unique", action="store_true", help="Make every question unique"
+    )
+    _ = parser.add_argument("--conversations", default=CONVERSATIONS_PATH)
+    add_fake_arguments(parser)
+    _ = parser.add_argument("--json", help="Also write the results to this file")
+    _ = parser.add_argument("--compare", help="Results file of a previous run")
+    args = parser.parse_args()
+
+    with open(args.conversations) as f:  # pyright: ignore[reportAny]
+        conversations: list[list[dict[str, str]]] = json.load(f)
+    fake_settings = get_fake_settings(args)
+    mode = "sync" if args.sync else "async"  # pyright: ignore[reportAny]
+
+    fake, fake_url = start_fake(fake_settings)
+
+    results: list[dict[str, Any]] = []  # pyright: ignore[reportExplicitAny]
+    try:
+        for step in args.steps:  # pyright: ignore[reportAny]
+            app_port = free_port()
+            app_url = f"http://127.0.0.1:{app_port}"
+            app = start(
+                [sys.executable, "-m", "bench.serve", "--port", str(app_port)],
+                app_env(step, fake_url, args.sync),  # pyright: ignore[reportAny]
+                f"{app_url}/api/stats",
+            )
+            try:
+                # One pass over the conversations to warm up imports and pools
+                _ = asyncio.run(
+                    run_level(
+                        f"{app_url}/api/chat", conversations, 4, len(conversations), True
+                    )
+                )
+                for concurrency in args.concurrency:  # pyright: ignore[reportAny]
+                    level = asyncio.run(
+                        run_level(
+                            f"{app_url}/api/chat",
+                            conversations,
+                            concurrency,  # pyright: ignore[reportAny]
+                            args.requests,  # pyright: ignore[reportAny]
+                            args.unique,  # pyright: ignore[reportAny]
+                        )
+                    )
+                    results.append({"step": step, "mode": mode, **level})
+                    print(f"STEP {step} x{concurrency}: {level['rps']:.2f} req/s", file=sys.stderr)
+            finally:
+                app.terminate()
+                _ = app.wait()
+    finally:
+        fake.terminate()
+        _ = fake.wait()
+
+    baseline = None
+    if args.compare:  # pyright: ignore[reportAny]
+        with open(args.compare) as f:  # pyright: ignore[reportAny]
+            previous: dict[str, Any] = json.load(f)  # pyright: ignore[reportExplicitAny]
+        if previous.get("settings") != fake_settings:
+            print("Warning: the baseline was run with other fake settings", file=sys.stderr)
+        print(f"Compared with {previous.get('commit')} (relative change below each row)\n")
+        baseline = previous["results"]  # pyright: ignore[reportAny]
+    print_table(results, baseline)  # pyright: ignore[reportAny]
+
+    if args.json:  # pyright: ignore[reportAny]
+        with open(args.json, "w") as f:  # pyright: ignore[reportAny]
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "settings": fake_settings,
+                    "unique": args.unique,  # pyright: ignore[reportAny]
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Runs the app with its web search tools pointed at `bench.fake_openai`.
+
+    FAKE_SERVER_URL=http://127.0.0.1:8911 uv run python -m bench.serve --port 8912
+
+The OpenAI clients and the weather tool are redirected with environment
+variables (OPENAI_BASE_URL, WEATHER_API_URL), which `bench.load` sets. The
+DuckDuckGo and Exa SDKs can't be, so their fetch functions are replaced by
+calls to the stand-in's `/search` endpoint, through the same pooled HTTP
+session and per-host limits as the real ones.
+"""
+
+import argparse
+import os
+from urllib.parse import quote
+
+import uvicorn
+
+FAKE_SERVER_URL = os.getenv("FAKE_SERVER_URL", "http://127.0.0.1:8911")
+
+
+def fake_search(host: str):
+    from api.utils.clients import host_limiter, http_get
+
+    def fetch(query: str) -> list[dict[str, str]]:
+        with host_limiter.limit(host):
+            response = http_get(f"{FAKE_SERVER_URL}/search?q={quote(query)}")
+        response.raise_for_status()
+        return response.json()  # pyright: ignore[reportAny]
+
+    return fetch
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _ = parser.add_argument("--host", default="127.0.0.1")
+    _ = parser.add_argument("--port", type=int, default=8912)
+    args = parser.parse_args()
+
+    from api import index
+    from api.utils import tools
+    from api.utils.clients import DUCKDUCKGO_HOST, EXA_HOST
+
+    tools.fetch_duckduckgo_search = fake_search(DUCKDUCKGO_HOST)
+    tools.fetch_exa_search = fake_search(EXA_HOST)
+    uvicorn.run(index.app, host=args.host, port=args.port, log_level="warning")  # pyright: ignore[reportAny]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Cold-start benchmark: import time, time to ready and first-request latency.
+
+Run it from the `rag-template` directory, once the PDF has been ingested:
+
+    uv run python -m bench.startup --steps 0 2 7 --warmup 0 1 --json startup.json
+
+For each STEP (and each WARMUP setting), `api.index` is imported in fresh
+interpreters (`--repeat` times, the median is kept), then the app is started
+with `bench.serve` against `bench.fake_openai`, and timed until it answers,
+then for its first and second chat requests. The first request pays for
+whatever is built lazily, unless WARMUP=1 built it during startup.
+
+To guard against regressions, `--compare` prints the change against a
+previous `--json` file and fails (exit code 1) when the import time or the
+first request got slower by more than `--max-regression` percent, and
+`--max-import-seconds` fails when an import takes longer than that.
+`--top` lists the slowest imports (from `python -X importtime`).
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any
+
+import httpx
+
+from .load import (
+    add_fake_arguments,
+    app_env,
+    chat,
+    free_port,
+    get_fake_settings,
+    git_commit,
+    start,
+    start_fake,
+)
+
+QUESTION = "What does the book say about Charles I?"
+IMPORT_SNIPPET = (
+    "import time; started_at = time.perf_counter(); import api.index; "
+    + "print(time.perf_counter() - started_at)"
+)
+# Metrics checked against the baseline by --max-regression
+GUARDED = ["import_s", "first_total_ms"]
+
+
+def import_seconds(env: dict[str, str]) -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        env={**os.environ, **env},
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env: dict[str, str], top: int) -> list[tuple[str, float]]:
+    """The top-level imports of `api.index` that took the longest (cumulative)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api.index"],
+        env={**os.environ, **env},
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    imports: list[tuple[str, float]] = []
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", indented by depth
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)", line)
+        if match and len(match.group(2)) <= 3:
+            imports.append((match.group(3), int(match.group(1)) / 1e6))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:top]
+
+
+def first_requests(url: str) -> tuple[float, float, float]:
+    """TTFT and latency of the first request, and latency of the second one."""
+
+    async def run() -> tuple[float, float, float]:
+        messages = [{"role": "user", "content": QUESTION}]
+        async with httpx.AsyncClient(timeout=300) as client:
+            first_ttft, first_total = await chat(client, url, messages)
+            _, second_total = await chat(client, url, messages)
+        return first_ttft, first_total, second_total
+
+    return asyncio.run(run())
+
+
+def measure(
+    step: int, warmup: int, fake_url: str, repeat: int
+) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+    env = {**app_env(step, fake_url), "WARMUP": str(warmup)}
+    imports = [import_seconds(env) for _ in range(repeat)]
+
+    port = free_port()
+    started_at = time.perf_counter()
+    app = start(
+        [sys.executable, "-m", "bench.serve", "--port", str(port)],
+        env,
+        f"http://127.0.0.1:{port}/api/metrics",
+        interval=0.02,
+    )
+    ready = time.perf_counter() - started_at
+    try:
+        first_ttft, first_total, second_total = first_requests(
+            f"http://127.0.0.1:{port}/api/chat"
+        )
+    finally:
+        app.terminate()
+        _ = app.wait()
+
+    return {
+        "step": step,
+        "warmup": warmup,
+        "import_s": statistics.median(imports),
+        "ready_s": ready,
+        "first_ttft_ms": first_ttft * 1000,
+        "first_total_ms": first_total * 1000,
+        "second_total_ms": second_total * 1000,
+    }
+
+
+def regressions(
+    results: list[dict[str, Any]],  # pyright: ignore[reportExplicitAny]
+    baseline: list[dict[str, Any]],  # pyright: ignore[reportExplicitAny]
+    max_regression: float,
+) -> list[str]:
+    previous = {(r["step"], r["warmup"]): r for r in baseline}  # pyright: ignore[reportAny]
+    failures: list[str] = []
+    for result in results:
+        before = previous.get((result["step"], result["warmup"]))  # pyright: ignore[reportAny]
+        if not before:
+            continue
+        for column in GUARDED:
+            change = (result[column] / before[column] - 1) * 100  # pyright: ignore[reportAny]
+            if math.isfinite(change) and change > max_regression:  # pyright: ignore[reportAny]
+                failures.append(
+                    f"STEP {result['step']} WARMUP={result['warmup']}: {column} "
+                    + f"{before[column]:.3f} -> {result[column]:.3f} ({change:+.1f}%)"
+                )
+    return failures
+
+
+def print_table(
+    results: list[dict[str, Any]],  # pyright: ignore[reportExplicitAny]
+    baseline: list[dict[str, Any]] | None,  # pyright: ignore[reportExplicitAny]
+) -> None:
+    columns = list(results[0])
+    print("  ".join(f"{column:>15}" for column in columns))
+    previous = {(r["step"], r["warmup"]): r for r in baseline or []}  # pyright: ignore[reportAny]
+    for result in results:
+        print(
+            "  ".join(
+                f"{value:>15.3f}" if isinstance(value, float) else f"{value:>15}"
+                for value in result.values()  # pyright: ignore[reportAny]
+            )
+        )
+        before = previous.get((result["step"], result["warmup"]))  # pyright: ignore[reportAny]
+        if before:
+            print(
+                "  ".join(
+                    f"{(value / before[column] - 1) * 100:>+14.1f}%"
+                    if isinstance(value, float) and before.get(column)
+                    else f"{'':>15}"
+                    for column, value in result.items()  # pyright: ignore[reportAny]
+                )
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _ = parser.add_argument("--steps", type=int, nargs="+", default=[0, 2, 7])
+    _ = parser.add_argument("--warmup", type=int, nargs="+", default=[0], choices=[0, 1])
+    _ = parser.add_argument("--repeat", type=int, default=5, help="Imports per STEP")
+    _ = parser.add_argument("--top", type=int, default=0, help="Slowest imports to list")
+    add_fake_arguments(parser)
+    _ = parser.add_argument("--json", help="Also write the results to this file")
+    _ = parser.add_argument("--compare", help="Results file of a previous run")
+    _ = parser.add_argument("--max-regression", type=float, default=20.0)
+    _ = parser.add_argument("--max-import-seconds", type=float)
+    args = parser.parse_args()
+
+    fake_settings = get_fake_settings(args)
+    fake, fake_url = start_fake(fake_settings)
+    results: list[dict[str, Any]] = []  # pyright: ignore[reportExplicitAny]
+    try:
+        if args.top:  # pyright: ignore[reportAny]
+            print(f"Slowest imports (STEP {args.steps[0]}):")  # pyright: ignore[reportAny]
+            for name, seconds in slowest_imports(
+                app_env(args.steps[0], fake_url), args.top  # pyright: ignore[reportAny]
+            ):
+                print(f"  {seconds * 1000:8.1f} ms  {name}")
+            print()
+        for step in args.steps:  # pyright: ignore[reportAny]
+            for warmup in args.warmup:  # pyright: ignore[reportAny]
+                result = measure(step, warmup, fake_url, args.repeat)  # pyright: ignore[reportAny]
+                results.append(result)
+                print(
+                    f"STEP {step} WARMUP={warmup}: import {result['import_s']:.2f}s, "
+                    + f"first request {result['first_total_ms']:.0f} ms",
+                    file=sys.stderr,
+                )
+    finally:
+        fake.terminate()
+        _ = fake.wait()
+
+    baseline = None
+    failures: list[str] = []
+    if args.compare:  # pyright: ignore[reportAny]
+        with open(args.compare) as f:  # pyright: ignore[reportAny]
+            previous: dict[str, Any] = json.load(f)  # pyright: ignore[reportExplicitAny]
+        print(f"Compared with {previous.get('commit')} (relative change below each row)\n")
+        baseline = previous["results"]  # pyright: ignore[reportAny]
+        failures = regressions(results, baseline, args.max_regression)  # pyright: ignore[reportAny]
+    print_table(results, baseline)  # pyright: ignore[reportAny]
+
+    if args.max_import_seconds is not None:  # pyright: ignore[reportAny]
+        failures += [
+            f"STEP {r['step']}: import took {r['import_s']:.2f}s "
+            + f"(budget {args.max_import_seconds}s)"
+            for r in results
+            if r["import_s"] > args.max_import_seconds  # pyright: ignore[reportAny]
+        ]
+
+    if args.json:  # pyright: ignore[reportAny]
+        with open(args.json, "w") as f:  # pyright: ignore[reportAny]
+            json.dump(
+                {"commit": git_commit(), "settings": fake_settings, "results": results},
+                f,
+                indent=2,
+            )
+
+    if failures:
+        print("\nRegressions:\n  " + "\n  ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Compares Chroma with the NumPy index variants: latency, memory and recall.
+
+Run it from the `rag-template` directory, once the PDF has been ingested:
+
+    uv run python -m bench.vector_index --queries 200 --k 10
+
+The Chroma collection is exported to temporary NumPy indexes, and the queries
+are stored chunk vectors with some noise added, so no API call is made. Each
+backend runs in its own process, so that RSS measurements don't interfere.
+The int8 and binary variants scan quantized vectors and rescore candidates
+with the float32 vectors; use `--rescore` to trade speed for recall.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+BACKENDS = [
+    "chroma",
+    "numpy-float32",
+    "numpy-float16",
+    "numpy-int8",
+    "numpy-binary",
+]
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(np.asarray(values), p))
+
+
+def recall(results: list[list[str]], truth: list[list[str]]) -> float:
+    found = sum(len(set(r) & set(t)) for r, t in zip(results, truth))
+    return found / max(1, sum(len(t) for t in truth))
+
+
+def open_backend(name: str, workdir: str, rescore_multiplier: int | None) -> Any:  # pyright: ignore[reportExplicitAny]
+    if name == "chroma":
+        from api.utils.pdf import get_vector_store
+        from api.utils.vector_index import ChromaBackend
+
+        return ChromaBackend(get_vector_store())
+
+    from api.utils.vector_index import NumpyVectorIndex
+
+    if name in ("numpy-int8", "numpy-binary"):
+        return NumpyVectorIndex(
+            os.path.join(workdir, "numpy-float32"),
+            read_only=True,
+            quantization=name.removeprefix("numpy-"),  # pyright: ignore[reportArgumentType]
+            rescore_multiplier=rescore_multiplier,
+        )
+    return NumpyVectorIndex(os.path.join(workdir, name), read_only=True)
+
+
+def run_worker(
+    name: str, workdir: str, k: int, batch_size: int, rescore_multiplier: int | None
+) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+    queries: npt.NDArray[np.float32] = np.load(os.path.join(workdir, "queries.npy"))
+    with open(os.path.join(workdir, "truth.json")) as f:
+        truth: list[list[str]] = json.load(f)
+
+    # Import everything first, so that RSS only measures the index itself
+    # (the pdf module imports the OpenAI and Chroma integrations lazily)
+    import api.utils.pdf  # noqa: F401  # pyright: ignore[reportUnusedImport]
+    import langchain_chroma  # noqa: F401  # pyright: ignore[reportUnusedImport]
+    import langchain_openai  # noqa: F401  # pyright: ignore[reportUnusedImport]
+
+    rss_before = rss_bytes()
+    backend = open_backend(name, workdir, rescore_multiplier)
+    _ = backend.search([queries[0].tolist()], k)  # pyright: ignore[reportAny]
+    rss_after = rss_bytes()
+
+    latencies: list[float] = []
+    results: list[list[str]] = []
+    for query in queries:
+        started_at = time.perf_counter()
+        hits = backend.search([query.tolist()], k)  # pyright: ignore[reportAny]
+        latencies.append(time.perf_counter() - started_at)
+        results.append([doc.id for doc, _ in hits[0]])  # pyright: ignore[reportAny]
+
+    started_at = time.perf_counter()
+    for start in range(0, len(queries), batch_size):
+        _ = backend.search(queries[start : start + batch_size].tolist(), k)  # pyright: ignore[reportAny]
+    batched_seconds = time.perf_counter() - started_at
+
+    return {
+        "backend": name,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "batched_qps": len(queries) / batched_seconds,
+        "rss_mb": (rss_after - rss_before) / 2**20,
+        "scanned_mb": (
+            backend.memory_report()["scanned_bytes"] / 2**20  # pyright: ignore[reportAny]
+            if hasattr(backend, "memory_report")  # pyright: ignore[reportAny]
+            else float("nan")
+        ),
+        f"recall@{k}": recall(results, truth),
+    }
+
+
+def prepare(workdir: str, n_queries: int, k: int, noise: float) -> int:
+    from api.utils.pdf import get_vector_store
+    from api.utils.vector_index import NumpyVectorIndex, export_chroma
+
+    for dtype in ("float32", "float16"):
+        index = NumpyVectorIndex(os.path.join(workdir, f"numpy-{dtype}"), dtype=dtype)
+        total = export_chroma(get_vector_store(), index)
+
+    exact = NumpyVectorIndex(os.path.join(workdir, "numpy-float32"), read_only=True)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(exact.matrix), size=n_queries)
+    queries = np.asarray(exact.matrix[rows], dtype=np.float32)
+    queries += rng.normal(0, noise, queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    np.save(os.path.join(workdir, "queries.npy"), queries)
+
+    # Ground truth: exact float32 top-k
+    scores = np.asarray(exact.matrix, dtype=np.float32) @ queries.T
+    top = np.argsort(-scores, axis=0)[:k]
+    truth = [[exact.ids[row] for row in top[:, column]] for column in range(n_queries)]
+    with open(os.path.join(workdir, "truth.json"), "w") as f:
+        json.dump(truth, f)
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _ = parser.add_argument("--queries", type=int, default=200)
+    _ = parser.add_argument("--k", type=int, default=10)
+    _ = parser.add_argument("--batch-size", type=int, default=32)
+    _ = parser.add_argument("--noise", type=float, default=0.02)
+    _ = parser.add_argument(
+        "--rescore", type=int, help="Rescore multiplier for quantized indexes"
+    )
+    _ = parser.add_argument("--backends", nargs="+", default=BACKENDS)
+    _ = parser.add_argument("--json", help="Also write the results to this file")
+    _ = parser.add_argument("--worker", help=argparse.SUPPRESS)
+    _ = parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:  # pyright: ignore[reportAny]
+        result = run_worker(
+            args.worker,  # pyright: ignore[reportAny]
+            args.workdir,  # pyright: ignore[reportAny]
+            args.k,  # pyright: ignore[reportAny]
+            args.batch_size,  # pyright: ignore[reportAny]
+            args.rescore,  # pyright: ignore[reportAny]
+        )
+        print(json.dumps(result))
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        total = prepare(workdir, args.queries, args.k, args.noise)  # pyright: ignore[reportAny]
+        print(f"{total} chunks, {args.queries} queries, k={args.k}\n")
+        results: list[dict[str, Any]] = []  # pyright: ignore[reportExplicitAny]
+        for backend in args.backends:  # pyright: ignore[reportAny]
+            command = [
+                sys.executable,
+                "-m",
+                "bench.vector_index",
+                "--worker",
+                backend,
+                "--workdir",
+                workdir,
+                "--k",
+                str(args.k),  # pyright: ignore[reportAny]
+                "--batch-size",
+                str(args.batch_size),  # pyright: ignore[reportAny]
+                *(["--rescore", str(args.rescore)] if args.rescore else []),  # pyright: ignore[reportAny]
+            ]
+            output = subprocess.run(
+                command,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    columns = list(results[0])
+    print("  ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(
+            "  ".join(
+                f"{value:>14.3f}" if isinstance(value, float) else f"{value:>14}"
+                for value in result.values()  # pyright: ignore[reportAny]
+            )
+        )
+    if args.json:  # pyright: ignore[reportAny]
+        with open(args.json, "w") as f:  # pyright: ignore[reportAny]
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Memory of several worker processes serving the same index, per backend.
+
+Run it from the `rag-template` directory, once the PDF has been ingested:
+
+    uv run python -m bench.workers --workers 1 2 4 8 --queries 200
+
+The Chroma collection is exported to a temporary NumPy index, with a BM25
+index of its chunks, and published as a temporary snapshot. For each backend
+and number of workers, that many processes open the vector and BM25 indexes
+and run the same dense and lexical searches, then their memory is read from
+`/proc/<pid>/smaps_rollup` while they are all alive: the private bytes are
+what each extra worker costs, and the PSS (proportional set size) splits the
+shared pages between the processes that map them. The "chroma" and "numpy"
+backends load the live BM25 index in each worker, the snapshot memory-maps
+its frozen copy. The "none" backend only imports the modules, as a baseline.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Any
+
+import numpy as np
+
+from .vector_index import percentile
+
+BACKENDS = ["none", "chroma", "numpy", "snapshot"]
+
+
+def open_backend(name: str, workdir: str) -> tuple[Any, Any]:  # pyright: ignore[reportExplicitAny]
+    """The vector and BM25 indexes a worker of this backend serves."""
+    from api.utils.bm25 import BM25Index
+    from api.utils.snapshot import load_snapshot
+    from api.utils.vector_index import ChromaBackend, NumpyVectorIndex
+
+    if name == "snapshot":
+        snapshot = load_snapshot(os.path.join(workdir, "snapshots"))
+        return snapshot.vectors, snapshot.bm25
+    lexical_index = BM25Index(os.path.join(workdir, "bm25"), read_only=True)
+    if name == "chroma":
+        from api.utils.pdf import get_vector_store
+
+        return ChromaBackend(get_vector_store()), lexical_index
+    vectors = NumpyVectorIndex(os.path.join(workdir, "numpy"), read_only=True)
+    return vectors, lexical_index
+
+
+def run_worker(name: str, workdir: str, k: int) -> None:
+    import api.utils.pdf  # noqa: F401  # pyright: ignore[reportUnusedImport]
+    import langchain_chroma  # noqa: F401  # pyright: ignore[reportUnusedImport]
+    import langchain_openai  # noqa: F401  # pyright: ignore[reportUnusedImport]
+
+    if name != "none":
+        queries = np.load(os.path.join(workdir, "queries.npy"))
+        with open(os.path.join(workdir, "queries.json")) as f:
+            texts: list[str] = json.load(f)
+        backend, lexical_index = open_backend(name, workdir)  # pyright: ignore[reportAny]
+        for query, text in zip(queries, texts):
+            _ = backend.search([query.tolist()], k)  # pyright: ignore[reportAny]
+            _ = lexical_index.search(text, k)  # pyright: ignore[reportAny]
+    print("ready", flush=True)
+    # Stay alive (with the index open) until the parent has measured us
+    _ = sys.stdin.read()
+
+
+def memory(pid: int) -> dict[str, int]:
+    """Bytes from `/proc/<pid>/smaps_rollup`."""
+    values: dict[str, int] = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return values
+
+
+def measure(name: str, workdir: str, workers: int, k: int) -> dict[str, Any]:  # pyright: ignore[reportExplicitAny]
+    command = [
+        sys.executable,
+        "-m",
+        "bench.workers",
+        "--worker",
+        name,
+        "--workdir",
+        workdir,
+        "--k",
+        str(k),
+    ]
+    processes = [
+        subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        for _ in range(workers)
+    ]
+    try:
+        for process in processes:
+            if process.stdout is None or process.stdout.readline().strip() != "ready":
+                raise RuntimeError(f"A {name} worker failed")
+        usages = [memory(process.pid) for process in processes]
+    finally:
+        for process in processes:
+            if process.stdin is not None:
+                process.stdin.close()
+            _ = process.wait()
+
+    private = [u["Private_Clean"] + u["Private_Dirty"] for u in usages]
+    return {
+        "backend": name,
+        "workers": workers,
+        "rss_mb": percentile([u["Rss"] / 2**20 for u in usages], 50),
+        "private_mb": percentile([p / 2**20 for p in private], 50),
+        "shared_mb": percentile(
+            [(u["Shared_Clean"] + u["Shared_Dirty"]) / 2**20 for u in usages], 50
+        ),
+        "total_pss_mb": sum(u["Pss"] for u in usages) / 2**20,
+    }
+
+
+def prepare(workdir: str, n_queries: int, noise: float) -> int:
+    from api.utils.bm25 import BM25Index, numpy_chunks
+    from api.utils.pdf import get_vector_store
+    from api.utils.snapshot import publish_snapshot
+    from api.utils.vector_index import ChromaBackend, NumpyVectorIndex, export_chroma
+
+    index = NumpyVectorIndex(os.path.join(workdir, "numpy"))
+    total = export_chroma(get_vector_store(), index)
+    lexical_index = BM25Index(os.path.join(workdir, "bm25"))
+    for ids, chunks in numpy_chunks(index):
+        lexical_index.add(ids, chunks)
+    _ = publish_snapshot(os.path.join(workdir, "snapshots"), index, lexical_index)
+
+    rng = np.random.default_rng(0)
+    rows = rng.choice(total, size=n_queries)
+    queries = np.asarray(index.matrix[rows], dtype=np.float32)
+    queries += rng.normal(0, noise, queries.shape).astype(np.float32)
+    np.save(os.path.join(workdir, "queries.npy"), queries)
+    # The lexical queries are a few words of the same chunks
+    texts = [
+        " ".join(index.document(int(row)).page_content.split()[:8]) for row in rows
+    ]
+    with open(os.path.join(workdir, "queries.json"), "w") as f:
+        json.dump(texts, f)
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _ = parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    _ = parser.add_argument("--queries", type=int, default=200)
+    _ = parser.add_argument("--k", type=int, default=10)
+    _ = parser.add_argument("--noise", type=float, default=0.02)
+    _ = parser.add_argument("--backends", nargs="+", default=BACKENDS)
+    _ = parser.add_argument("--json", help="Also write the results to this file")
+    _ = parser.add_argument("--worker", help=argparse.SUPPRESS)
+    _ = parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:  # pyright: ignore[reportAny]
+        run_worker(args.worker, args.workdir, args.k)  # pyright: ignore[reportAny]
+        return
+
+    results: list[dict[str, Any]] = []  # pyright: ignore[reportExplicitAny]
+    with tempfile.TemporaryDirectory() as workdir:
+        total = prepare(workdir, args.queries, args.noise)  # pyright: ignore[reportAny]
+        print(f"{total} chunks, {args.queries} queries per worker\n")
+        for backend in args.backends:  # pyright: ignore[reportAny]
+            for workers in args.workers:  # pyright: ignore[reportAny]
+                results.append(measure(backend, workdir, workers, args.k))  # pyright: ignore[reportAny]
+
+    columns = list(results[0])
+    print("  ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(
+            "  ".join(
+                f"{value:>14.1f}" if isinstance(value, float) else f"{value:>14}"
+                for value in result.values()  # pyright: ignore[reportAny]
+            )
+        )
+    if args.json:  # pyright: ignore[reportAny]
+        with open(args.json, "w") as f:  # pyright: ignore[reportAny]
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()